@@ -3,32 +3,77 @@ from dotenv import load_dotenv
 from flask import Flask, jsonify
 from flask_cors import CORS
 
-from db import get_db
-from auth_routes import register_auth_routes, require_auth as require_auth_factory
+# Load .env before importing the route modules: they read their settings at import time.
+load_dotenv()
+
+from db import get_db, pool_monitor
+from indexes import ensure_indexes
+from blobstore import BlobStore
+import derivatives
+import hashing
+import events
+from event_routes import register_event_routes, open_streams
+from metrics_routes import register_metrics
+from responses import register_responses
+from auth_routes import register_auth_routes, require_auth as require_auth_factory, user_cache
 from work_routes import register_work_routes
 from mobile_routes import register_mobile_routes
-
-load_dotenv()
+from upload_routes import register_upload_routes
 
 app = Flask(__name__)
 
 _allow = os.getenv("CORS_ALLOW_ORIGINS", "*").strip()
 allow_origins = "*" if _allow in ("*", "") else [x.strip() for x in _allow.split(",") if x.strip()]
-CORS(app, resources={r"/*": {"origins": allow_origins}})
+cors_options = {"origins": allow_origins}
+CORS(app, resources={r"/*": cors_options})
 
 db = get_db()
 users = db["users"]
 workorders = db["workorders"]
+sync_states = db["mobile_sync_states"]
+upload_sessions = db["upload_sessions"]
+auth_sessions = db["auth_sessions"]
+idempotency_keys = db["idempotency_keys"]
+blob_store = BlobStore.from_env(db["blobs"])
+
+if os.getenv("MONGO_ENSURE_INDEXES", "0").strip() in ("1", "true", "True"):
+    ensure_indexes(db)
 
 require_auth = require_auth_factory(users)
+require_auth_read = require_auth_factory(users, stateless=True)
+
+# Per-worker stats, shown by GET / and exported as gauges by /metrics.
+def worker_stats():
+    return {
+        "user_cache": user_cache.stats(),
+        "db_pool": pool_monitor.stats(),
+        "derivatives": derivatives.stats(),
+        "password_hashing": hashing.stats(),
+        "events": dict(events.stats(), open_streams=open_streams()),
+    }
 
 @app.get("/")
 def health():
-    return jsonify({"ok": True, "service": "fabrix-mobile-backend"})
+    return jsonify({"ok": True, "service": "fabrix-mobile-backend", **worker_stats()})
+
+register_metrics(app, gauges=worker_stats)
+register_responses(app)
 
-register_auth_routes(app, users)
+register_auth_routes(app, users, sessions=auth_sessions)
 register_work_routes(app, workorders, require_auth)
-register_mobile_routes(app, workorders, users, require_auth)
+register_mobile_routes(
+    app,
+    workorders,
+    users,
+    require_auth,
+    require_auth_read,
+    sync_states=sync_states,
+    upload_sessions=upload_sessions,
+    blob_store=blob_store,
+    idempotency_keys=idempotency_keys,
+)
+register_upload_routes(app, upload_sessions, require_auth, blob_store=blob_store)
+register_event_routes(app, workorders, require_auth_read)
 
 if __name__ == "__main__":
     port = int(os.getenv("MOBILE_BACKEND_PORT", "8100"))
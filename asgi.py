@@ -0,0 +1,425 @@
+import os
+import time
+import asyncio
+
+import aiofiles
+from a2wsgi import WSGIMiddleware
+from flask_cors.core import get_cors_headers, get_cors_options
+from starlette.applications import Starlette
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.http import parse_accept_header
+
+# ASGI entry point (uvicorn asgi:app --workers 3). The routes that spend their time
+# waiting (on MongoDB, bcrypt or a slow client upload) run natively on asyncio with Motor:
+#   POST /auth/login, GET /mobile/my-workorders, PUT /mobile/uploads/<upload_id>,
+#   GET /mobile/events, GET /
+# Every other route is served by the Flask app from app.py through a WSGI bridge on
+# ASGI_WSGI_THREADS threads per worker, so both modes answer the same API; gunicorn app:app
+# keeps working unchanged. The native handlers reuse the Flask routes' helpers and must
+# answer with the same bodies, status codes and validators.
+import app as wsgi_app
+import db as dbmod
+import event_routes
+import events
+import geo
+import hashing
+import metrics
+import responses
+from auth_routes import (
+    cached_token_version,
+    claims_refusal,
+    claims_user,
+    decode_access_token,
+    device_patch,
+    device_refusal,
+    is_super_user,
+    issue_access_token,
+    login_refusal,
+    login_response,
+    new_session,
+    parse_bearer,
+    rehash_write,
+    rehashed,
+    remember_token_version,
+    session_refresh_token,
+    user_cache,
+    user_refusal,
+)
+from mobile_routes import (
+    decode_cursor,
+    encode_cursor,
+    is_admin,
+    list_validators,
+    my_workorders_filter,
+    page_size,
+    parse_fields,
+    work_projection,
+    work_public,
+)
+from upload_routes import ChunkError, chunk_range, keep_hasher, live_session, staging_path, take_hasher
+from util import norm, utcnow
+
+WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "16"))
+_WRITE_BUF = 256 * 1024
+
+_in_flight = 0
+
+
+def _collection(name, route=None):
+    coll = dbmod.get_async_db()[name]
+    pref = dbmod.read_preference(route) if route else None
+    return coll.with_options(read_preference=pref) if pref is not None else coll
+
+
+def stats():
+    return {
+        **wsgi_app.worker_stats(),
+        "db_pool_async": dbmod.async_pool_monitor.stats(),
+        "asgi": {"native_in_flight": _in_flight, "wsgi_threads": WSGI_THREADS},
+    }
+
+
+# ----------------------------------------------------------------------
+# Responses (same encoding, validators, compression and CORS headers as the Flask side)
+# ----------------------------------------------------------------------
+
+# flask-cors computes the headers from the app's own CORS options, so both modes answer
+# alike (it echoes the request Origin rather than sending "*").
+_cors_options = get_cors_options(wsgi_app.app, wsgi_app.cors_options)
+
+
+def _cors(request, headers):
+    for k, v in get_cors_headers(_cors_options, request.headers, request.method).items():
+        headers[k] = ", ".join(filter(None, (headers.get(k), v))) if k == "Vary" else v
+
+
+def _json(request, obj, status=200, headers=None):
+    headers = dict(headers or {})
+    body = responses.dumps(obj)
+    if responses.COMPRESS_ENABLED:
+        headers["Vary"] = "Accept-Encoding"
+        body, encoding = responses.compress(body, parse_accept_header(request.headers.get("accept-encoding")))
+        if encoding:
+            headers["Content-Encoding"] = encoding
+    _cors(request, headers)
+    return Response(body, status, headers, media_type="application/json")
+
+
+def _error(request, detail, status, headers=None, **extra):
+    return _json(request, {"detail": detail, **extra}, status, headers)
+
+
+def _not_modified(request, etag, last_modified):
+    if responses.etag_matches(request.headers.get("if-none-match"), etag):
+        headers = responses.validator_headers(etag, last_modified)
+        _cors(request, headers)
+        return Response(status_code=304, headers=headers)
+    return None
+
+
+# Route label: the Flask url rule, so /metrics and the benchmark see one route in both modes.
+def native(rule):
+    def deco(fn):
+        async def endpoint(request):
+            global _in_flight
+            _in_flight += 1
+            t0 = time.perf_counter()
+            status = 500
+            try:
+                resp = await fn(request)
+                status = resp.status_code
+                return resp
+            finally:
+                _in_flight -= 1
+                if metrics.ENABLED:
+                    metrics.record_request(rule, request.method, status, time.perf_counter() - t0)
+        return endpoint
+    return deco
+
+
+# ----------------------------------------------------------------------
+# Auth (as auth_routes.require_auth, reading users through Motor)
+# ----------------------------------------------------------------------
+
+async def _load_user(uid):
+    if not uid:
+        return None
+    u = user_cache.get(uid)
+    if u is None:
+        u = await _collection("users").find_one({"_id": uid, "is_deleted": {"$ne": True}})
+        if not u:
+            return None
+        user_cache.set(uid, u)
+    return dict(u)
+
+
+# (user, None) or (None, error response).
+async def _authenticate(request, stateless=False):
+    payload = decode_access_token(parse_bearer(request.headers.get("authorization")))
+    if not payload:
+        return None, _error(request, "Invalid token", 401)
+    uid = payload.get("sub")
+    if stateless:
+        current = cached_token_version(payload)
+        if current is None:
+            current = remember_token_version(uid, await _load_user(uid))
+        refusal = claims_refusal(payload, current)
+        u = claims_user(payload)
+    else:
+        u = await _load_user(uid)
+        refusal = user_refusal(payload, u)
+    if refusal:
+        return None, _error(request, *refusal)
+    return u, None
+
+
+# ----------------------------------------------------------------------
+# Native routes
+# ----------------------------------------------------------------------
+
+@native("/")
+async def health(request):
+    return _json(request, {"ok": True, "service": "fabrix-mobile-backend", "mode": "asgi", **stats()})
+
+
+async def _rehash_if_needed(users, u, password):
+    if not hashing.needs_rehash(u.get("password_hash", "")):
+        return
+    try:
+        new = await hashing.new_hash_async(password)
+    except hashing.Saturated:
+        return
+    if (await users.update_one(*rehash_write(u, new))).modified_count:
+        rehashed(u)
+
+
+# bcrypt runs in hashing's process pool; the event loop only awaits it.
+@native("/auth/login")
+async def login(request):
+    try:
+        data = await request.json() or {}
+    except ValueError:
+        return _error(request, "Invalid JSON body", 400)
+    username = norm(data.get("username"))
+    password = data.get("password") or ""
+    remember_me = bool(data.get("remember_me", True))
+    device_id = norm(data.get("device_id"))
+    mac_address = norm(data.get("mac_address"))
+
+    users = _collection("users")
+    u = await users.find_one({"username": username, "is_deleted": {"$ne": True}})
+    refusal = login_refusal(u)
+    if refusal:
+        return _error(request, *refusal)
+    try:
+        ok = await hashing.verify_async(password, u.get("password_hash", ""))
+    except hashing.Saturated:
+        return _error(request, "Too many logins in progress, retry shortly", 503,
+                      {"Retry-After": str(hashing.RETRY_AFTER_SECONDS)})
+    if not ok:
+        return _error(request, "Invalid credentials", 401)
+    await _rehash_if_needed(users, u, password)
+
+    if not is_super_user(u):
+        refusal = device_refusal(u, device_id)
+        if refusal:
+            return _error(request, *refusal)
+        await users.update_one({"_id": u["_id"]}, {"$set": device_patch(device_id, mac_address)})
+        user_cache.invalidate(u["_id"])
+        u = await users.find_one({"_id": u["_id"]})
+
+    access = issue_access_token(u)
+    refresh = None
+    if remember_me:
+        s = new_session(u, device_id)
+        await _collection("auth_sessions").insert_one(s)
+        refresh = session_refresh_token(s)
+    return _json(request, login_response(u, access, refresh))
+
+
+@native("/mobile/my-workorders")
+async def my_workorders(request):
+    u, err = await _authenticate(request, stateless=True)
+    if err:
+        return err
+    args = request.query_params
+    status_q = norm(args.get("status"))
+    user_id = norm(args.get("user_id"))
+
+    target_uid = u.get("_id")
+    if user_id and is_admin(u):
+        target_uid = user_id
+
+    statuses = [s.strip() for s in status_q.split(",") if s.strip()]
+    limit = page_size(args.get("limit"))
+    cursor = norm(args.get("cursor"))
+    near = norm(args.get("near"))
+    try:
+        fields = parse_fields(norm(args.get("fields")))
+        after = decode_cursor(cursor) if cursor else None
+        if near:
+            lat, lng = geo.parse_point(near)
+            radius = geo.parse_radius(norm(args.get("radius")))
+    except ValueError as ve:
+        return _error(request, str(ve), 400)
+
+    workorders = _collection("workorders", "my_workorders")
+    query_string = request.url.query.encode()
+    scope_uid = target_uid if (not is_admin(u) or user_id) else None
+    if near:
+        if after:
+            return _error(request, "cursor cannot be combined with near", 400)
+        pipeline = geo.geo_near(
+            lat, lng, radius, my_workorders_filter(scope_uid, statuses), limit, work_projection(fields)
+        )
+        docs = await workorders.aggregate(pipeline).to_list(None)
+        for d in docs:
+            d["distance_m"] = round(d["distance_m"])
+        etag, last_modified = list_validators(u.get("_id"), query_string, docs, [d["distance_m"] for d in docs])
+        resp = _not_modified(request, etag, last_modified)
+        if resp:
+            return resp
+        items = [{**work_public(d, fields), "distance_m": d["distance_m"]} for d in docs]
+        return _json(request, {"items": items, "next_cursor": None}, headers=responses.validator_headers(etag, last_modified))
+
+    filt = my_workorders_filter(scope_uid, statuses, after)
+    docs = await (
+        workorders.find(filt, work_projection(fields))
+        .sort([("updated_at", -1), ("_id", -1)])
+        .limit(limit + 1)
+        .to_list(None)
+    )
+    etag, last_modified = list_validators(u.get("_id"), query_string, docs)
+    resp = _not_modified(request, etag, last_modified)
+    if resp:
+        return resp
+    next_cursor = encode_cursor(docs[limit - 1]) if len(docs) > limit else None
+    body = {"items": [work_public(d, fields) for d in docs[:limit]], "next_cursor": next_cursor}
+    return _json(request, body, headers=responses.validator_headers(etag, last_modified))
+
+
+# The body is streamed to the staging file as it arrives: a slow client holds a socket and
+# a coroutine, not a thread. File writes go through aiofiles (a thread per write call), in
+# blocks of _WRITE_BUF.
+@native("/mobile/uploads/<upload_id>")
+async def put_chunk(request):
+    u, err = await _authenticate(request)
+    if err:
+        return err
+    upload_id = request.path_params["upload_id"]
+    upload_sessions = _collection("upload_sessions")
+    s = live_session(await upload_sessions.find_one({"_id": upload_id, "user_id": u.get("_id")}))
+    if not s:
+        return _error(request, "Not found", 404)
+    try:
+        start, end = chunk_range(s, request.headers.get("content-range"))
+    except ChunkError as ce:
+        if ce.offset is None:
+            return _error(request, ce.detail, ce.status_code)
+        return _error(request, ce.detail, ce.status_code, {"Upload-Offset": str(ce.offset)}, offset=ce.offset)
+    length = end - start + 1
+    hasher = take_hasher(upload_id, start)
+
+    written = 0
+    buf = bytearray()
+    async with aiofiles.open(staging_path(upload_id), "r+b") as f:
+        await f.seek(start)
+        async for block in request.stream():
+            buf += block[: length - written - len(buf)]
+            if len(buf) >= _WRITE_BUF or written + len(buf) == length:
+                await f.write(bytes(buf))
+                if hasher is not None:
+                    hasher.update(buf)
+                written += len(buf)
+                buf.clear()
+            if written == length:
+                break
+    if written != length:
+        return _error(request, "Incomplete chunk", 400, offset=start)
+
+    res = await upload_sessions.update_one(
+        {"_id": upload_id, "status": "OPEN", "received": start},
+        {"$set": {"received": end + 1, "updated_at": utcnow()}},
+    )
+    if not res.modified_count:
+        return _error(request, "Concurrent chunk upload", 409)
+    keep_hasher(upload_id, end + 1, hasher)
+    return _json(request, {"upload_id": upload_id, "offset": end + 1, "size": s["size"]},
+                 headers={"Upload-Offset": str(end + 1)})
+
+
+class _EventStream(StreamingResponse):
+    def __init__(self, content, on_close, headers):
+        super().__init__(content, headers=headers, media_type="text/event-stream")
+        self.on_close = on_close
+
+    # Like Flask's call_on_close: also when the client goes away before the first chunk.
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
+
+
+# Same stream as event_routes, without a thread per client: the change stream thread hands
+# events to this loop (call_soon_threadsafe) and the stream awaits its asyncio.Queue.
+@native("/mobile/events")
+async def workorder_events(request):
+    u, err = await _authenticate(request, stateless=True)
+    if err:
+        return err
+    last_id = request.headers.get("last-event-id") or request.query_params.get("last_event_id") or None
+
+    if not event_routes.acquire(event_routes.ASYNC_MAX_STREAMS):
+        return _error(request, "Too many open event streams, retry later", 503,
+                      {"Retry-After": str(max(1, event_routes.RETRY_MS // 1000))})
+    feed = events.get_feed(wsgi_app.workorders)
+    try:
+        # Off the loop: an unknown last_id is caught up from the oplog.
+        loop = asyncio.get_running_loop()
+        sub, missed = await loop.run_in_executor(None, feed.subscribe, u.get("_id"), is_admin(u), last_id, loop)
+    except events.Unavailable as e:
+        event_routes.release()
+        return _error(request, str(e), 503)
+    except Exception:
+        event_routes.release()
+        raise
+
+    async def stream():
+        for chunk in event_routes.opening(missed):
+            yield chunk
+        deadline = time.monotonic() + event_routes.STREAM_SECONDS
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return
+            item = sub.due()
+            if item is None:
+                try:
+                    item = await asyncio.wait_for(sub.queue.get(), min(event_routes.HEARTBEAT_SECONDS, left))
+                except asyncio.TimeoutError:
+                    yield event_routes.PING
+                    continue
+            chunk, last = event_routes.render(sub, item)
+            yield chunk
+            if last:
+                return
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    _cors(request, headers)
+    return _EventStream(stream(), lambda: (feed.unsubscribe(sub), event_routes.release()), headers)
+
+
+if metrics.ENABLED:
+    metrics.gauge_source = stats
+
+app = Starlette(routes=[
+    Route("/", health, methods=["GET"]),
+    Route("/auth/login", login, methods=["POST"]),
+    Route("/mobile/my-workorders", my_workorders, methods=["GET"]),
+    Route("/mobile/uploads/{upload_id}", put_chunk, methods=["PUT"]),
+    Route("/mobile/events", workorder_events, methods=["GET"]),
+    # Everything else, and other methods on the paths above (CORS preflight), goes to Flask.
+    Mount("/", WSGIMiddleware(wsgi_app.app, workers=WSGI_THREADS)),
+])
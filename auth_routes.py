@@ -1,17 +1,95 @@
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask import request, jsonify
 from functools import wraps
 
-from security import verify_password, create_access_token, create_refresh_token, decode_access_token
-from util import utcnow, mac_hash, norm
+from cache import TTLCache
+from pymongo import ReturnDocument
+
+import hashing
+from responses import not_modified, weak_etag, with_validators
+from security import create_access_token, create_refresh_token, decode_access_token, decode_refresh_token, from_epoch
+from util import utcnow, naive_utc, new_id, mac_hash, norm
 
 ACCESS_TOKEN_MINUTES = int(os.getenv("ACCESS_TOKEN_MINUTES", "15"))
 REFRESH_TOKEN_DAYS = int(os.getenv("REFRESH_TOKEN_DAYS", "30"))
+# Refresh sessions slide by REFRESH_TOKEN_DAYS on every use but never outlive this.
+REFRESH_SESSION_MAX_DAYS = int(os.getenv("REFRESH_SESSION_MAX_DAYS", "90"))
+# A client that lost the response to a refresh may retry with the previous token for this long.
+REFRESH_REUSE_GRACE_SECONDS = int(os.getenv("REFRESH_REUSE_GRACE_SECONDS", "30"))
 SUPER_USER_USERNAME = os.getenv("SUPER_USER_USERNAME", "Adyapragnya").strip()
 
 RELEASE_DEVICE_ON_LOGOUT = os.getenv("RELEASE_DEVICE_ON_LOGOUT", "1").strip() not in ("0", "false", "False")
 
+# Authenticated user docs keyed by token "sub". Changes made by the desktop backend
+# (disable, lock, delete) become visible here after at most USER_CACHE_TTL_SECONDS.
+user_cache = TTLCache(
+    maxsize=int(os.getenv("USER_CACHE_MAX", "5000")),
+    ttl=float(os.getenv("USER_CACHE_TTL_SECONDS", "30")),
+)
+
+def load_user(users, uid):
+    if not uid:
+        return None
+    u = user_cache.get(uid)
+    if u is None:
+        u = users.find_one({"_id": uid, "is_deleted": {"$ne": True}})
+        if not u:
+            return None
+        user_cache.set(uid, u)
+    return dict(u)
+
+# Latest known token_version per user. Stateless auth only goes back to MongoDB
+# when this entry expires or a token carries a version newer than the one cached.
+token_versions = TTLCache(
+    maxsize=int(os.getenv("USER_CACHE_MAX", "5000")),
+    ttl=float(os.getenv("TOKEN_VERSION_TTL_SECONDS", "60")),
+)
+
+def token_version(u: dict) -> int:
+    try:
+        return int((u or {}).get("token_version") or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def bump_token_version(users, uid, patch: dict = None):
+    # Revokes every access token issued to uid so far (logout, device unlink, lock, disable).
+    d = users.find_one_and_update(
+        {"_id": uid},
+        {"$inc": {"token_version": 1}, "$set": {**(patch or {}), "updated_at": utcnow()}},
+        projection={"token_version": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    user_cache.invalidate(uid)
+    if d:
+        token_versions.set(uid, token_version(d))
+    else:
+        token_versions.invalidate(uid)
+    return d
+
+def issue_access_token(u: dict) -> str:
+    return create_access_token(
+        u["_id"],
+        u["username"],
+        u["role"],
+        ACCESS_TOKEN_MINUTES,
+        token_version=token_version(u),
+        is_active=u.get("is_active", True),
+        subscription_start=u.get("subscription_start"),
+        subscription_end=u.get("subscription_end"),
+    )
+
+def claims_user(payload: dict) -> dict:
+    return {
+        "_id": payload.get("sub"),
+        "username": payload.get("username"),
+        "role": payload.get("role"),
+        "is_active": payload.get("act", True),
+        "token_version": int(payload.get("tv") or 0),
+        "subscription_start": from_epoch(payload.get("sst")),
+        "subscription_end": from_epoch(payload.get("sen")),
+    }
+
 def subscription_allows(u: dict) -> bool:
     if not u:
         return False
@@ -34,30 +112,240 @@ def is_super_user(u: dict) -> bool:
         return True
     return (u.get("username") or "").strip().lower() == SUPER_USER_USERNAME.lower()
 
-def bearer_token():
-    h = request.headers.get("Authorization") or ""
+def parse_bearer(authorization: str) -> str:
+    h = authorization or ""
     if h.lower().startswith("bearer "):
         return h.split(" ", 1)[1].strip()
     return ""
 
-def require_auth(users):
+def bearer_token():
+    return parse_bearer(request.headers.get("Authorization"))
+
+# ----------------------------------------------------------------------
+# Access token checks, shared with asgi.py (which loads users through Motor). The
+# refusals return (detail, status) when the request is refused, else None.
+# ----------------------------------------------------------------------
+
+# Stateless mode: the cached token_version for the token's user, or None when the user
+# has to be loaded (nothing cached, or the token is newer than the cache).
+def cached_token_version(payload: dict):
+    current = token_versions.get(payload.get("sub"))
+    if current is None or int(payload.get("tv") or 0) > current:
+        return None
+    return current
+
+# Caches and returns the token_version of a freshly loaded user (None: user gone).
+def remember_token_version(uid, u: dict):
+    if not u:
+        return None
+    current = token_version(u)
+    token_versions.set(uid, current)
+    return current
+
+def claims_refusal(payload: dict, current):
+    if current is None:
+        return "User disabled", 403
+    if int(payload.get("tv") or 0) < current:
+        return "Token revoked", 401
+    u = claims_user(payload)
+    if not u.get("is_active", True) or not subscription_allows(u):
+        return "User disabled", 403
+    return None
+
+def user_refusal(payload: dict, u: dict):
+    if not u or not u.get("is_active", True):
+        return "User disabled", 403
+    if int(payload.get("tv") or 0) < token_version(u):
+        return "Token revoked", 401
+    return None
+
+# stateless=True trusts the gating claims embedded in the access token (for read-only
+# endpoints); request.user then only carries _id, username, role and the subscription window.
+def require_auth(users, stateless: bool = False):
     def deco(fn):
         @wraps(fn)
         def wrapper(*args, **kwargs):
-            token = bearer_token()
-            payload = decode_access_token(token)
+            payload = decode_access_token(bearer_token())
             if not payload:
                 return jsonify({"detail": "Invalid token"}), 401
             uid = payload.get("sub")
-            u = users.find_one({"_id": uid, "is_deleted": {"$ne": True}})
-            if not u or not u.get("is_active", True):
-                return jsonify({"detail": "User disabled"}), 403
+            if stateless:
+                current = cached_token_version(payload)
+                if current is None:
+                    current = remember_token_version(uid, load_user(users, uid))
+                refusal = claims_refusal(payload, current)
+                u = claims_user(payload)
+            else:
+                u = load_user(users, uid)
+                refusal = user_refusal(payload, u)
+            if refusal:
+                return jsonify({"detail": refusal[0]}), refusal[1]
             request.user = u
             return fn(*args, **kwargs)
         return wrapper
     return deco
 
-def register_auth_routes(app, users):
+# ----------------------------------------------------------------------
+# Login checks, shared with asgi.py's native /auth/login. Each returns (detail, status)
+# when the login is refused, else None.
+# ----------------------------------------------------------------------
+
+def login_refusal(u: dict):
+    if not u or not u.get("is_active", True):
+        return "Invalid credentials", 401
+    if u.get("is_locked", False):
+        return "Account locked", 403
+    if not subscription_allows(u):
+        return "Subscription inactive/expired", 403
+    return None
+
+# Accounts other than the super user are bound to one device at a time.
+def device_refusal(u: dict, device_id: str):
+    if not device_id:
+        return "device_id required for this account", 400
+    existing_device = norm(u.get("active_device_id"))
+    if existing_device and existing_device != device_id:
+        return "This account is already active on another system. Ask SUPER_ADMIN to unlink the device.", 409
+    return None
+
+def device_patch(device_id: str, mac_address: str) -> dict:
+    patch = {
+        "active_device_id": device_id,
+        "active_device_last_login": utcnow(),
+        "updated_at": utcnow(),
+    }
+    mh = mac_hash(mac_address)
+    if mh:
+        patch["active_device_mac_hash"] = mh
+    return patch
+
+def login_response(u: dict, access: str, refresh: str) -> dict:
+    return {
+        "user": {
+            "id": u["_id"],
+            "username": u["username"],
+            "role": u["role"],
+            "user_type": u.get("user_type") or ("MOBILE_USER" if u.get("role") == "MOBILE_USER" else "ADMIN"),
+            "full_name": u.get("full_name"),
+            "phone": u.get("phone"),
+            "allowed_modules": u.get("allowed_modules") or [],
+            "subscription_start": u.get("subscription_start"),
+            "subscription_end": u.get("subscription_end"),
+        },
+        "access_token": access,
+        "refresh_token": refresh,
+    }
+
+# BCRYPT_ROUNDS changed since this hash was made: store a new one while we hold the
+# plaintext. Skipped when the hash pool is busy; the next login tries again.
+# rehash_write/rehashed are shared with asgi.py, which awaits the hash and the write.
+def rehash_write(u: dict, new_hash: str):
+    old = u.get("password_hash", "")
+    return {"_id": u["_id"], "password_hash": old}, {"$set": {"password_hash": new_hash, "updated_at": utcnow()}}
+
+def rehashed(u: dict):
+    hashing.note_rehash()
+    user_cache.invalidate(u["_id"])
+
+def _rehash_if_needed(users, u, password):
+    if not hashing.needs_rehash(u.get("password_hash", "")):
+        return
+    try:
+        new = hashing.new_hash(password)
+    except hashing.Saturated:
+        return
+    if users.update_one(*rehash_write(u, new)).modified_count:
+        rehashed(u)
+
+# ----------------------------------------------------------------------
+# Refresh sessions (auth_sessions collection). Each login with remember_me opens one;
+# the refresh token carries its id (sid) and current rotation id (jti). Every refresh
+# rotates jti. Presenting an older jti (outside the retry grace) means the token was
+# copied: the whole session is revoked. Sessions are bound to the device they were
+# opened on and die with token_version (logout, device unlink, lock on desktop).
+# ----------------------------------------------------------------------
+
+class RefreshError(Exception):
+    def __init__(self, detail: str, status_code: int = 401):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code
+
+def new_session(u: dict, device_id: str = None) -> dict:
+    now = utcnow()
+    return {
+        "_id": new_id(),
+        "user_id": u["_id"],
+        "device_id": device_id or None,
+        "jti": new_id(),
+        "prev_jti": None,
+        "tv": token_version(u),
+        "rotations": 0,
+        "created_at": now,
+        "last_used_at": now,
+        "expires_at": now + timedelta(days=REFRESH_TOKEN_DAYS),
+        "max_expires_at": now + timedelta(days=REFRESH_SESSION_MAX_DAYS),
+        "revoked_at": None,
+    }
+
+def open_session(sessions, u: dict, device_id: str = None) -> dict:
+    s = new_session(u, device_id)
+    sessions.insert_one(s)
+    return s
+
+def session_refresh_token(s: dict) -> str:
+    return create_refresh_token(s["user_id"], REFRESH_TOKEN_DAYS, session_id=s["_id"], jti=s["jti"])
+
+def revoke_sessions(sessions, filt: dict, reason: str):
+    sessions.update_many({**filt, "revoked_at": None}, {"$set": {"revoked_at": utcnow(), "revoked_reason": reason}})
+
+def load_session(sessions, payload: dict, now) -> dict:
+    s = sessions.find_one({"_id": payload["sid"]})
+    if not s or s.get("user_id") != payload.get("sub"):
+        raise RefreshError("Invalid refresh token")
+    if s.get("revoked_at"):
+        raise RefreshError("Session revoked")
+    n = naive_utc(now)
+    if naive_utc(s["expires_at"]) <= n or naive_utc(s["max_expires_at"]) <= n:
+        raise RefreshError("Session expired")
+    return s
+
+def _within_grace(s: dict, jti: str, now) -> bool:
+    last = naive_utc(s.get("last_used_at"))
+    return (
+        jti == s.get("prev_jti")
+        and last is not None
+        and (naive_utc(now) - last).total_seconds() <= REFRESH_REUSE_GRACE_SECONDS
+    )
+
+# Compare-and-set on the presented jti. Returns the session carrying the jti to issue.
+def rotate_session(sessions, s: dict, jti: str, now) -> dict:
+    if jti != s["jti"]:
+        if _within_grace(s, jti, now):
+            return s
+        revoke_sessions(sessions, {"_id": s["_id"]}, "reuse")
+        raise RefreshError("Refresh token reuse detected")
+    expires_at = min(naive_utc(now) + timedelta(days=REFRESH_TOKEN_DAYS), naive_utc(s["max_expires_at"]))
+    rotated = sessions.find_one_and_update(
+        {"_id": s["_id"], "jti": jti, "revoked_at": None},
+        {
+            "$set": {"jti": new_id(), "prev_jti": jti, "last_used_at": now, "expires_at": expires_at},
+            "$inc": {"rotations": 1},
+        },
+        return_document=ReturnDocument.AFTER,
+    )
+    if rotated:
+        return rotated
+    # A concurrent refresh with the same token won the race.
+    current = sessions.find_one({"_id": s["_id"]})
+    if current and not current.get("revoked_at") and _within_grace(current, jti, now):
+        return current
+    raise RefreshError("Session revoked")
+
+def register_auth_routes(app, users, sessions=None):
+    if sessions is None:
+        sessions = users.database["auth_sessions"]
+
     @app.post("/auth/login")
     def login():
         data = request.get_json(force=True) or {}
@@ -69,70 +357,87 @@ def register_auth_routes(app, users):
         mac_address = norm(data.get("mac_address"))
 
         u = users.find_one({"username": username, "is_deleted": {"$ne": True}})
-        if not u or not u.get("is_active", True):
-            return jsonify({"detail": "Invalid credentials"}), 401
-        if u.get("is_locked", False):
-            return jsonify({"detail": "Account locked"}), 403
-        if not subscription_allows(u):
-            return jsonify({"detail": "Subscription inactive/expired"}), 403
-        if not verify_password(password, u.get("password_hash", "")):
+        refusal = login_refusal(u)
+        if refusal:
+            return jsonify({"detail": refusal[0]}), refusal[1]
+        try:
+            ok = hashing.verify(password, u.get("password_hash", ""))
+        except hashing.Saturated:
+            resp = jsonify({"detail": "Too many logins in progress, retry shortly"})
+            resp.headers["Retry-After"] = str(hashing.RETRY_AFTER_SECONDS)
+            return resp, 503
+        if not ok:
             return jsonify({"detail": "Invalid credentials"}), 401
+        _rehash_if_needed(users, u, password)
 
         if not is_super_user(u):
-            if not device_id:
-                return jsonify({"detail": "device_id required for this account"}), 400
-
-            existing_device = norm(u.get("active_device_id"))
-            if existing_device and existing_device != device_id:
-                return jsonify({"detail": "This account is already active on another system. Ask SUPER_ADMIN to unlink the device."}), 409
-
-            patch = {
-                "active_device_id": device_id,
-                "active_device_last_login": utcnow(),
-                "updated_at": utcnow(),
-            }
-            mh = mac_hash(mac_address)
-            if mh:
-                patch["active_device_mac_hash"] = mh
-            users.update_one({"_id": u["_id"]}, {"$set": patch})
+            refusal = device_refusal(u, device_id)
+            if refusal:
+                return jsonify({"detail": refusal[0]}), refusal[1]
+            users.update_one({"_id": u["_id"]}, {"$set": device_patch(device_id, mac_address)})
+            user_cache.invalidate(u["_id"])
             u = users.find_one({"_id": u["_id"]})
 
-        access = create_access_token(u["_id"], u["username"], u["role"], ACCESS_TOKEN_MINUTES)
-        refresh = create_refresh_token(u["_id"], REFRESH_TOKEN_DAYS) if remember_me else None
-
-        return jsonify({
-            "user": {
-                "id": u["_id"],
-                "username": u["username"],
-                "role": u["role"],
-                "user_type": u.get("user_type") or ("MOBILE_USER" if u.get("role") == "MOBILE_USER" else "ADMIN"),
-                "full_name": u.get("full_name"),
-                "phone": u.get("phone"),
-                "allowed_modules": u.get("allowed_modules") or [],
-                "subscription_start": u.get("subscription_start").isoformat() if u.get("subscription_start") else None,
-                "subscription_end": u.get("subscription_end").isoformat() if u.get("subscription_end") else None,
-            },
-            "access_token": access,
-            "refresh_token": refresh,
-        })
+        access = issue_access_token(u)
+        refresh = session_refresh_token(open_session(sessions, u, device_id)) if remember_me else None
+
+        return jsonify(login_response(u, access, refresh))
+
+    # Renews the access token without a password check: {refresh_token, device_id}.
+    # Returns a new access token and the rotated refresh token (the old one is spent).
+    @app.post("/auth/refresh")
+    def refresh():
+        data = request.get_json(force=True) or {}
+        payload = decode_refresh_token(norm(data.get("refresh_token")))
+        if not payload:
+            return jsonify({"detail": "Invalid refresh token"}), 401
+        device_id = norm(data.get("device_id"))
+        now = utcnow()
+
+        u = load_user(users, payload.get("sub"))
+        if not u or not u.get("is_active", True) or not subscription_allows(u):
+            return jsonify({"detail": "User disabled"}), 403
+        if u.get("is_locked", False):
+            return jsonify({"detail": "Account locked"}), 403
+
+        try:
+            s = load_session(sessions, payload, now)
+            if s.get("tv") != token_version(u):
+                revoke_sessions(sessions, {"_id": s["_id"]}, "token_version")
+                raise RefreshError("Session revoked")
+            if not is_super_user(u):
+                if not device_id or device_id != s.get("device_id"):
+                    revoke_sessions(sessions, {"_id": s["_id"]}, "device_mismatch")
+                    raise RefreshError("Refresh token belongs to another device")
+                if norm(u.get("active_device_id")) != device_id:
+                    revoke_sessions(sessions, {"_id": s["_id"]}, "device_unlinked")
+                    raise RefreshError("Device is no longer linked to this account")
+            s = rotate_session(sessions, s, payload["jti"], now)
+        except RefreshError as rfe:
+            return jsonify({"detail": rfe.detail}), rfe.status_code
+
+        return jsonify({"access_token": issue_access_token(u), "refresh_token": session_refresh_token(s)})
 
     @app.get("/auth/me")
     @require_auth(users)
     def me():
         u = request.user
-        return jsonify({
-            "user": {
-                "id": u["_id"],
-                "username": u["username"],
-                "role": u["role"],
-                "user_type": u.get("user_type"),
-                "full_name": u.get("full_name"),
-                "phone": u.get("phone"),
-                "allowed_modules": u.get("allowed_modules") or [],
-                "subscription_start": u.get("subscription_start").isoformat() if u.get("subscription_start") else None,
-                "subscription_end": u.get("subscription_end").isoformat() if u.get("subscription_end") else None,
-            }
-        })
+        user = {
+            "id": u["_id"],
+            "username": u["username"],
+            "role": u["role"],
+            "user_type": u.get("user_type"),
+            "full_name": u.get("full_name"),
+            "phone": u.get("phone"),
+            "allowed_modules": u.get("allowed_modules") or [],
+            "subscription_start": u.get("subscription_start"),
+            "subscription_end": u.get("subscription_end"),
+        }
+        etag = weak_etag(sorted(user.items()))
+        resp = not_modified(etag)
+        if resp:
+            return resp
+        return with_validators(jsonify({"user": user}), etag)
 
     @app.post("/auth/logout")
     @require_auth(users)
@@ -141,10 +446,11 @@ def register_auth_routes(app, users):
         data = request.get_json(force=True) or {}
         device_id = norm(data.get("device_id"))
 
+        patch = {}
         if RELEASE_DEVICE_ON_LOGOUT and u.get("role") != "SUPER_ADMIN":
             if device_id and norm(u.get("active_device_id")) == device_id:
-                users.update_one(
-                    {"_id": u["_id"]},
-                    {"$set": {"active_device_id": None, "active_device_mac_hash": None, "updated_at": utcnow()}},
-                )
+                patch = {"active_device_id": None, "active_device_mac_hash": None}
+        bump_token_version(users, u["_id"], patch)
+        # The version bump already invalidates them; mark them for clarity and cleanup.
+        revoke_sessions(sessions, {"user_id": u["_id"]}, "logout")
         return jsonify({"ok": True})
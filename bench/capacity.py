@@ -0,0 +1,95 @@
+import sys
+import json
+import argparse
+from pathlib import Path
+
+from bench import load
+from bench.run import add_server_args, serve
+
+# Side-by-side capacity run: the same seeded corpus and the same slow-clients traffic
+# (my-workorders polling while a third of the clients upload voice notes at
+# load.SLOW_UPLOAD_BPS) against each server, at increasing numbers of concurrent clients.
+# Every client keeps one keep-alive connection. A step passes when my-workorders stays
+# under --slo-ms at p95 with no errors, timeouts or 503s; the connections a container
+# handles is the largest passing client count with every smaller step passing too.
+#
+#   python -m bench.capacity --db fabrix_bench --clients 24,48,96,192,384 --duration 30
+#   python -m bench.capacity --standin --users 50 --workorders-per-user 10 --clients 16,32,64
+
+PHASE = next(w for name, w, _ in load.MIXES["slow-clients"] if name == "slow-clients")
+
+
+def _step(res, slo_ms):
+    poll = res["endpoints"].get("my_workorders")
+    upload = res["endpoints"].get("put_chunk")
+    failed = sum(r["errors"] + r["rejected_503"] for r in res["endpoints"].values())
+    return {
+        "poll_rps": poll["rps"] if poll else 0,
+        "poll_p50_ms": poll["p50_ms"] if poll else None,
+        "poll_p95_ms": poll["p95_ms"] if poll else None,
+        "uploads": upload["count"] if upload else 0,
+        "upload_p95_ms": upload["p95_ms"] if upload else None,
+        "failed": failed,
+        "ok": bool(poll) and failed == 0 and poll["p95_ms"] <= slo_ms,
+    }
+
+
+def handled(steps):
+    best = 0
+    for clients, step in sorted(steps.items()):
+        if not step["ok"]:
+            break
+        best = clients
+    return best
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(prog="python -m bench.capacity", description="gunicorn vs uvicorn connections handled")
+    add_server_args(p)
+    p.add_argument("--servers", default="gunicorn,uvicorn")
+    p.add_argument("--clients", default="24,48,96,192", help="comma-separated concurrent client counts")
+    p.add_argument("--duration", type=float, default=30, help="seconds per step")
+    p.add_argument("--slo-ms", type=float, default=500, help="my-workorders p95 a step must stay under")
+    p.add_argument("--out", help="write the result JSON here")
+    args = p.parse_args(argv)
+
+    work = Path(args.workdir).resolve()
+    work.mkdir(parents=True, exist_ok=True)
+    servers = [s.strip() for s in args.servers.split(",") if s.strip()]
+    counts = sorted(int(n) for n in args.clients.split(","))
+    results = {}
+    for i, server in enumerate(servers):
+        # The corpus is seeded once; later servers read the same one.
+        with serve(args, server, work, skip_seed=i > 0) as (port, workers, manifest):
+            tokens = {}
+            load.run_phase("127.0.0.1", port, manifest, tokens, "login_storm", None, min(32, counts[-1]), args.seed)
+            steps = {}
+            for n in counts:
+                print(f"{server}: {n} clients for {args.duration:.0f}s ...")
+                res = load.run_phase("127.0.0.1", port, manifest, tokens, PHASE, args.duration, n, args.seed)
+                steps[n] = _step(res, args.slo_ms)
+            results[server] = {"workers": workers, "steps": steps, "handled": handled(steps)}
+
+    print(f"\n{'clients':>7} " + " ".join(
+        f"{s + ' p95 ms':>16} {'rps':>7} {'fail':>5}" for s in servers))
+    for n in counts:
+        cells = []
+        for s in servers:
+            st = results[s]["steps"][n]
+            p95 = "-" if st["poll_p95_ms"] is None else f"{st['poll_p95_ms']}{'' if st['ok'] else ' !'}"
+            cells.append(f"{p95:>16} {st['poll_rps']:>7} {st['failed']:>5}")
+        print(f"{n:>7} " + " ".join(cells))
+    for s in servers:
+        r = results[s]
+        print(f"{s}: {r['handled']} concurrent connections per container ({r['workers']} workers, "
+              f"my-workorders p95 <= {args.slo_ms:.0f} ms, no failures)")
+
+    if args.out:
+        config = {k: getattr(args, k) for k in ("users", "workorders_per_user", "workers", "threads", "duration",
+                                               "slo_ms", "standin", "seed")}
+        Path(args.out).write_text(json.dumps({"config": config, "servers": results}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+import io
+import random
+from collections import Counter
+from datetime import timedelta
+from pathlib import Path
+
+try:
+    from PIL import Image
+except ImportError:  # without Pillow the "photos" are random bytes behind a JPEG header
+    Image = None
+
+from security import hash_password
+from util import utcnow
+
+# Synthetic corpus for the benchmark: users, workorders with realistic history /
+# work_updates sizes, and photo / voice files stored in the blob store like real uploads.
+# Everything but the timestamps is derived from `seed`, so two runs with the same
+# arguments produce the same documents and ids. Returns a manifest the load generator works from.
+
+PASSWORD = "bench-pass"
+COLLECTIONS = (
+    "users", "workorders", "user_stats", "mobile_sync_states", "upload_sessions", "auth_sessions",
+    "idempotency_keys", "blobs", "workorder_update_buckets",
+)
+# (status, weight) of seeded workorders.
+STATUSES = (("ASSIGNED", 3), ("ACCEPTED", 2), ("IN_PROGRESS", 2), ("COMPLETED", 3))
+# Around which workorders are placed (lat, lng).
+CENTRE = (12.97, 77.59)
+
+
+def _photo(rng, i):
+    if Image is None:
+        return b"\xff\xd8\xff\xe0" + rng.randbytes(rng.randint(300_000, 1_500_000))
+    # Noise compresses badly, so this is about the size of a real phone photo.
+    im = Image.frombytes("RGB", (1280, 960), rng.randbytes(1280 * 960 * 3))
+    buf = io.BytesIO()
+    im.save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+
+def write_media(out_dir: Path, photos=6, voices=3, seed=1) -> dict:
+    rng = random.Random(seed)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    files = {"image": [], "voice": []}
+    for i in range(photos):
+        p = out_dir / f"photo_{i}.jpg"
+        if not p.exists():
+            p.write_bytes(_photo(rng, i))
+        files["image"].append(str(p))
+    for i in range(voices):
+        p = out_dir / f"voice_{i}.m4a"
+        if not p.exists():
+            p.write_bytes(rng.randbytes(rng.randint(60_000, 400_000)))
+        files["voice"].append(str(p))
+    return files
+
+
+def _store(blob_store, files) -> dict:
+    metas = {"image": [], "voice": []}
+    for kind, paths in files.items():
+        for path in paths:
+            mime = "image/jpeg" if kind == "image" else "audio/mp4"
+            with open(path, "rb") as f:
+                sha256, size = blob_store.put_stream(f, mime)
+            metas[kind].append({"name": Path(path).name, "mime": mime, "size": size, "sha256": sha256})
+    return metas
+
+
+def _meta(m, wo_id, update_id):
+    return {**m, "url": f"/mobile/uploads/workorders/{wo_id}/{update_id}/{m['name']}"}
+
+
+def seed(db, blob_store, media_dir: Path, users=100, workorders_per_user=40, history=(10, 40), updates=(0, 12),
+         seed=1) -> dict:
+    rng = random.Random(seed)
+    for name in COLLECTIONS:
+        db[name].delete_many({})
+    files = write_media(Path(media_dir), seed=seed)
+    stored = _store(blob_store, files)
+    now = utcnow()
+    # One bcrypt hash for everyone: the login storm still pays the full cost per login.
+    pw_hash = hash_password(PASSWORD)
+
+    user_docs, wo_docs, manifest_users = [], [], []
+    refs = Counter()
+    statuses = [s for s, w in STATUSES for _ in range(w)]
+    for ui in range(users):
+        uid = f"bench-u{ui:04d}"
+        user_docs.append({
+            "_id": uid,
+            "username": f"bench-user-{ui:04d}",
+            "role": "MOBILE_USER",
+            "user_type": "MOBILE_USER",
+            "full_name": f"Bench Technician {ui}",
+            "password_hash": pw_hash,
+            "is_active": True,
+            "is_deleted": False,
+            "created_at": now,
+            "updated_at": now,
+        })
+        entry = {"id": uid, "username": f"bench-user-{ui:04d}", "device_id": f"bench-device-{ui:04d}",
+                 "active_wo_ids": [], "media": []}
+        for wi in range(workorders_per_user):
+            wo_id = f"bench-wo-{ui:04d}-{wi:03d}"
+            status = rng.choice(statuses)
+            updated = now - timedelta(minutes=rng.randint(0, 60 * 24 * 30))
+            lat = CENTRE[0] + rng.uniform(-0.2, 0.2)
+            lng = CENTRE[1] + rng.uniform(-0.2, 0.2)
+            hist = [
+                {"at": (updated - timedelta(hours=h)).isoformat(), "by": uid, "action": "NOTE", "status": status}
+                for h in range(rng.randint(*history))
+            ]
+            ups = []
+            for n in range(rng.randint(*updates)):
+                update_id = f"bench-up-{ui:04d}-{wi:03d}-{n:02d}"
+                imgs = [_meta(rng.choice(stored["image"]), wo_id, update_id) for _ in range(rng.randint(0, 3))]
+                voice = _meta(rng.choice(stored["voice"]), wo_id, update_id) if rng.random() < 0.3 else None
+                # Distinct names within an update, as _unique_name would produce.
+                for k, m in enumerate(imgs):
+                    m["name"] = f"{k}_{m['name']}"
+                    m["url"] = f"/mobile/uploads/workorders/{wo_id}/{update_id}/{m['name']}"
+                for m in imgs + ([voice] if voice else []):
+                    refs[m["sha256"]] += 1
+                    if len(entry["media"]) < 50:
+                        entry["media"].append(m["url"])
+                ups.append({
+                    "id": update_id,
+                    "at": (updated - timedelta(hours=n)).isoformat(),
+                    "by": uid,
+                    "message": "bench update " + "x" * rng.randint(10, 200),
+                    "images": imgs,
+                    "voice": voice,
+                    "source": "MOBILE",
+                    "status": status,
+                })
+            doc = {
+                "_id": wo_id,
+                "wo_no": f"B{ui:04d}{wi:03d}",
+                "customer_name": f"Customer {ui}-{wi}",
+                "phone": f"+91 90000 {ui:04d}{wi % 10}",
+                "address": f"{wi} Bench Street, Block {ui}",
+                "status": status,
+                "schedule": {"date": (now + timedelta(days=rng.randint(-3, 10))).date().isoformat()},
+                "location": {"lat": lat, "lng": lng, "label": f"Site {wi}"},
+                "geo": {"type": "Point", "coordinates": [lng, lat]},
+                "assigned_team_ids": [uid],
+                "is_deleted": False,
+                "created_at": updated - timedelta(days=7),
+                "updated_at": updated,
+                "history": hist,
+                "work_updates": ups,
+            }
+            if status == "COMPLETED":
+                doc.update(completed_by=uid, completed_at=updated)
+            if status in ("ACCEPTED", "IN_PROGRESS"):
+                entry["active_wo_ids"].append(wo_id)
+            wo_docs.append(doc)
+        manifest_users.append(entry)
+
+    db["users"].insert_many(user_docs)
+    for i in range(0, len(wo_docs), 500):
+        db["workorders"].insert_many(wo_docs[i:i + 500])
+    sizes = {m["sha256"]: (m["size"], m["mime"]) for kind in stored.values() for m in kind}
+    # put_stream took one reference per file; set the real counts.
+    for sha, n in refs.items():
+        db["blobs"].update_one(
+            {"_id": sha},
+            {"$set": {"refs": n, "size": sizes[sha][0], "mime": sizes[sha][1], "created_at": now, "last_ref_at": now}},
+            upsert=True,
+        )
+    return {
+        "seed": seed,
+        "password": PASSWORD,
+        "users": manifest_users,
+        "media": files,
+        "workorders": len(wo_docs),
+        "work_updates": sum(len(d["work_updates"]) for d in wo_docs),
+        "history": sum(len(d["history"]) for d in wo_docs),
+    }
@@ -0,0 +1,255 @@
+import json
+import time
+import uuid
+import random
+import threading
+import http.client
+from pathlib import Path
+from urllib.parse import urlencode
+
+# Load generator: a fixed number of client threads, each with its own keep-alive
+# connection, replaying a traffic mix against a running server. Latency is measured per
+# request on the client (connect + send + full response body).
+
+# Endpoint name -> (method, Flask url rule); the rule is the `route` label in /metrics.
+ENDPOINTS = {
+    "login": ("POST", "/auth/login"),
+    "my_workorders": ("GET", "/mobile/my-workorders"),
+    "achievement": ("GET", "/mobile/achievement"),
+    "submit": ("POST", "/mobile/workorders/<wo_id>/submit"),
+    "get_upload": ("GET", "/mobile/uploads/workorders/<wo_id>/<update_id>/<filename>"),
+    "open_upload": ("POST", "/mobile/uploads"),
+    "put_chunk": ("PUT", "/mobile/uploads/<upload_id>"),
+}
+
+# Uplink of a technician on a weak mobile connection (bytes/s), for slow_upload.
+SLOW_UPLOAD_BPS = 64 * 1024
+
+# Traffic mixes: phases of (name, {endpoint: weight} or "login_storm", share of the run
+# duration, or None for "until every user has logged in once").
+# shift-start: every technician logs in at once, then polls and reports work.
+MIXES = {
+    "shift-start": [
+        ("login_storm", "login_storm", None),
+        ("shift", {"my_workorders": 50, "achievement": 15, "get_upload": 22, "submit": 8, "login": 5}, 1.0),
+    ],
+    "polling": [
+        ("login_storm", "login_storm", None),
+        ("polling", {"my_workorders": 80, "achievement": 20}, 1.0),
+    ],
+    "uploads": [
+        ("login_storm", "login_storm", None),
+        ("uploads", {"submit": 40, "get_upload": 60}, 1.0),
+    ],
+    # slow-clients: polling while a third of the clients trickle voice notes in at
+    # SLOW_UPLOAD_BPS; used by bench.capacity to find how many clients a container serves.
+    "slow-clients": [
+        ("login_storm", "login_storm", None),
+        ("slow-clients", {"my_workorders": 70, "slow_upload": 30}, 1.0),
+    ],
+}
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}  # endpoint -> [seconds]
+        self.statuses = {}  # endpoint -> {status: n}
+
+    def add(self, endpoint, status, seconds):
+        with self.lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+            st = self.statuses.setdefault(endpoint, {})
+            st[status] = st.get(status, 0) + 1
+
+
+def _pct(xs, q):
+    return xs[min(len(xs) - 1, int(len(xs) * q))] if xs else None
+
+
+def summarize(rec: Recorder, seconds: float) -> dict:
+    out = {}
+    for name, xs in rec.samples.items():
+        xs = sorted(xs)
+        statuses = rec.statuses.get(name, {})
+        errors = sum(n for st, n in statuses.items() if st >= 400 and st != 503)
+        out[name] = {
+            "count": len(xs),
+            "rps": round(len(xs) / seconds, 2) if seconds else None,
+            "p50_ms": round(_pct(xs, 0.50) * 1000, 2),
+            "p95_ms": round(_pct(xs, 0.95) * 1000, 2),
+            "p99_ms": round(_pct(xs, 0.99) * 1000, 2),
+            "errors": errors,
+            "rejected_503": statuses.get(503, 0),
+            "statuses": {str(k): v for k, v in sorted(statuses.items())},
+        }
+    return out
+
+
+def _multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for k, v in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode())
+    for k, filename, mime, data in files:
+        head = (f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"; filename="{filename}"\r\n'
+                f"Content-Type: {mime}\r\n\r\n")
+        parts.append(head.encode() + data + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def _throttled(data, bps, block=16 * 1024):
+    t0 = time.perf_counter()
+    for i in range(0, len(data), block):
+        delay = t0 + i / bps - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        yield data[i:i + block]
+
+
+class Client:
+    def __init__(self, host, port, manifest, rec: Recorder, tokens: dict, rng: random.Random, media: dict):
+        self.host, self.port = host, port
+        self.manifest = manifest
+        self.rec = rec
+        self.tokens = tokens
+        self.rng = rng
+        self.media = media
+        self.conn = None
+
+    def _request(self, endpoint, method, path, body=None, headers=None):
+        t0 = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=120)
+            self.conn.request(method, path, body=body, headers=headers or {})
+            resp = self.conn.getresponse()
+            data = resp.read()
+            status = resp.status
+            if resp.getheader("Connection", "").lower() == "close":
+                self.conn.close()
+                self.conn = None
+        except (OSError, http.client.HTTPException):
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = None
+            status, data = 599, b""
+        self.rec.add(endpoint, status, time.perf_counter() - t0)
+        return status, data
+
+    def _auth(self, user):
+        return {"Authorization": f"Bearer {self.tokens.get(user['id'], '')}"}
+
+    def login(self, user):
+        body = json.dumps({"username": user["username"], "password": self.manifest["password"],
+                           "device_id": user["device_id"]})
+        status, data = self._request("login", "POST", "/auth/login", body, {"Content-Type": "application/json"})
+        if status == 200:
+            self.tokens[user["id"]] = json.loads(data)["access_token"]
+
+    def my_workorders(self, user):
+        self._request("my_workorders", "GET", "/mobile/my-workorders?" + urlencode({"limit": 100}), None, self._auth(user))
+
+    def achievement(self, user):
+        self._request("achievement", "GET", "/mobile/achievement", None, self._auth(user))
+
+    def get_upload(self, user):
+        if user["media"]:
+            self._request("get_upload", "GET", self.rng.choice(user["media"]), None, self._auth(user))
+
+    # 3 photos + 1 voice note, as the app sends a finished job.
+    def submit(self, user):
+        if not user["active_wo_ids"]:
+            return
+        wo_id = self.rng.choice(user["active_wo_ids"])
+        files = [("images", f"photo_{i}.jpg", "image/jpeg", self.rng.choice(self.media["image"])) for i in range(3)]
+        files.append(("voice", "voice.m4a", "audio/mp4", self.rng.choice(self.media["voice"])))
+        body, ctype = _multipart({"note": "bench submit", "status": "IN_PROGRESS"}, files)
+        self._request("submit", "POST", f"/mobile/workorders/{wo_id}/submit", body,
+                      {**self._auth(user), "Content-Type": ctype})
+
+    # Resumable upload of one voice note, sent as a single chunk at SLOW_UPLOAD_BPS: the
+    # PUT keeps its connection (and, under gunicorn, a server thread) busy for seconds.
+    def slow_upload(self, user):
+        data = self.rng.choice(self.media["voice"])
+        body = json.dumps({"kind": "voice", "filename": "voice.m4a", "size": len(data), "mime": "audio/mp4"})
+        status, out = self._request("open_upload", "POST", "/mobile/uploads", body,
+                                    {**self._auth(user), "Content-Type": "application/json"})
+        if status != 201:
+            return
+        upload_id = json.loads(out)["upload_id"]
+        self._request("put_chunk", "PUT", f"/mobile/uploads/{upload_id}", _throttled(data, SLOW_UPLOAD_BPS), {
+            **self._auth(user),
+            "Content-Range": f"bytes 0-{len(data) - 1}/{len(data)}",
+            "Content-Length": str(len(data)),
+        })
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+def _load_media(manifest):
+    return {kind: [Path(p).read_bytes() for p in paths] for kind, paths in manifest["media"].items()}
+
+
+def run_phase(host, port, manifest, tokens, weights, seconds, concurrency, seed):
+    rec = Recorder()
+    users = manifest["users"]
+    media = _load_media(manifest)
+    stop_at = time.monotonic() + seconds if seconds else None
+    storm = iter(users) if weights == "login_storm" else None
+    storm_lock = threading.Lock()
+    if weights != "login_storm":
+        names = list(weights)
+        cum = [sum(weights[n] for n in names[:i + 1]) for i in range(len(names))]
+
+    def worker(idx):
+        rng = random.Random(seed * 1000 + idx)
+        client = Client(host, port, manifest, rec, tokens, rng, media)
+        try:
+            while True:
+                if storm is not None:
+                    with storm_lock:
+                        user = next(storm, None)
+                    if user is None:
+                        return
+                    client.login(user)
+                    continue
+                if time.monotonic() >= stop_at:
+                    return
+                user = rng.choice(users)
+                pick = rng.uniform(0, cum[-1])
+                name = next(n for n, c in zip(names, cum) if pick <= c)
+                getattr(client, name)(user)
+        finally:
+            client.close()
+
+    t0 = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - t0
+    return {"seconds": round(elapsed, 2), "endpoints": summarize(rec, elapsed)}
+
+
+# Runs every phase of a mix; `duration` scales the timed phases. mongo_ops() returns
+# {route: (commands, requests)} totals from the server (see bench.run.scrape_mongo_ops).
+def run_mix(host, port, manifest, mix, duration, concurrency, seed=1, mongo_ops=None):
+    tokens = {}
+    phases = {}
+    for name, weights, share in MIXES[mix]:
+        seconds = duration * share if share else None
+        before = mongo_ops() if mongo_ops else {}
+        phase = run_phase(host, port, manifest, tokens, weights, seconds, concurrency, seed)
+        after = mongo_ops() if mongo_ops else {}
+        for endpoint, res in phase["endpoints"].items():
+            route = ENDPOINTS[endpoint][1]
+            cmds = after.get(route, (0, 0))[0] - before.get(route, (0, 0))[0]
+            reqs = after.get(route, (0, 0))[1] - before.get(route, (0, 0))[1]
+            res["mongo_ops"] = round(cmds / reqs, 2) if mongo_ops and reqs else None
+        phases[name] = phase
+    return phases
@@ -0,0 +1,256 @@
+import os
+import re
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import subprocess
+import urllib.request
+from contextlib import contextmanager
+from pathlib import Path
+
+from bench import load
+
+# Benchmark driver: seeds a corpus, starts the real app under gunicorn (or uvicorn, the
+# ASGI mode), replays a traffic mix, reports p50/p95/p99, requests/s and MongoDB commands
+# per request for each endpoint, and compares the result with a stored baseline (exit 1 on
+# regression, 2 when there is no baseline and --save-baseline was not given).
+#
+#   python -m bench.run --mongo-uri mongodb://127.0.0.1:27017 --db fabrix_bench --save-baseline
+#   python -m bench.run --mongo-uri mongodb://127.0.0.1:27017 --db fabrix_bench
+#   python -m bench.run --standin          # no mongod: in-process stand-in, one worker
+#   python -m bench.run --server uvicorn   # asgi:app; see bench.capacity for a side-by-side run
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_BASELINE = ROOT / "bench" / "baseline.json"
+
+_MONGO_LINE = re.compile(r'^fabrix_http_request_mongo_commands_(sum|count)\{route="([^"]*)"\} (\S+)$')
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _get(url, headers=None, timeout=5):
+    req = urllib.request.Request(url, headers=headers or {})
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return resp.status, resp.read()
+
+
+def _wait_healthy(base, proc, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        try:
+            if _get(base + "/")[0] == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError("server did not become healthy")
+
+
+# {route: (mongo commands, requests)} summed over all workers.
+def scrape_mongo_ops(base):
+    headers = {}
+    if os.getenv("METRICS_TOKEN"):
+        headers["Authorization"] = f"Bearer {os.environ['METRICS_TOKEN']}"
+    _, body = _get(base + "/metrics", headers)
+    out = {}
+    for line in body.decode().splitlines():
+        m = _MONGO_LINE.match(line)
+        if m:
+            kind, route, value = m.groups()
+            cmds, reqs = out.get(route, (0.0, 0.0))
+            out[route] = (cmds + float(value), reqs) if kind == "sum" else (cmds, reqs + float(value))
+    return out
+
+
+def seed_mongo(args, work: Path):
+    from pymongo import MongoClient
+    from blobstore import BlobStore
+    from indexes import ensure_indexes
+    from bench import corpus
+
+    if "bench" not in args.db and not args.force:
+        raise SystemExit(f"refusing to wipe database {args.db!r}: its name must contain 'bench' (or pass --force)")
+    db = MongoClient(args.mongo_uri)[args.db]
+    ensure_indexes(db)
+    manifest = corpus.seed(db, BlobStore.from_env(db["blobs"]), work / "media", users=args.users,
+                           workorders_per_user=args.workorders_per_user, seed=args.seed)
+    (work / "manifest.json").write_text(json.dumps(manifest))
+    return manifest
+
+
+# Regressions of `current` against `baseline` (both results of this script).
+def compare(current, baseline, tolerance, min_ms):
+    problems = []
+    for phase, base_phase in baseline["phases"].items():
+        cur_phase = current["phases"].get(phase)
+        if not cur_phase:
+            problems.append(f"{phase}: phase missing")
+            continue
+        for ep, b in base_phase["endpoints"].items():
+            c = cur_phase["endpoints"].get(ep)
+            if not c:
+                problems.append(f"{phase}/{ep}: no requests")
+                continue
+            for key in ("p50_ms", "p95_ms", "p99_ms"):
+                if c[key] > b[key] * (1 + tolerance) and c[key] - b[key] > min_ms:
+                    problems.append(f"{phase}/{ep}: {key} {c[key]} > {b[key]} (+{tolerance:.0%})")
+            if b["rps"] and c["rps"] < b["rps"] * (1 - tolerance):
+                problems.append(f"{phase}/{ep}: rps {c['rps']} < {b['rps']} (-{tolerance:.0%})")
+            if b.get("mongo_ops") is not None and c.get("mongo_ops") is not None and c["mongo_ops"] > b["mongo_ops"] + 0.5:
+                problems.append(f"{phase}/{ep}: mongo ops/request {c['mongo_ops']} > {b['mongo_ops']}")
+            if c["errors"] > max(1, c["count"] * 0.01):
+                problems.append(f"{phase}/{ep}: {c['errors']} errors")
+    return problems
+
+
+def _print(result):
+    print(f"{'phase':12} {'endpoint':14} {'count':>7} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'mongo/req':>9} {'err':>5} {'503':>5}")
+    for phase, res in result["phases"].items():
+        for ep, r in sorted(res["endpoints"].items()):
+            ops = "-" if r.get("mongo_ops") is None else r["mongo_ops"]
+            print(f"{phase:12} {ep:14} {r['count']:>7} {r['rps']:>8} {r['p50_ms']:>8} {r['p95_ms']:>8} "
+                  f"{r['p99_ms']:>8} {ops:>9} {r['errors']:>5} {r['rejected_503']:>5}")
+
+
+# Options shared with bench.capacity: corpus, server and client settings.
+def add_server_args(p):
+    p.add_argument("--mongo-uri", default=os.getenv("BENCH_MONGO_URI", "mongodb://127.0.0.1:27017"))
+    p.add_argument("--db", default="fabrix_bench")
+    p.add_argument("--force", action="store_true", help="allow seeding a database whose name lacks 'bench'")
+    p.add_argument("--standin", action="store_true", help="in-process MongoDB stand-in (needs mongomock), 1 worker")
+    p.add_argument("--skip-seed", action="store_true", help="reuse the corpus and manifest of the previous run")
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--workorders-per-user", type=int, default=40)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--workers", type=int, default=3, help="server worker processes")
+    p.add_argument("--threads", type=int, default=8,
+                   help="gunicorn threads per worker; under uvicorn, the threads of the Flask bridge")
+    p.add_argument("--workdir", default=str(ROOT / "bench" / ".work"))
+
+
+# gunicorn runs app:app on gthread workers; uvicorn runs asgi:app (native async routes,
+# the rest through a bridge with the same number of threads).
+def _server_cmd(server, standin, workers, threads, port):
+    if server == "uvicorn":
+        module = "bench.standin_asgi:app" if standin else "asgi:app"
+        return [sys.executable, "-m", "uvicorn", "--workers", str(workers), "--host", "127.0.0.1", "--port", str(port),
+                "--no-access-log", "--log-level", "warning", module]
+    module = "bench.standin:app" if standin else "app:app"
+    return [sys.executable, "-m", "gunicorn", "-w", str(workers), "-k", "gthread", "--threads", str(threads),
+            "-b", f"127.0.0.1:{port}", "--timeout", "120", module]
+
+
+# Seeds the corpus (unless --skip-seed or skip_seed) and runs the server until the block
+# exits. Yields (port, workers, manifest).
+@contextmanager
+def serve(args, server, work: Path, skip_seed=False):
+    metrics_dir = work / "metrics"
+    metrics_dir.mkdir(exist_ok=True)
+    for f in metrics_dir.iterdir():
+        f.unlink()
+    port = _free_port()
+    env = {
+        **os.environ,
+        "UPLOAD_ROOT": str(work / "uploads"),
+        "STORAGE_BACKEND": "local",
+        "METRICS_ENABLED": "1",
+        "METRICS_DIR": str(metrics_dir),
+        "MONGO_URI": args.mongo_uri,
+        "MONGO_DB": args.db,
+        "ASGI_WSGI_THREADS": str(args.threads),
+    }
+    os.environ["UPLOAD_ROOT"] = env["UPLOAD_ROOT"]
+
+    workers = args.workers
+    if args.standin:
+        workers = 1
+        (work / "manifest.json").unlink(missing_ok=True)
+        env.update(BENCH_MEDIA_DIR=str(work / "media"), BENCH_MANIFEST=str(work / "manifest.json"),
+                   BENCH_USERS=str(args.users), BENCH_WORKORDERS_PER_USER=str(args.workorders_per_user),
+                   BENCH_SEED=str(args.seed), MONGO_URI="mongodb://standin")
+    elif not (args.skip_seed or skip_seed):
+        print(f"seeding {args.users} users x {args.workorders_per_user} workorders into {args.db} ...")
+        seed_mongo(args, work)
+
+    cmd = _server_cmd(server, args.standin, workers, args.threads, port)
+    with open(work / f"{server}.log", "w") as log_file:
+        proc = subprocess.Popen(cmd, cwd=str(ROOT), env=env, stdout=log_file, stderr=subprocess.STDOUT)
+        try:
+            _wait_healthy(f"http://127.0.0.1:{port}", proc, timeout=600 if args.standin else 60)
+            yield port, workers, json.loads((work / "manifest.json").read_text())
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(prog="python -m bench.run", description="FabriX mobile backend benchmark")
+    add_server_args(p)
+    p.add_argument("--server", choices=("gunicorn", "uvicorn"), default="gunicorn")
+    p.add_argument("--mix", choices=sorted(load.MIXES), default="shift-start")
+    p.add_argument("--duration", type=float, default=60, help="seconds of timed traffic per run")
+    p.add_argument("--concurrency", type=int, default=32, help="client threads")
+    p.add_argument("--out", help="write the result JSON here")
+    p.add_argument("--baseline", default=str(DEFAULT_BASELINE))
+    p.add_argument("--save-baseline", action="store_true", help="store this result as the baseline")
+    p.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    p.add_argument("--min-ms", type=float, default=5.0, help="ignore latency regressions smaller than this")
+    args = p.parse_args(argv)
+    # A gate that passes without a baseline would never catch anything.
+    if not args.save_baseline and not Path(args.baseline).exists():
+        p.error(f"no baseline at {args.baseline} (run with --save-baseline to create one)")
+
+    work = Path(args.workdir).resolve()
+    work.mkdir(parents=True, exist_ok=True)
+    with serve(args, args.server, work) as (port, workers, manifest):
+        base = f"http://127.0.0.1:{port}"
+        print(f"running mix {args.mix} for {args.duration:.0f}s, {args.concurrency} clients, "
+              f"{args.server} {workers}x{args.threads} ...")
+        phases = load.run_mix("127.0.0.1", port, manifest, args.mix, args.duration, args.concurrency,
+                              seed=args.seed, mongo_ops=lambda: scrape_mongo_ops(base))
+
+    result = {
+        "config": {
+            "server": args.server, "mix": args.mix, "duration": args.duration, "concurrency": args.concurrency, "workers": workers,
+            "threads": args.threads, "users": args.users, "workorders_per_user": args.workorders_per_user,
+            "seed": args.seed, "standin": args.standin, "python": platform.python_version(),
+            "machine": platform.node(),
+        },
+        "corpus": {k: manifest[k] for k in ("workorders", "work_updates", "history")},
+        "phases": phases,
+    }
+    _print(result)
+    if args.out:
+        Path(args.out).write_text(json.dumps(result, indent=2))
+
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(result, indent=2))
+        print(f"baseline saved to {baseline_path}")
+        return 0
+    baseline = json.loads(baseline_path.read_text())
+    if baseline["config"] != result["config"]:
+        print("warning: baseline was recorded with a different configuration")
+    problems = compare(result, baseline, args.tolerance, args.min_ms)
+    for line in problems:
+        print(f"REGRESSION {line}")
+    if not problems:
+        print("no regressions against the baseline")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,28 @@
+import os
+import json
+from pathlib import Path
+
+import mongomock
+
+import db as dbmod
+
+# In-process MongoDB stand-in for running the benchmark without a mongod:
+#   gunicorn -w 1 bench.standin:app   (started by `python -m bench.run --standin`)
+# The data lives in this one process, so there is a single worker; it seeds the corpus
+# at import and writes the manifest to BENCH_MANIFEST. Numbers measure the application
+# code, not MongoDB (mongomock emits no command events, so Mongo ops read 0).
+dbmod.MongoClient = mongomock.MongoClient
+
+from app import app, db, blob_store  # noqa: E402
+from bench import corpus  # noqa: E402
+
+_manifest = corpus.seed(
+    db,
+    blob_store,
+    Path(os.environ["BENCH_MEDIA_DIR"]),
+    users=int(os.getenv("BENCH_USERS", "100")),
+    workorders_per_user=int(os.getenv("BENCH_WORKORDERS_PER_USER", "40")),
+    seed=int(os.getenv("BENCH_SEED", "1")),
+)
+with open(os.environ["BENCH_MANIFEST"], "w") as f:
+    json.dump(_manifest, f)
@@ -0,0 +1,9 @@
+import db as dbmod
+from bench import standin  # noqa: F401  (seeds the corpus)
+from mongomock_motor import AsyncMongoMockClient
+
+# bench.standin for the ASGI mode (`python -m bench.run --standin --server uvicorn`):
+# Motor reads and writes the same in-memory data as the stand-in MongoClient.
+dbmod.AsyncIOMotorClient = lambda *args, **kwargs: AsyncMongoMockClient(mock_mongo_client=dbmod.get_client())
+
+from asgi import app  # noqa: E402
@@ -0,0 +1,223 @@
+import os
+import time
+import hashlib
+import tempfile
+from pathlib import Path
+from datetime import timedelta
+
+from flask import Response, request
+from pymongo.errors import DuplicateKeyError
+
+import storage
+from util import utcnow, naive_utc
+
+_COPY_BUF = 256 * 1024
+# gc marks a blob {deleting: <at>} while it removes the file; add_refs waits for it to
+# finish, and takes over a mark this old (a gc run that died half-way).
+_CLAIM_SECONDS = 30
+
+# Content-addressed upload store. Files are keyed by their sha256 and sharded as
+# <aa>/<bb>/<sha256> in the storage backend (storage.py); the blobs collection ({_id: sha256, size, mime, refs})
+# counts how many work_updates entries point at each file. Identical retries and
+# re-shared photos are stored once. Unreferenced blobs are removed by
+# `python manage.py gc-blobs`.
+#
+# A reference is taken before the file is written (or found already stored) and released
+# if the update that needed it is not stored, so gc never removes a file a submit is about
+# to point at.
+
+
+class BlobStore:
+    def __init__(self, storage, blobs, tmp: Path):
+        self.storage = storage
+        self.blobs = blobs
+        self.tmp = Path(tmp)
+        self.tmp.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, blobs):
+        upload_root = Path(os.getenv("UPLOAD_ROOT", "./uploads")).resolve()
+        # Temp files sit next to the local blobs so the final rename stays on one filesystem.
+        return cls(storage.from_env(upload_root / "blobs"), blobs, upload_root / "blobs" / "_tmp")
+
+    @staticmethod
+    def key(sha256: str) -> str:
+        return f"{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+    def exists(self, sha256: str) -> bool:
+        return self.storage.exists(self.key(sha256))
+
+    # Strong ETag = sha256. A client revalidating a blob it already has gets a 304 before
+    # any file or object-store access.
+    def response(self, sha256: str, mime: str, download_name: str):
+        if request.if_none_match.contains(sha256):
+            resp = Response(status=304)
+            resp.set_etag(sha256)
+            resp.headers["Cache-Control"] = storage.IMMUTABLE
+            return resp
+        return self.storage.response(self.key(sha256), mime, download_name, sha256)
+
+    # Streams fileobj into the store while hashing it. Returns (sha256, size); the caller
+    # holds one reference to the blob.
+    def put_stream(self, fileobj, mime=None):
+        h = hashlib.sha256()
+        size = 0
+        fd, tmp_name = tempfile.mkstemp(dir=self.tmp)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                for block in iter(lambda: fileobj.read(_COPY_BUF), b""):
+                    h.update(block)
+                    out.write(block)
+                    size += len(block)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+        sha256 = h.hexdigest()
+        self.put_path(Path(tmp_name), sha256, size, mime)
+        return sha256, size
+
+    # Moves a hashed temp file into the store (dropped if the content is already there).
+    def put_path(self, tmp_path: Path, sha256: str, size: int, mime=None):
+        self.add_refs([{"sha256": sha256, "size": size, "mime": mime}])
+        try:
+            self.storage.put_path(tmp_path, self.key(sha256))
+        except BaseException:
+            self.release(sha256)
+            raise
+
+    # Adds an already hashed file (e.g. a finished chunked upload) without copying its bytes.
+    def put_file(self, src: Path, sha256: str, mime=None):
+        size = src.stat().st_size
+        self.add_refs([{"sha256": sha256, "size": size, "mime": mime}])
+        fd, tmp_name = tempfile.mkstemp(dir=self.tmp)
+        os.close(fd)
+        tmp_path = Path(tmp_name)
+        tmp_path.unlink()
+        try:
+            self.storage.put_copy(src, self.key(sha256), tmp_path)
+        except BaseException:
+            self.release(sha256)
+            raise
+        return sha256, size
+
+    def add_refs(self, metas):
+        for m in metas:
+            if not m or not m.get("sha256"):
+                continue
+            deadline = time.monotonic() + _CLAIM_SECONDS
+            while True:
+                now = utcnow()
+                try:
+                    self.blobs.update_one(
+                        {"_id": m["sha256"], "$or": [
+                            {"deleting": {"$exists": False}},
+                            {"deleting": {"$lt": now - timedelta(seconds=_CLAIM_SECONDS)}},
+                        ]},
+                        {
+                            "$inc": {"refs": 1},
+                            "$set": {"last_ref_at": now},
+                            "$unset": {"deleting": ""},
+                            "$setOnInsert": {"size": m.get("size"), "mime": m.get("mime"), "created_at": now},
+                        },
+                        upsert=True,
+                    )
+                    break
+                except DuplicateKeyError:
+                    # gc is removing this blob; the caller stores the file again afterwards.
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.05)
+
+    def release(self, sha256: str):
+        self.blobs.update_one({"_id": sha256}, {"$inc": {"refs": -1}, "$set": {"released_at": utcnow()}})
+
+    def release_all(self, metas):
+        for m in metas:
+            if m and m.get("sha256"):
+                self.release(m["sha256"])
+
+    # Deletes blobs with no references that are older than grace_seconds: counted-out
+    # documents and files on disk that never got a document (e.g. a failed submit).
+    # Each blob is claimed ({deleting}) before its file is removed; add_refs doesn't revive
+    # a claimed blob, and a blob referenced since it was read can't be claimed.
+    def gc(self, grace_seconds: int = 24 * 3600, dry_run: bool = False) -> dict:
+        report = {"unreferenced": 0, "orphan_files": 0, "bytes": 0}
+        cutoff = naive_utc(utcnow()).timestamp() - grace_seconds
+
+        for d in self.blobs.find({"refs": {"$lte": 0}}, {"released_at": 1, "created_at": 1, "last_ref_at": 1}):
+            at = naive_utc(d.get("released_at") or d.get("created_at"))
+            if at and at.timestamp() > cutoff:
+                continue
+            mark = utcnow()
+            if not dry_run and not self.blobs.find_one_and_update(
+                {"_id": d["_id"], "refs": {"$lte": 0}, "last_ref_at": d.get("last_ref_at")},
+                {"$set": {"deleting": mark}},
+            ):
+                continue
+            size = self.storage.size(self.key(d["_id"]))
+            if size is not None:
+                report["bytes"] += size
+                if not dry_run:
+                    self.storage.delete(self.key(d["_id"]))
+            if not dry_run:
+                self.blobs.delete_one({"_id": d["_id"], "deleting": mark})
+            report["unreferenced"] += 1
+
+        now = time.time()
+        for key, size, mtime in self.storage.list():
+            if mtime > now - grace_seconds:
+                continue
+            sha256 = key.rsplit("/", 1)[-1]
+            if dry_run:
+                if self.blobs.find_one({"_id": sha256}, {"_id": 1}):
+                    continue
+            else:
+                # The claim is a placeholder document; it fails if the blob has one.
+                mark = utcnow()
+                try:
+                    self.blobs.insert_one({"_id": sha256, "refs": 0, "deleting": mark})
+                except DuplicateKeyError:
+                    continue
+                self.storage.delete(key)
+                self.blobs.delete_one({"_id": sha256, "deleting": mark})
+            report["bytes"] += size
+            report["orphan_files"] += 1
+
+        for p in self.tmp.glob("*"):
+            if p.stat().st_mtime < now - grace_seconds and not dry_run:
+                p.unlink(missing_ok=True)
+        return report
+
+    # Recomputes refs from the work_updates stored on workorders (and their buckets),
+    # image derivatives included.
+    def recount(self, workorders, bucket_coll=None) -> int:
+        counts = {}
+
+        def _count(up):
+            for m in (up or {}).get("images") or []:
+                if (m or {}).get("sha256"):
+                    counts[m["sha256"]] = counts.get(m["sha256"], 0) + 1
+                for v in ((m or {}).get("variants") or {}).values():
+                    counts[v["sha256"]] = counts.get(v["sha256"], 0) + 1
+            v = (up or {}).get("voice") or {}
+            if v.get("sha256"):
+                counts[v["sha256"]] = counts.get(v["sha256"], 0) + 1
+
+        for d in workorders.find({"updates_bucketed": {"$ne": True}}, {"work_updates": 1}):
+            for up in d.get("work_updates") or []:
+                _count(up)
+        if bucket_coll is not None:
+            for b in bucket_coll.find({"kind": "work_updates"}, {"entries": 1}):
+                for up in b.get("entries") or []:
+                    _count(up)
+
+        changed = 0
+        for d in self.blobs.find({}, {"refs": 1}):
+            n = counts.pop(d["_id"], 0)
+            if d.get("refs") != n:
+                self.blobs.update_one({"_id": d["_id"]}, {"$set": {"refs": n, "released_at": utcnow()}})
+                changed += 1
+        for sha256, n in counts.items():
+            self.blobs.update_one({"_id": sha256}, {"$set": {"refs": n}, "$setOnInsert": {"created_at": utcnow()}}, upsert=True)
+            changed += 1
+        return changed
@@ -0,0 +1,162 @@
+import os
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from util import utcnow
+
+# Overflow storage for work_updates/history. When enabled, every new entry is also
+# written to a per-month bucket document in workorder_update_buckets, and the
+# workorder itself only keeps the most recent WO_INLINE_UPDATES entries plus counts
+# (work_updates_count, history_count). Workorders are migrated lazily on their first
+# write in bucket mode, or up front with `python manage.py backfill-buckets`.
+
+ENABLED = os.getenv("WO_UPDATE_BUCKETS", "0").strip() in ("1", "true", "True")
+INLINE_LIMIT = max(1, int(os.getenv("WO_INLINE_UPDATES", "20")))
+
+KINDS = ("work_updates", "history")
+
+
+def collection(workorders):
+    # Inherit the caller's read preference (see db.for_route).
+    return workorders.database.get_collection("workorder_update_buckets", read_preference=workorders.read_preference)
+
+
+def bucket_of(entry: dict) -> str:
+    at = (entry or {}).get("at")
+    if isinstance(at, datetime):
+        return at.strftime("%Y-%m")
+    if isinstance(at, str) and len(at) >= 7:
+        return at[:7]
+    return utcnow().strftime("%Y-%m")
+
+
+def push_ops(pushes: dict) -> dict:
+    if not ENABLED:
+        return {"$push": pushes}
+    return {
+        "$push": {k: {"$each": [e], "$slice": -INLINE_LIMIT} for k, e in pushes.items()},
+        "$inc": {f"{k}_count": 1 for k in pushes},
+    }
+
+
+def _bucket_ops(wo_id, kind, entries, op="$push"):
+    grouped = {}
+    for e in entries:
+        grouped.setdefault(bucket_of(e), []).append(e)
+    now = utcnow()
+    return [
+        UpdateOne(
+            {"_id": f"{wo_id}:{kind}:{b}"},
+            {
+                op: {"entries": {"$each": es}},
+                "$set": {"updated_at": now},
+                "$setOnInsert": {"wo_id": wo_id, "kind": kind, "bucket": b},
+            },
+            upsert=True,
+        )
+        for b, es in grouped.items()
+    ]
+
+
+# Runs after the inline push. $addToSet makes it safe to repeat with reconcile().
+def archive(workorders, wo_id, pushes: dict):
+    ops = []
+    for kind, entry in pushes.items():
+        ops.extend(_bucket_ops(wo_id, kind, [entry], op="$addToSet"))
+    if ops:
+        collection(workorders).bulk_write(ops, ordered=False)
+
+
+# Moves existing inline entries of wo_id into buckets and trims the inline arrays.
+# Returns True when this call migrated the workorder.
+def migrate(workorders, wo_id, attempts: int = 3) -> bool:
+    for _ in range(attempts):
+        d = workorders.find_one({"_id": wo_id}, {"updates_bucketed": 1, "work_updates": 1, "history": 1})
+        if not d or d.get("updates_bucketed"):
+            return False
+
+        guard = [{"_id": wo_id}, {"updates_bucketed": {"$ne": True}}]
+        ops = []
+        empty = []
+        for kind in KINDS:
+            entries = d.get(kind)
+            if entries is None:
+                # Missing or null: set to [] ($push would fail on null).
+                guard.append({kind: None})
+                empty.append(kind)
+                continue
+            guard.append({kind: {"$size": len(entries)}})
+            # $addToSet keeps a re-run after a lost race from duplicating entries.
+            ops.extend(_bucket_ops(wo_id, kind, entries, op="$addToSet"))
+        if ops:
+            collection(workorders).bulk_write(ops, ordered=False)
+
+        update = {
+            "$set": {
+                "updates_bucketed": True,
+                "work_updates_count": len(d.get("work_updates") or []),
+                "history_count": len(d.get("history") or []),
+                **{k: [] for k in empty},
+            },
+        }
+        trim = {k: {"$each": [], "$slice": -INLINE_LIMIT} for k in KINDS if k not in empty}
+        if trim:
+            update["$push"] = trim
+        res = workorders.update_one({"$and": guard}, update)
+        if res.modified_count:
+            return True
+    return False
+
+
+# Archives inline entries of a migrated workorder that are missing from its buckets (a
+# worker died between the inline push and archive()). Entries leave the inline window
+# after INLINE_LIMIT newer writes, so `manage.py backfill-buckets` runs this regularly.
+# Each inline entry is looked up in its own bucket by _id: work_updates by id
+# (derivatives may have changed the archived copy), history entries by value.
+# Returns the number of entries archived.
+def reconcile(workorders, wo_id) -> int:
+    d = workorders.find_one({"_id": wo_id, "updates_bucketed": True}, {k: 1 for k in KINDS})
+    if not d:
+        return 0
+    coll = collection(workorders)
+    ops, added = [], 0
+    for kind in KINDS:
+        missing = []
+        for e in d.get(kind) or []:
+            match = {"entries.id": e.get("id")} if kind == "work_updates" else {"entries": e}
+            if not coll.find_one({"_id": f"{wo_id}:{kind}:{bucket_of(e)}", **match}, {"_id": 1}):
+                missing.append(e)
+        ops.extend(_bucket_ops(wo_id, kind, missing, op="$addToSet"))
+        added += len(missing)
+    if ops:
+        coll.bulk_write(ops, ordered=False)
+    return added
+
+
+# Newest-first page of entries of one kind. `before` is (bucket, index) from a previous page.
+def read_page(workorders, wo_id, kind, limit: int, before=None):
+    filt = {"wo_id": wo_id, "kind": kind}
+    if before:
+        filt["bucket"] = {"$lte": before[0]}
+    out = []
+    next_before = None
+    for b in collection(workorders).find(filt, {"bucket": 1, "entries": 1}).sort("bucket", -1):
+        entries = b.get("entries") or []
+        end = len(entries)
+        if before and b["bucket"] == before[0]:
+            end = min(end, int(before[1]))
+        for i in range(end - 1, -1, -1):
+            if len(out) == limit:
+                next_before = [b["bucket"], i + 1]
+                return out, next_before
+            out.append(entries[i])
+    return out, next_before
+
+
+def find_update(workorders, wo_id, update_id):
+    b = collection(workorders).find_one(
+        {"wo_id": wo_id, "kind": "work_updates", "entries.id": update_id},
+        {"entries": {"$elemMatch": {"id": update_id}}},
+    )
+    return ((b or {}).get("entries") or [None])[0]
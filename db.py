@@ -1,10 +1,252 @@
 import os
-from pymongo import MongoClient
+import threading
+from pymongo import MongoClient, monitoring
+from pymongo.read_preferences import (
+    Nearest,
+    Primary,
+    PrimaryPreferred,
+    Secondary,
+    SecondaryPreferred,
+)
 
-def get_db():
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:  # only the ASGI mode (asgi.py, requirements-asgi.txt) needs Motor
+    AsyncIOMotorClient = None
+
+import metrics
+
+# The MongoClient is created lazily, once per process, on first use. gunicorn forks
+# its workers after importing app.py (or before, with --preload); a client created
+# before the fork must not be shared, so the owning pid is checked on every access.
+
+_READ_PREFS = {
+    "primary": Primary,
+    "primarypreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondarypreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+
+def _env_int(name, default=None):
+    v = os.getenv(name, "").strip()
+    if not v:
+        return default
+    return int(v)
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.open = 0
+            self.checked_out = 0
+            self.waiting = 0
+            self.max_waiting = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.checkout_timeouts = 0
+            self.pool_clears = 0
+
+    def _inc(self, **deltas):
+        with self._lock:
+            for k, v in deltas.items():
+                setattr(self, k, getattr(self, k) + v)
+            self.max_waiting = max(self.max_waiting, self.waiting)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._inc(pool_clears=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._inc(open=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._inc(open=-1)
+
+    def connection_check_out_started(self, event):
+        self._inc(waiting=1)
+
+    def connection_check_out_failed(self, event):
+        timeout = 1 if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT else 0
+        self._inc(waiting=-1, checkout_failures=1, checkout_timeouts=timeout)
+
+    def connection_checked_out(self, event):
+        self._inc(waiting=-1, checked_out=1, checkouts=1)
+
+    def connection_checked_in(self, event):
+        self._inc(checked_out=-1)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "max_pool_size": client_options().get("maxPoolSize"),
+                "open": self.open,
+                "checked_out": self.checked_out,
+                "waiting": self.waiting,
+                "max_waiting": self.max_waiting,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "checkout_timeouts": self.checkout_timeouts,
+                "pool_clears": self.pool_clears,
+            }
+
+
+pool_monitor = PoolMonitor()
+# Pool of the Motor client (ASGI mode), next to the pymongo one the bridged Flask routes use.
+async_pool_monitor = PoolMonitor()
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+
+
+def client_options() -> dict:
+    opts = {
+        "appname": os.getenv("MONGO_APP_NAME", "fabrix-mobile-backend"),
+        "maxPoolSize": _env_int("MONGO_MAX_POOL_SIZE", 32),
+        "minPoolSize": _env_int("MONGO_MIN_POOL_SIZE", 0),
+        "maxIdleTimeMS": _env_int("MONGO_MAX_IDLE_TIME_MS", 60000),
+        "waitQueueTimeoutMS": _env_int("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000),
+        "serverSelectionTimeoutMS": _env_int("MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000),
+        "connectTimeoutMS": _env_int("MONGO_CONNECT_TIMEOUT_MS", 10000),
+        "socketTimeoutMS": _env_int("MONGO_SOCKET_TIMEOUT_MS"),
+    }
+    # e.g. "zstd,snappy,zlib"; zstd needs `zstandard`, snappy needs `python-snappy`.
+    compressors = os.getenv("MONGO_COMPRESSORS", "").strip()
+    if compressors:
+        opts["compressors"] = compressors
+    return {k: v for k, v in opts.items() if v is not None}
+
+
+def get_client():
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    with _lock:
+        if _client is None or _client_pid != pid:
+            uri = os.getenv("MONGO_URI", "").strip()
+            if not uri:
+                raise RuntimeError("MONGO_URI missing. Set it in .env")
+            if _client_pid != pid:
+                pool_monitor.reset()
+            listeners = [pool_monitor] + ([metrics.command_listener] if metrics.ENABLED else [])
+            _client = MongoClient(uri, event_listeners=listeners, **client_options())
+            _client_pid = pid
+    return _client
+
+
+# Motor client for asgi.py's native routes: one per uvicorn worker, created lazily on the
+# event loop thread (Motor binds to the running loop), same options as get_client().
+_async_client = None
+_async_client_pid = None
+
+
+def get_async_client():
+    global _async_client, _async_client_pid
+    pid = os.getpid()
+    if _async_client is not None and _async_client_pid == pid:
+        return _async_client
+    if AsyncIOMotorClient is None:
+        raise RuntimeError("motor missing: pip install -r requirements-asgi.txt")
     uri = os.getenv("MONGO_URI", "").strip()
-    dbn = os.getenv("MONGO_DB", "fabrix").strip()
     if not uri:
         raise RuntimeError("MONGO_URI missing. Set it in .env")
-    client = MongoClient(uri)
-    return client[dbn]
+    if _async_client_pid != pid:
+        async_pool_monitor.reset()
+    listeners = [async_pool_monitor] + ([metrics.command_listener] if metrics.ENABLED else [])
+    _async_client = AsyncIOMotorClient(uri, event_listeners=listeners, **client_options())
+    _async_client_pid = pid
+    return _async_client
+
+
+def get_async_db():
+    return get_async_client()[_db_name()]
+
+
+def _db_name():
+    return os.getenv("MONGO_DB", "fabrix").strip()
+
+
+# Route name -> read preference, from MONGO_READ_PREFERENCES, e.g.
+# "achievement=secondaryPreferred,my_workorders=secondaryPreferred,team_stats=secondary".
+# Routes not listed (and every write) use the primary.
+def read_preference(route: str):
+    raw = os.getenv("MONGO_READ_PREFERENCES", "").strip()
+    for part in raw.split(","):
+        name, _, mode = part.partition("=")
+        if name.strip() == route and mode.strip():
+            cls = _READ_PREFS.get(mode.strip().lower())
+            if cls is None:
+                raise RuntimeError(f"Unknown read preference for {route}: {mode}")
+            return cls()
+    return None
+
+
+def for_route(coll, route: str):
+    pref = read_preference(route)
+    return coll.with_options(read_preference=pref) if pref is not None else coll
+
+
+class LazyCollection:
+    def __init__(self, name: str, options: dict = None):
+        self._name = name
+        self._options = options or {}
+        self._resolved = None
+        self._resolved_client = None
+
+    def _get(self):
+        client = get_client()
+        if self._resolved is None or self._resolved_client is not client:
+            coll = client[_db_name()][self._name]
+            if self._options:
+                coll = coll.with_options(**self._options)
+            self._resolved = coll
+            self._resolved_client = client
+        return self._resolved
+
+    def with_options(self, **options):
+        return LazyCollection(self._name, {**self._options, **options})
+
+    def __getattr__(self, item):
+        return getattr(self._get(), item)
+
+    def __getitem__(self, item):
+        return self._get()[item]
+
+
+class LazyDatabase:
+    def __init__(self):
+        self._collections = {}
+
+    def __getitem__(self, name):
+        coll = self._collections.get(name)
+        if coll is None:
+            coll = self._collections[name] = LazyCollection(name)
+        return coll
+
+    def __getattr__(self, item):
+        return getattr(get_client()[_db_name()], item)
+
+
+def get_db():
+    if not os.getenv("MONGO_URI", "").strip():
+        raise RuntimeError("MONGO_URI missing. Set it in .env")
+    return LazyDatabase()
@@ -0,0 +1,200 @@
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it originals are served for every variant.
+    Image = None
+
+import buckets
+
+log = logging.getLogger(__name__)
+
+# Image derivatives (thumbnails and previews) rendered off the request path. submit only
+# schedules the work; a per-worker thread pool fetches the original and hands the decode
+# and resize to a process pool (no GIL contention with request threads). Results are
+# stored in the blob store and recorded on the image metadata as
+#   images[i].variants = {"thumb": {sha256, mime, size, width, height}, "preview": {...}}
+# and on the original's blobs document, so the same photo is only rendered once.
+
+ENABLED = Image is not None and os.getenv("IMAGE_DERIVATIVES", "1").strip() in ("1", "true", "True")
+WORKERS = max(1, int(os.getenv("IMAGE_DERIVATIVE_WORKERS", "2")))
+# Images waiting or rendering per gunicorn worker; beyond this new ones are skipped
+# (`python manage.py derive-images` fills them in later).
+MAX_PENDING = int(os.getenv("IMAGE_DERIVATIVE_MAX_PENDING", "200"))
+TIMEOUT_SECONDS = int(os.getenv("IMAGE_DERIVATIVE_TIMEOUT_SECONDS", "60"))
+
+MIME = "image/webp"
+# name -> (longest side in px, WebP quality)
+VARIANTS = {
+    "thumb": (int(os.getenv("IMAGE_THUMB_PX", "320")), 70),
+    "preview": (int(os.getenv("IMAGE_PREVIEW_PX", "1280")), 80),
+}
+
+_lock = threading.Lock()
+_pid = None
+_procs = None
+_threads = None
+_stats = {"pending": 0, "done": 0, "reused": 0, "skipped": 0, "failed": 0, "pool_restarts": 0}
+
+
+# Runs in a worker process: returns [(name, tmp path, sha256, size, width, height)].
+def render(src: str, out_dir: str, variants: dict):
+    out = []
+    with Image.open(src) as im:
+        largest = max(px for px, _ in variants.values())
+        # JPEG: decode at a reduced scale straight away (much faster for 12 MP photos).
+        im.draft("RGB", (largest, largest))
+        im = ImageOps.exif_transpose(im)
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGB")
+        for name, (px, quality) in variants.items():
+            v = im.copy()
+            v.thumbnail((px, px), Image.LANCZOS)
+            fd, tmp = tempfile.mkstemp(dir=out_dir, suffix=".webp")
+            os.close(fd)
+            # No exif= argument: derivatives carry no EXIF (orientation is applied, GPS dropped).
+            v.save(tmp, "WEBP", quality=quality, method=4)
+            h = hashlib.sha256()
+            with open(tmp, "rb") as f:
+                for block in iter(lambda: f.read(256 * 1024), b""):
+                    h.update(block)
+            out.append((name, tmp, h.hexdigest(), os.path.getsize(tmp), v.width, v.height))
+    return out
+
+
+# Like db.get_client: pools are created lazily once per process, after gunicorn forks.
+def _pools():
+    global _pid, _procs, _threads
+    with _lock:
+        if _pid != os.getpid():
+            _procs = _new_procs()
+            _threads = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="derivatives")
+            _pid = os.getpid()
+        return _procs, _threads
+
+
+def _new_procs():
+    # spawn, not fork: forking a process that runs request threads can deadlock.
+    return ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+# A render process killed from outside (OOM on a huge photo) breaks the executor for good;
+# the first caller to see it swaps in a fresh one.
+def _replace_procs(broken):
+    global _procs
+    with _lock:
+        if _procs is broken:
+            _procs = _new_procs()
+            _stats["pool_restarts"] += 1
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _render(src, out_dir):
+    procs, _ = _pools()
+    try:
+        future = procs.submit(render, src, out_dir, VARIANTS)
+    except BrokenProcessPool:
+        _replace_procs(procs)
+        future = _pools()[0].submit(render, src, out_dir, VARIANTS)
+    # A process dying under this job fails it; the next submit replaces the pool.
+    return future.result(timeout=TIMEOUT_SECONDS)
+
+
+def _count(key, n=1):
+    with _lock:
+        _stats[key] += n
+
+
+def stats() -> dict:
+    with _lock:
+        return dict(_stats, enabled=ENABLED, workers=WORKERS)
+
+
+def record(workorders, wo_id, update_id, sha256, variants: dict):
+    filters = [{"u.id": update_id}, {"i.sha256": sha256}]
+    workorders.update_one(
+        {"_id": wo_id, "work_updates.id": update_id},
+        {"$set": {"work_updates.$[u].images.$[i].variants": variants}},
+        array_filters=filters,
+    )
+    buckets.collection(workorders).update_one(
+        {"wo_id": wo_id, "kind": "work_updates", "entries.id": update_id},
+        {"$set": {"entries.$[u].images.$[i].variants": variants}},
+        array_filters=filters,
+    )
+
+
+# Variants already rendered for sha256, with a reference taken on each; None (and no
+# references) if they have to be rendered.
+def _existing(blob_store, sha256):
+    doc = blob_store.blobs.find_one({"_id": sha256}, {"variants": 1}) or {}
+    variants = doc.get("variants") or {}
+    if not set(variants) >= set(VARIANTS):
+        return None
+    # Referenced first, so gc can't remove a file between the check and the reference.
+    blob_store.add_refs(variants.values())
+    if all(blob_store.exists(v["sha256"]) for v in variants.values()):
+        return variants
+    blob_store.release_all(variants.values())
+    return None
+
+
+# Renders (or reuses) the variants of one stored image and records them. Blocking.
+def derive(blob_store, workorders, wo_id, update_id, sha256) -> dict:
+    variants = _existing(blob_store, sha256)
+    if variants:
+        _count("reused")
+    else:
+        fd, tmp_name = tempfile.mkstemp(dir=blob_store.tmp)
+        os.close(fd)
+        tmp_src = Path(tmp_name)
+        try:
+            src = blob_store.storage.fetch(blob_store.key(sha256), tmp_src)
+            results = _render(str(src), str(blob_store.tmp))
+        finally:
+            tmp_src.unlink(missing_ok=True)
+        # One reference per image entry that points at the variants (as for originals).
+        variants = {}
+        for name, tmp, vsha, size, width, height in results:
+            blob_store.put_path(Path(tmp), vsha, size, MIME)
+            variants[name] = {"sha256": vsha, "mime": MIME, "size": size, "width": width, "height": height}
+        blob_store.blobs.update_one({"_id": sha256}, {"$set": {"variants": variants}})
+        _count("done")
+    record(workorders, wo_id, update_id, sha256, variants)
+    return variants
+
+
+def _run(blob_store, workorders, wo_id, update_id, sha256):
+    try:
+        derive(blob_store, workorders, wo_id, update_id, sha256)
+    except Exception:
+        _count("failed")
+        log.exception("image derivatives failed for %s/%s %s", wo_id, update_id, sha256)
+    finally:
+        _count("pending", -1)
+
+
+# Non-blocking: queues derivatives for the images of a just-saved update.
+def schedule(blob_store, workorders, wo_id, update_id, metas):
+    if not ENABLED:
+        return
+    shas = []
+    for m in metas or []:
+        if m and m.get("sha256") and (m.get("mime") or "").startswith("image/") and m["sha256"] not in shas:
+            shas.append(m["sha256"])
+    for sha256 in shas:
+        with _lock:
+            if _stats["pending"] >= MAX_PENDING:
+                _stats["skipped"] += 1
+                continue
+            _stats["pending"] += 1
+        _, threads = _pools()
+        threads.submit(_run, blob_store, workorders, wo_id, update_id, sha256)
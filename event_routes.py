@@ -0,0 +1,116 @@
+import os
+import queue
+import threading
+import time
+
+from flask import Response, jsonify, request, stream_with_context
+
+import events
+
+# Each open stream holds a gunicorn thread for its whole life, so streams are capped per
+# worker and closed after EVENTS_STREAM_SECONDS (EventSource reconnects with Last-Event-ID
+# and picks up where it left off; the token is re-checked on every reconnect). asgi.py
+# serves the same stream natively on asyncio, where an open stream is a coroutine; its cap
+# is EVENTS_ASYNC_MAX_STREAMS.
+MAX_STREAMS = int(os.getenv("EVENTS_MAX_STREAMS", "4"))
+ASYNC_MAX_STREAMS = int(os.getenv("EVENTS_ASYNC_MAX_STREAMS", "2000"))
+STREAM_SECONDS = int(os.getenv("EVENTS_STREAM_SECONDS", "300"))
+HEARTBEAT_SECONDS = int(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))
+RETRY_MS = int(os.getenv("EVENTS_RETRY_MS", "3000"))
+PING = ": ping\n\n"
+
+_lock = threading.Lock()
+_open = 0
+
+
+def acquire(limit=MAX_STREAMS) -> bool:
+    global _open
+    with _lock:
+        if _open >= limit:
+            return False
+        _open += 1
+        return True
+
+
+def release():
+    global _open
+    with _lock:
+        _open -= 1
+
+
+def open_streams() -> int:
+    with _lock:
+        return _open
+
+
+# The first chunks of a stream: reconnect delay, then what the client missed.
+def opening(missed):
+    out = [f"retry: {RETRY_MS}\n\n"]
+    if missed is None:
+        out.append(events.format_event(None, {"type": "resync", "reason": "unknown_last_event_id"}))
+    else:
+        out.extend(events.format_event(token, payload) for token, payload in missed)
+    return out
+
+
+# (chunk, last) for one queued event.
+def render(sub, item):
+    token, payload = item
+    if sub.lagged:
+        # Events were dropped for this client; it must catch up through /mobile/sync.
+        return events.format_event(None, {"type": "resync", "reason": "lagged"}), True
+    return events.format_event(token, payload), payload["type"] == "unavailable"
+
+
+def register_event_routes(app, workorders, require_auth_read):
+    def _is_admin(u):
+        return ((u or {}).get("role") or "") in ("SUPER_ADMIN", "ADMIN")
+
+    @app.get("/mobile/events")
+    @require_auth_read
+    def workorder_events():
+        u = request.user
+        # EventSource sends Last-Event-ID itself; the query form is for clients that cannot set headers.
+        last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or None
+
+        if not acquire():
+            resp = jsonify({"detail": "Too many open event streams, retry later"})
+            resp.headers["Retry-After"] = str(max(1, RETRY_MS // 1000))
+            return resp, 503
+        feed = events.get_feed(workorders)
+        try:
+            sub, missed = feed.subscribe(u.get("_id"), _is_admin(u), last_id)
+        except events.Unavailable as e:
+            release()
+            return jsonify({"detail": str(e)}), 503
+        except Exception:
+            release()
+            raise
+
+        def stream():
+            yield from opening(missed)
+            deadline = time.monotonic() + STREAM_SECONDS
+            while True:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return
+                item = sub.due()
+                if item is None:
+                    try:
+                        item = sub.queue.get(timeout=min(HEARTBEAT_SECONDS, left))
+                    except queue.Empty:
+                        yield PING
+                        continue
+                chunk, last = render(sub, item)
+                yield chunk
+                if last:
+                    return
+
+        resp = Response(stream_with_context(stream()), mimetype="text/event-stream")
+        resp.headers["Cache-Control"] = "no-cache"
+        # nginx: do not buffer the stream.
+        resp.headers["X-Accel-Buffering"] = "no"
+        # Runs when the server closes the response (stream ended or client gone), also if
+        # the generator never started.
+        resp.call_on_close(lambda: (feed.unsubscribe(sub), release()))
+        return resp
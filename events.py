@@ -0,0 +1,346 @@
+import os
+import json
+import queue
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+log = logging.getLogger(__name__)
+
+# Workorder change notifications for /mobile/events. Each worker process runs one change
+# stream on `workorders` (started by the first subscriber) and fans its events out to the
+# connected clients of that process, each of which only receives changes to workorders it
+# is (or was) assigned to. Events carry the change stream resume token as their SSE id and
+# the most recent ones are kept in a ring buffer, so a client reconnecting with
+# Last-Event-ID gets what it missed. An id this worker's buffer does not have (the client
+# was on another worker, or is further behind) is caught up with a short change stream of
+# its own resuming after that id; only when the oplog no longer covers it, or more than
+# EVENTS_BUFFER_SIZE events for it are missing, is the client told to `resync` (run /mobile/sync).
+#
+# Change streams need a replica set; a single-node one is enough (see docker-compose.yml).
+# Unassignments are reported precisely when pre-images are enabled on workorders
+# (`python manage.py enable-preimages`, MongoDB 6+); otherwise connected clients get a
+# resync hint for them, at most one per EVENTS_RESYNC_SECONDS per client.
+#
+# Subscribers are fed from the change stream thread: thread-per-stream servers (gunicorn)
+# read a queue.Queue, asyncio ones (asgi.py) an asyncio.Queue filled on their loop.
+
+BUFFER_SIZE = int(os.getenv("EVENTS_BUFFER_SIZE", "2000"))
+QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "200"))
+RESTART_SECONDS = float(os.getenv("EVENTS_RESTART_SECONDS", "2"))
+RESYNC_SECONDS = float(os.getenv("EVENTS_RESYNC_SECONDS", "30"))
+CATCHUP_SECONDS = float(os.getenv("EVENTS_CATCHUP_SECONDS", "5"))
+
+# Fields the stream looks at; everything else is projected away on the server.
+_FIELDS = ("_id", "assigned_team_ids", "status", "updated_at", "is_deleted", "wo_no")
+
+PIPELINE = [
+    {"$match": {
+        "operationType": {"$in": ["insert", "update", "replace", "delete"]},
+        "$or": [
+            {"operationType": "delete"},
+            {"fullDocument.assigned_team_ids.0": {"$exists": True}},
+            {"fullDocumentBeforeChange.assigned_team_ids.0": {"$exists": True}},
+            {"updateDescription.updatedFields.assigned_team_ids": {"$exists": True}},
+        ],
+    }},
+    {"$project": {
+        "operationType": 1,
+        "documentKey": 1,
+        **{f"fullDocument.{f}": 1 for f in _FIELDS},
+        "fullDocumentBeforeChange.assigned_team_ids": 1,
+        "updateDescription.updatedFields.assigned_team_ids": 1,
+    }},
+]
+
+
+class Unavailable(Exception):
+    pass
+
+
+_ASSIGNMENT_RESYNC = {"type": "resync", "reason": "assignment_changed"}
+
+
+class _Subscriber:
+    def __init__(self, uid, admin: bool, loop=None):
+        self.uid = uid
+        self.admin = admin
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE) if loop else queue.Queue(maxsize=QUEUE_SIZE)
+        self.lagged = False
+        self.lock = threading.Lock()
+        self.next_resync = 0.0
+        self.resync_due = False
+
+    def put(self, item):
+        if item[1] is _ASSIGNMENT_RESYNC:
+            # Coalesced: within RESYNC_SECONDS of the last one, due() sends it later.
+            with self.lock:
+                now = time.monotonic()
+                if now < self.next_resync:
+                    self.resync_due = True
+                    return
+                self.next_resync = now + RESYNC_SECONDS
+        if self.loop is None:
+            self._put_nowait(item)
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._put_nowait, item)
+        except RuntimeError:
+            pass  # loop closed; the stream is gone
+
+    def _put_nowait(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except (queue.Full, asyncio.QueueFull):
+            self.lagged = True
+
+    # The coalesced assignment resync, once its window has passed; the stream checks it
+    # on every wake-up (heartbeats included).
+    def due(self):
+        with self.lock:
+            now = time.monotonic()
+            if not self.resync_due or now < self.next_resync:
+                return None
+            self.resync_due = False
+            self.next_resync = now + RESYNC_SECONDS
+        return None, _ASSIGNMENT_RESYNC
+
+
+def _iso(v):
+    return v.isoformat() if hasattr(v, "isoformat") else v
+
+
+# (recipient uids or None for everyone, payload per recipient kind) for one change.
+def route(change: dict):
+    op = change.get("operationType")
+    wo_id = (change.get("documentKey") or {}).get("_id")
+    doc = change.get("fullDocument") or {}
+    before = change.get("fullDocumentBeforeChange")
+    after_uids = set(doc.get("assigned_team_ids") or [])
+    before_uids = set((before or {}).get("assigned_team_ids") or [])
+    deleted = op == "delete" or bool(doc.get("is_deleted"))
+
+    upsert = {
+        "type": "upsert",
+        "id": wo_id,
+        "wo_no": doc.get("wo_no"),
+        "status": doc.get("status"),
+        "updated_at": _iso(doc.get("updated_at")),
+    }
+    removed = {"type": "removed", "id": wo_id}
+
+    out = []
+    if not deleted and after_uids:
+        out.append((after_uids, upsert))
+    gone = (after_uids | before_uids) if deleted else (before_uids - after_uids)
+    if gone:
+        out.append((gone, removed))
+
+    assignees_changed = op in ("delete", "replace") or "assigned_team_ids" in (
+        (change.get("updateDescription") or {}).get("updatedFields") or {}
+    )
+    if before is None and assignees_changed:
+        # Without a pre-image nobody knows who was unassigned; let everyone else check.
+        out.append((None, _ASSIGNMENT_RESYNC))
+    return out
+
+
+class ChangeFeed:
+    def __init__(self, workorders):
+        self.workorders = workorders
+        self.lock = threading.Lock()
+        self.buffer = deque(maxlen=BUFFER_SIZE)  # (token, [(uids|None, payload)])
+        self.tokens = {}  # token -> position marker (count of events seen when buffered)
+        self.seen = 0
+        self.subscribers = set()
+        self.thread = None
+        self.error = None
+        self.resume_token = None
+        self.preimages = True
+        self.stats = {"events": 0, "restarts": 0, "history_lost": 0, "lagged": 0, "caught_up": 0, "catchup_failed": 0}
+
+    def start(self):
+        with self.lock:
+            if self.error:
+                raise Unavailable(self.error)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="workorder-change-stream", daemon=True)
+                self.thread.start()
+
+    def _watch(self, resume_after=None, **kwargs):
+        kwargs["full_document"] = "updateLookup"
+        if self.preimages:
+            kwargs["full_document_before_change"] = "whenAvailable"
+        if resume_after:
+            kwargs["resume_after"] = resume_after
+        return self.workorders.watch(PIPELINE, **kwargs)
+
+    def _run(self):
+        while True:
+            try:
+                with self._watch(self.resume_token) as stream:
+                    for change in stream:
+                        self._publish(change)
+            except OperationFailure as e:
+                # 40573: not a replica set. 286/280: resume point no longer in the oplog.
+                if e.code == 40573:
+                    with self.lock:
+                        self.error = "Change streams need a replica set"
+                    log.error("workorder change stream unavailable: %s", e)
+                    self._broadcast({"type": "unavailable"})
+                    return
+                if self.preimages and "fullDocumentBeforeChange" in str(e):
+                    # MongoDB < 6.0.
+                    self.preimages = False
+                    continue
+                if e.code in (280, 286) or "resume" in str(e).lower():
+                    self.resume_token = None
+                    self.stats["history_lost"] += 1
+                    self._broadcast({"type": "resync", "reason": "history_lost"})
+                log.warning("workorder change stream restarting: %s", e)
+            except PyMongoError as e:
+                log.warning("workorder change stream restarting: %s", e)
+            except Exception:
+                log.exception("workorder change stream failed")
+            self.stats["restarts"] += 1
+            time.sleep(RESTART_SECONDS)
+
+    def _publish(self, change):
+        token = (change.get("_id") or {}).get("_data")
+        routed = route(change)
+        with self.lock:
+            self.resume_token = change.get("_id")
+            self.seen += 1
+            self.stats["events"] += 1
+            if len(self.buffer) == self.buffer.maxlen:
+                self.tokens.pop(self.buffer[0][0], None)
+            self.buffer.append((token, routed))
+            self.tokens[token] = self.seen
+            for sub in self.subscribers:
+                for item in _for(sub, token, routed):
+                    sub.put(item)
+
+    def _broadcast(self, payload):
+        with self.lock:
+            for sub in self.subscribers:
+                sub.put((None, payload))
+
+    # Registers a subscriber and returns it with the events after last_id. missed is None
+    # when they cannot be recovered (the client must resync). Blocks while catching up.
+    # loop: the asyncio loop the subscriber reads on, if any.
+    def subscribe(self, uid, admin: bool, last_id: str = None, loop=None):
+        self.start()
+        sub = _Subscriber(uid, admin, loop)
+        missed = []
+        with self.lock:
+            known = not last_id or last_id in self.tokens
+            if last_id and known:
+                after = False
+                for token, routed in self.buffer:
+                    if after:
+                        missed.extend(_for(sub, token, routed))
+                    elif token == last_id:
+                        after = True
+            # Everything after upto reaches sub live.
+            upto = (self.resume_token or {}).get("_data")
+            self.subscribers.add(sub)
+        if not known:
+            missed = self._catch_up(sub, last_id, upto)
+        return sub, _one_resync(missed)
+
+    # The events after last_id read back from the oplog, up to and including upto. With
+    # upto unknown (or a client ahead of this worker) it reads until the stream is idle, and
+    # the client may then get a few events twice; they are idempotent.
+    def _catch_up(self, sub, last_id, upto):
+        missed = []
+        deadline = time.monotonic() + CATCHUP_SECONDS
+        try:
+            with self._watch({"_data": last_id}, max_await_time_ms=200) as stream:
+                while time.monotonic() < deadline and len(missed) <= BUFFER_SIZE:
+                    change = stream.try_next()
+                    if change is None:
+                        break
+                    token = change["_id"]["_data"]
+                    missed.extend(_for(sub, token, route(change)))
+                    if token == upto:
+                        break
+                else:
+                    missed = None
+        except OperationFailure as e:
+            # 280/286: no longer in the oplog; others: not a resume token at all.
+            log.info("events catch-up from %s failed: %s", last_id, e)
+            missed = None
+        except PyMongoError as e:
+            log.warning("events catch-up from %s failed: %s", last_id, e)
+            missed = None
+        with self.lock:
+            self.stats["caught_up" if missed is not None else "catchup_failed"] += 1
+        return missed
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers.discard(sub)
+            if sub.lagged:
+                self.stats["lagged"] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                **self.stats,
+                "running": bool(self.thread and self.thread.is_alive()),
+                "error": self.error,
+                "subscribers": len(self.subscribers),
+                "buffered": len(self.buffer),
+            }
+
+
+# One assignment resync covers all of them.
+def _one_resync(missed):
+    if missed:
+        resyncs = [i for i, (_, p) in enumerate(missed) if p is _ASSIGNMENT_RESYNC]
+        for i in reversed(resyncs[:-1]):
+            del missed[i]
+    return missed
+
+
+def _for(sub, token, routed):
+    out = []
+    for uids, payload in routed:
+        if uids is None or sub.admin or sub.uid in uids:
+            out.append((token, payload))
+    return out
+
+
+def format_event(token, payload) -> str:
+    lines = []
+    if token:
+        lines.append(f"id: {token}")
+    lines.append(f"event: {payload['type']}")
+    lines.append("data: " + json.dumps(payload, separators=(",", ":")))
+    return "\n".join(lines) + "\n\n"
+
+
+_feed = None
+_feed_pid = None
+_feed_lock = threading.Lock()
+
+
+# One feed per worker process, created after gunicorn forks (like db.get_client).
+def get_feed(workorders) -> ChangeFeed:
+    global _feed, _feed_pid
+    with _feed_lock:
+        if _feed is None or _feed_pid != os.getpid():
+            _feed = ChangeFeed(workorders)
+            _feed_pid = os.getpid()
+        return _feed
+
+
+def stats() -> dict:
+    with _feed_lock:
+        feed = _feed if _feed_pid == os.getpid() else None
+    return feed.snapshot() if feed else {"running": False, "subscribers": 0}
@@ -0,0 +1,102 @@
+import os
+
+# Workorders carry `location: {lat, lng, label}` (written by the desktop backend). For
+# server-side distance queries the same point is mirrored as GeoJSON in `geo`
+#   geo = {"type": "Point", "coordinates": [lng, lat]}
+# which is what the 2dsphere index (indexes.py: mobile_assigned_geo) covers. `geo` is
+# derived data: `python manage.py backfill-geo` (re)computes it for every workorder whose
+# location changed, and removes it when the location is missing or invalid.
+
+FIELD = "geo"
+NEAR_RADIUS_M = int(os.getenv("MOBILE_NEAR_RADIUS_M", "50000"))
+NEAR_MAX_RADIUS_M = int(os.getenv("MOBILE_NEAR_MAX_RADIUS_M", "500000"))
+
+
+def _valid(lat, lng) -> bool:
+    return -90 <= lat <= 90 and -180 <= lng <= 180 and (lat, lng) != (0, 0)
+
+
+# (lat, lng) of a location dict, or None when it is missing or not a usable point.
+def point(location):
+    try:
+        lat, lng = float(location["lat"]), float(location["lng"])
+    except (TypeError, KeyError, ValueError):
+        return None
+    return (lat, lng) if _valid(lat, lng) else None
+
+
+# (lat, lng) of a workorder: the indexed `geo` field, else its `location`.
+def doc_point(d):
+    coords = ((d or {}).get(FIELD) or {}).get("coordinates")
+    if coords and len(coords) == 2:
+        return float(coords[1]), float(coords[0])
+    return point((d or {}).get("location"))
+
+
+# "lat,lng" query parameter.
+def parse_point(raw):
+    try:
+        lat, lng = (float(x) for x in raw.split(","))
+    except (AttributeError, ValueError):
+        raise ValueError("Expected lat,lng")
+    if not _valid(lat, lng):
+        raise ValueError("lat,lng out of range")
+    return lat, lng
+
+
+def parse_radius(raw):
+    if not raw:
+        return NEAR_RADIUS_M
+    try:
+        r = float(raw)
+    except ValueError:
+        raise ValueError("Invalid radius")
+    if r <= 0:
+        raise ValueError("Invalid radius")
+    return min(r, NEAR_MAX_RADIUS_M)
+
+
+def geo_near(lat, lng, radius_m, query, limit, projection):
+    return [
+        {"$geoNear": {
+            "near": {"type": "Point", "coordinates": [lng, lat]},
+            "key": FIELD,
+            "distanceField": "distance_m",
+            "maxDistance": radius_m,
+            "spherical": True,
+            "query": query,
+        }},
+        {"$limit": limit},
+        {"$project": {**projection, "distance_m": 1}},
+    ]
+
+
+def _num(path):
+    return {"$convert": {"input": path, "to": "double", "onError": None, "onNull": None}}
+
+
+_LAT = _num("$location.lat")
+_LNG = _num("$location.lng")
+# Server-side version of _valid() (lat/lng may be stored as strings).
+_VALID = {"$and": [
+    {"$ne": [_LAT, None]},
+    {"$ne": [_LNG, None]},
+    {"$gte": [_LAT, -90]}, {"$lte": [_LAT, 90]},
+    {"$gte": [_LNG, -180]}, {"$lte": [_LNG, 180]},
+    {"$not": [{"$and": [{"$eq": [_LAT, 0]}, {"$eq": [_LNG, 0]}]}]},
+]}
+
+
+# Brings `geo` in line with `location` on every workorder; safe to re-run (cron).
+# updated_at is left alone: this is not a change clients need to sync.
+def backfill(workorders) -> dict:
+    coords = [_LNG, _LAT]
+    set_res = workorders.update_many(
+        {"$expr": {"$and": [_VALID, {"$ne": [f"${FIELD}.coordinates", coords]}]}},
+        [{"$set": {FIELD: {"type": "Point", "coordinates": coords}}}],
+    )
+    unset_res = workorders.update_many(
+        {FIELD: {"$exists": True}, "$expr": {"$not": [_VALID]}},
+        {"$unset": {FIELD: ""}},
+    )
+    return {"set": set_res.modified_count, "removed": unset_res.modified_count}
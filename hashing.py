@@ -0,0 +1,216 @@
+import os
+import time
+import asyncio
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+from security import BCRYPT_ROUNDS, hash_password, verify_password, hash_rounds
+
+# bcrypt off the request threads. Each gunicorn worker owns a small process pool; at most
+# BCRYPT_QUEUE_MAX hash operations may be outstanding (running + queued) per worker, beyond
+# that callers get Saturated immediately and /auth/login answers 503 + Retry-After instead
+# of piling up behind a login burst while my-workorders traffic waits for a thread.
+# BCRYPT_WORKERS=0 runs bcrypt inline (still bounded by the queue limit).
+# The *_async variants (asgi.py) await the same pool from the event loop; with
+# BCRYPT_WORKERS=0 they run bcrypt on the loop's default thread pool.
+
+WORKERS = max(0, int(os.getenv("BCRYPT_WORKERS", "2")))
+QUEUE_MAX = max(1, int(os.getenv("BCRYPT_QUEUE_MAX", "32")))
+TIMEOUT_SECONDS = float(os.getenv("BCRYPT_TIMEOUT_SECONDS", "10"))
+RETRY_AFTER_SECONDS = int(os.getenv("BCRYPT_RETRY_AFTER_SECONDS", "2"))
+
+_SAMPLES = 1000
+
+
+class Saturated(Exception):
+    pass
+
+
+_lock = threading.Lock()
+_pid = None
+_pool = None
+_outstanding = 0
+_counts = {"verify": 0, "hash": 0, "rejected": 0, "timeouts": 0, "rehashed": 0, "pool_restarts": 0}
+_latency = {"wait": deque(maxlen=_SAMPLES), "hash": deque(maxlen=_SAMPLES)}
+
+
+# Runs in a pool process: (result, seconds spent hashing).
+def _timed(fn, *args):
+    t0 = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - t0
+
+
+# Like db.get_client: one pool per process, created after gunicorn forks.
+def _get_pool():
+    global _pid, _pool
+    with _lock:
+        if _pid != os.getpid():
+            _pool = _new_pool()
+            _pid = os.getpid()
+        return _pool
+
+
+def _new_pool():
+    # spawn, not fork: the worker already runs request threads.
+    return ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+# A pool process killed from outside (OOM killer) breaks the whole executor for good; the
+# first caller to see it swaps in a fresh one, later callers find it already replaced.
+def _replace_pool(broken):
+    global _pool
+    with _lock:
+        if _pool is broken:
+            _pool = _new_pool()
+            _counts["pool_restarts"] += 1
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _enter():
+    global _outstanding
+    with _lock:
+        if _outstanding >= QUEUE_MAX:
+            _counts["rejected"] += 1
+            raise Saturated()
+        _outstanding += 1
+
+
+def _leave():
+    global _outstanding
+    with _lock:
+        _outstanding -= 1
+
+
+def _timed_out():
+    with _lock:
+        _counts["timeouts"] += 1
+    return Saturated()
+
+
+def _done(kind, t0, spent):
+    with _lock:
+        _counts[kind] += 1
+        _latency["hash"].append(spent)
+        _latency["wait"].append(max(0.0, time.perf_counter() - t0 - spent))
+
+
+# Pool job holding an admission slot. The slot is freed when the job ends (or is cancelled
+# while still queued), not when a caller stops waiting for it: a job that outlives
+# TIMEOUT_SECONDS still occupies a pool process.
+def _submit(fn, *args):
+    try:
+        pool = _get_pool()
+        try:
+            future = pool.submit(_timed, fn, *args)
+        except BrokenProcessPool:
+            _replace_pool(pool)
+            future = _get_pool().submit(_timed, fn, *args)
+    except BaseException:
+        _leave()
+        raise
+    future.add_done_callback(lambda _: _leave())
+    return future
+
+
+# Inline job on a thread the caller may stop waiting for; frees its own slot.
+def _timed_leave(fn, *args):
+    try:
+        return _timed(fn, *args)
+    finally:
+        _leave()
+
+
+def _run(kind, fn, *args):
+    _enter()
+    t0 = time.perf_counter()
+    if WORKERS:
+        future = _submit(fn, *args)
+        try:
+            out, spent = future.result(timeout=TIMEOUT_SECONDS)
+        except FutureTimeout:
+            future.cancel()
+            raise _timed_out()
+        except BrokenProcessPool:
+            # The process died under this job; the next _submit replaces the pool.
+            raise Saturated()
+    else:
+        out, spent = _timed_leave(fn, *args)
+    _done(kind, t0, spent)
+    return out
+
+
+async def _run_async(kind, fn, *args):
+    _enter()
+    t0 = time.perf_counter()
+    if WORKERS:
+        future = _submit(fn, *args)
+        try:
+            out, spent = await asyncio.wait_for(asyncio.wrap_future(future), TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise _timed_out()
+        except BrokenProcessPool:
+            raise Saturated()
+    else:
+        out, spent = await asyncio.get_running_loop().run_in_executor(None, _timed_leave, fn, *args)
+    _done(kind, t0, spent)
+    return out
+
+
+def verify(password: str, password_hash: str) -> bool:
+    # Wall time seen by the request, queue wait included.
+    with metrics.timed("verify_password"):
+        return _run("verify", verify_password, password, password_hash)
+
+
+def new_hash(password: str) -> str:
+    return _run("hash", hash_password, password, BCRYPT_ROUNDS)
+
+
+async def verify_async(password: str, password_hash: str) -> bool:
+    with metrics.timed("verify_password"):
+        return await _run_async("verify", verify_password, password, password_hash)
+
+
+async def new_hash_async(password: str) -> str:
+    return await _run_async("hash", hash_password, password, BCRYPT_ROUNDS)
+
+
+def needs_rehash(password_hash: str) -> bool:
+    rounds = hash_rounds(password_hash)
+    return rounds is not None and rounds != BCRYPT_ROUNDS
+
+
+def note_rehash():
+    with _lock:
+        _counts["rehashed"] += 1
+
+
+def _summary(samples):
+    if not samples:
+        return {"p50_ms": None, "p95_ms": None, "max_ms": None}
+    xs = sorted(samples)
+    return {
+        "p50_ms": round(xs[len(xs) // 2] * 1000, 1),
+        "p95_ms": round(xs[min(len(xs) - 1, int(len(xs) * 0.95))] * 1000, 1),
+        "max_ms": round(xs[-1] * 1000, 1),
+    }
+
+
+def stats() -> dict:
+    with _lock:
+        return {
+            **_counts,
+            "outstanding": _outstanding,
+            "queue_depth": max(0, _outstanding - WORKERS) if WORKERS else 0,
+            "queue_max": QUEUE_MAX,
+            "workers": WORKERS,
+            "rounds": BCRYPT_ROUNDS,
+            "hash_latency": _summary(list(_latency["hash"])),
+            "queue_wait": _summary(list(_latency["wait"])),
+        }
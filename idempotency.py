@@ -0,0 +1,95 @@
+import os
+import json
+import hashlib
+from datetime import timedelta
+
+from pymongo.errors import DuplicateKeyError
+
+from util import utcnow, naive_utc
+
+# Client idempotency keys (idempotency_keys collection, _id = "<user id>:<key>"). The first
+# request with a key records PENDING, runs, and stores its response; a retry with the same
+# key and the same request gets that stored response instead of running again. Entries
+# expire after IDEMPOTENCY_TTL_HOURS (TTL index). Retryable outcomes (409 conflicts, 5xx)
+# are not stored, so the client's retry runs the action again.
+
+TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "48"))
+# A PENDING entry older than this belongs to a request that died; a retry may take it over.
+PENDING_SECONDS = int(os.getenv("IDEMPOTENCY_PENDING_SECONDS", "120"))
+MAX_KEY_LENGTH = 128
+
+
+class IdempotencyError(Exception):
+    def __init__(self, detail: str, status_code: int):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code
+
+
+def fingerprint(request_data: dict) -> str:
+    raw = json.dumps(request_data, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# Stable id for what the keyed request creates (e.g. a work_updates entry), so a takeover
+# after a crash writes the same id and the duplicate guard in workflow.submit catches it.
+def derived_id(uid, key: str) -> str:
+    return hashlib.sha256(f"{uid}:{key}".encode("utf-8")).hexdigest()[:20]
+
+
+def check_key(key: str) -> str:
+    key = (key or "").strip()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise IdempotencyError(f"Idempotency key must be 1-{MAX_KEY_LENGTH} characters", 400)
+    return key
+
+
+# Returns the stored {"status_code", "body"} for a completed key, or None when the caller
+# now owns the key and must run the request and call finish().
+def begin(keys, uid, key: str, fp: str, attempts: int = 2):
+    now = utcnow()
+    _id = f"{uid}:{key}"
+    for _ in range(attempts):
+        try:
+            keys.insert_one({
+                "_id": _id,
+                "user_id": uid,
+                "fingerprint": fp,
+                "state": "PENDING",
+                "created_at": now,
+                "expires_at": now + timedelta(hours=TTL_HOURS),
+            })
+            return None
+        except DuplicateKeyError:
+            pass
+        d = keys.find_one({"_id": _id})
+        if d is None:
+            continue  # expired between the insert and the read
+        if d.get("fingerprint") != fp:
+            raise IdempotencyError("Idempotency key was already used for a different request", 422)
+        if d.get("state") == "DONE":
+            return d.get("result")
+        if naive_utc(d["created_at"]) < naive_utc(now) - timedelta(seconds=PENDING_SECONDS):
+            res = keys.update_one(
+                {"_id": _id, "state": "PENDING", "created_at": d["created_at"]},
+                {"$set": {"created_at": now}},
+            )
+            if res.modified_count:
+                return None
+        raise IdempotencyError("A request with this idempotency key is still in progress", 409)
+    raise IdempotencyError("A request with this idempotency key is still in progress", 409)
+
+
+def finish(keys, uid, key: str, status_code: int, body: dict):
+    _id = f"{uid}:{key}"
+    if status_code >= 500 or status_code == 409:
+        keys.delete_one({"_id": _id, "state": "PENDING"})
+        return
+    keys.update_one(
+        {"_id": _id},
+        {"$set": {"state": "DONE", "result": {"status_code": status_code, "body": body}, "done_at": utcnow()}},
+    )
+
+
+def abandon(keys, uid, key: str):
+    keys.delete_one({"_id": f"{uid}:{key}", "state": "PENDING"})
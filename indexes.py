@@ -0,0 +1,177 @@
+import logging
+from datetime import timedelta
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+from util import utcnow
+
+log = logging.getLogger(__name__)
+
+# Declarative index registry: collection -> [(keys, options)].
+# Applied idempotently by ensure_indexes() (at startup with MONGO_ENSURE_INDEXES=1,
+# or `python manage.py ensure-indexes`). Names are explicit so the desktop backend
+# and this service agree on them.
+INDEXES = {
+    "workorders": [
+        # my-workorders / sync: assignee + keyset sort; status is filtered during FETCH.
+        ([("assigned_team_ids", ASCENDING), ("updated_at", DESCENDING), ("_id", DESCENDING)],
+         {"name": "mobile_assigned_updated"}),
+        # achievement active count.
+        ([("assigned_team_ids", ASCENDING), ("status", ASCENDING)], {"name": "mobile_assigned_status"}),
+        # admin listing (no assignee filter).
+        ([("updated_at", DESCENDING), ("_id", DESCENDING)], {"name": "mobile_updated"}),
+        # achievement / stats rebuild / team stats.
+        ([("completed_by", ASCENDING), ("completed_at", DESCENDING)], {"name": "mobile_completed_by_at"}),
+        # my-workorders?near= ($geoNear on geo, see geo.py).
+        ([("assigned_team_ids", ASCENDING), ("geo", "2dsphere")], {"name": "mobile_assigned_geo"}),
+    ],
+    "users": [
+        ([("username", ASCENDING)], {"name": "mobile_username"}),
+        ([("role", ASCENDING)], {"name": "mobile_role"}),
+    ],
+    "mobile_sync_states": [
+        ([("expires_at", ASCENDING)], {"name": "mobile_sync_expiry", "expireAfterSeconds": 0}),
+    ],
+    "auth_sessions": [
+        ([("expires_at", ASCENDING)], {"name": "auth_session_expiry", "expireAfterSeconds": 0}),
+        # logout revokes all sessions of a user.
+        ([("user_id", ASCENDING)], {"name": "auth_session_user"}),
+    ],
+    "idempotency_keys": [
+        ([("expires_at", ASCENDING)], {"name": "idempotency_expiry", "expireAfterSeconds": 0}),
+    ],
+    "upload_sessions": [
+        ([("expires_at", ASCENDING)], {"name": "upload_session_expiry", "expireAfterSeconds": 0}),
+    ],
+    "blobs": [
+        # gc-blobs: unreferenced blobs.
+        ([("refs", ASCENDING)], {"name": "blob_refs"}),
+    ],
+    "workorder_update_buckets": [
+        ([("wo_id", ASCENDING), ("kind", ASCENDING), ("bucket", DESCENDING)], {"name": "bucket_wo_kind"}),
+    ],
+}
+
+
+def ensure_indexes(db) -> dict:
+    report = {"created": [], "exists": [], "conflicts": []}
+    for coll_name, specs in INDEXES.items():
+        coll = db[coll_name]
+        existing = {ix["name"]: ix for ix in coll.list_indexes()}
+        for keys, opts in specs:
+            name = opts["name"]
+            if name in existing:
+                report["exists"].append(f"{coll_name}.{name}")
+                continue
+            try:
+                coll.create_index(keys, **opts)
+                report["created"].append(f"{coll_name}.{name}")
+            except OperationFailure as e:
+                # Same keys already indexed under another name/options (e.g. by the desktop backend).
+                if e.code in (85, 86):
+                    report["conflicts"].append(f"{coll_name}.{name}: {e.details.get('errmsg') if e.details else e}")
+                    log.warning("index %s.%s not created: %s", coll_name, name, e)
+                else:
+                    raise
+    return report
+
+
+# ----------------------------------------------------------------------
+# Query-plan regression checks: explain() each route's real query shape and
+# flag collection scans and blocking (in-memory) sorts.
+# ----------------------------------------------------------------------
+
+BAD_STAGES = {"COLLSCAN", "SORT"}
+
+
+def _stages(node, out):
+    if isinstance(node, dict):
+        st = node.get("stage")
+        if isinstance(st, str):
+            out.add(st)
+        for v in node.values():
+            _stages(v, out)
+    elif isinstance(node, list):
+        for v in node:
+            _stages(v, out)
+    return out
+
+
+def _winning_plans(node, out):
+    if isinstance(node, dict):
+        for k, v in node.items():
+            if k == "winningPlan":
+                out.append(v)
+            else:
+                _winning_plans(v, out)
+    elif isinstance(node, list):
+        for v in node:
+            _winning_plans(v, out)
+    return out
+
+
+def query_shapes(now=None):
+    # Imported lazily: the route modules pull in Flask.
+    from mobile_routes import my_workorders_filter, team_stats_pipeline, work_projection
+    import geo
+    import stats
+
+    now = now or utcnow()
+    uid = "plan-check-user"
+    keyset = (now - timedelta(days=1), "plan-check-wo")
+    by_updated = [("updated_at", -1), ("_id", -1)]
+    completed = {"is_deleted": {"$ne": True}, "completed_by": uid}
+    return [
+        ("login", "users", "find", {"username": "plan-check", "is_deleted": {"$ne": True}}, None),
+        ("my_workorders", "workorders", "find", my_workorders_filter(uid), by_updated),
+        ("my_workorders:status", "workorders", "find", my_workorders_filter(uid, ["ASSIGNED", "ACCEPTED"]), by_updated),
+        ("my_workorders:cursor", "workorders", "find", my_workorders_filter(uid, None, keyset), by_updated),
+        ("my_workorders:admin", "workorders", "find", my_workorders_filter(None, None, keyset), by_updated),
+        ("my_workorders:near", "workorders", "aggregate",
+         geo.geo_near(52.52, 13.405, geo.NEAR_RADIUS_M, my_workorders_filter(uid), 100, work_projection()), None),
+        ("route_plan", "workorders", "find", my_workorders_filter(uid, stats.ACTIVE_STATUSES), by_updated),
+        ("achievement:assigned", "workorders", "count", {"is_deleted": {"$ne": True}, "assigned_team_ids": uid}, None),
+        ("achievement:active", "workorders", "count",
+         {"is_deleted": {"$ne": True}, "assigned_team_ids": uid, "status": {"$in": stats.ACTIVE_STATUSES}}, None),
+        ("achievement:completed", "workorders", "count", completed, None),
+        ("achievement:recent", "workorders", "find", completed, [("completed_at", -1)]),
+        ("team_stats", "workorders", "aggregate", team_stats_pipeline([uid, "plan-check-user-2"], now), None),
+        ("team_stats:members", "users", "find", {"is_deleted": {"$ne": True}, "role": "MOBILE_USER"}, None),
+        ("sync:ids", "workorders", "find", my_workorders_filter(uid), None),
+        ("sync:state", "mobile_sync_states", "find", {"_id": "plan-check-sync", "user_id": uid}, None),
+        ("sync:delta", "workorders", "find", {"$and": [
+            my_workorders_filter(uid),
+            {"$or": [{"updated_at": {"$gte": now - timedelta(minutes=5)}}, {"_id": {"$in": ["plan-check-wo"]}}]},
+        ]}, by_updated),
+        ("updates:buckets", "workorder_update_buckets", "find",
+         {"wo_id": "plan-check-wo", "kind": "work_updates"}, [("bucket", -1)]),
+    ]
+
+
+def explain_shape(db, coll_name, kind, filt, sort):
+    if kind == "find":
+        cur = db[coll_name].find(filt)
+        if sort:
+            cur = cur.sort(sort)
+        return cur.explain()
+    if kind == "count":
+        return db.command("explain", {"count": coll_name, "query": filt}, verbosity="queryPlanner")
+    if kind == "aggregate":
+        return db.command("explain", {"aggregate": coll_name, "pipeline": filt, "cursor": {}}, verbosity="queryPlanner")
+    raise ValueError(f"unknown query kind: {kind}")
+
+
+def check_plans(db, now=None):
+    failures = []
+    results = []
+    for name, coll_name, kind, filt, sort in query_shapes(now):
+        explained = explain_shape(db, coll_name, kind, filt, sort)
+        stages = set()
+        for plan in _winning_plans(explained, []):
+            _stages(plan, stages)
+        bad = sorted(stages & BAD_STAGES)
+        results.append((name, sorted(stages), bad))
+        if bad:
+            failures.append(name)
+    return results, failures
@@ -0,0 +1,174 @@
+import argparse
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from db import get_db
+from blobstore import BlobStore
+import derivatives
+import geo
+import buckets
+import indexes
+import stats
+from upload_routes import cleanup_staging
+
+
+def cmd_backfill_buckets(db, args):
+    workorders = db["workorders"]
+    filt = {"updates_bucketed": {"$ne": True}}
+    if args.wo_id:
+        filt["_id"] = args.wo_id
+    done = 0
+    for d in workorders.find(filt, {"_id": 1}).batch_size(500):
+        if buckets.migrate(workorders, d["_id"]):
+            done += 1
+            if done % 500 == 0:
+                print(f"migrated {done}")
+    print(f"migrated {done} workorders")
+
+    filt = {"updates_bucketed": True}
+    if args.wo_id:
+        filt["_id"] = args.wo_id
+    added = sum(buckets.reconcile(workorders, d["_id"]) for d in workorders.find(filt, {"_id": 1}).batch_size(500))
+    print(f"archived {added} inline entries missing from buckets")
+
+
+def cmd_backfill_geo(db, args):
+    report = geo.backfill(db["workorders"])
+    print(f"geo set on {report['set']} workorders, removed from {report['removed']}")
+
+
+def cmd_rebuild_stats(db, args):
+    workorders = db["workorders"]
+    if args.user_id:
+        uids = [args.user_id]
+    else:
+        live = {"is_deleted": {"$ne": True}}
+        uids = set(workorders.distinct("completed_by", live)) | set(workorders.distinct("assigned_team_ids", live))
+        uids = sorted(x for x in uids if x)
+    for i, uid in enumerate(uids, 1):
+        stats.rebuild_user(workorders, uid)
+        if i % 200 == 0:
+            print(f"rebuilt {i}/{len(uids)}")
+    print(f"rebuilt stats for {len(uids)} users")
+
+
+def cmd_ensure_indexes(db, args):
+    report = indexes.ensure_indexes(db)
+    for k in ("created", "exists", "conflicts"):
+        for name in report[k]:
+            print(f"{k:9} {name}")
+    return 1 if report["conflicts"] and args.strict else 0
+
+
+def cmd_check_plans(db, args):
+    if args.ensure:
+        indexes.ensure_indexes(db)
+    results, failures = indexes.check_plans(db)
+    for name, stages, bad in results:
+        flag = "FAIL" if bad else "ok"
+        print(f"{flag:4} {name:28} {' > '.join(stages)}")
+    if failures:
+        print(f"{len(failures)} query shape(s) use COLLSCAN or an in-memory SORT: {', '.join(failures)}")
+        return 1
+    return 0
+
+
+def cmd_cleanup_uploads(db, args):
+    print(f"removed {cleanup_staging(db['upload_sessions'])} staged upload files")
+
+
+def cmd_gc_blobs(db, args):
+    store = BlobStore.from_env(db["blobs"])
+    if args.recount:
+        print(f"recounted refs, {store.recount(db['workorders'], buckets.collection(db['workorders']))} blobs changed")
+    report = store.gc(grace_seconds=int(args.grace_hours * 3600), dry_run=args.dry_run)
+    prefix = "would remove" if args.dry_run else "removed"
+    print(f"{prefix} {report['unreferenced']} unreferenced blobs, {report['orphan_files']} orphan files, {report['bytes']} bytes")
+
+
+def cmd_derive_images(db, args):
+    if not derivatives.ENABLED:
+        print("image derivatives disabled (Pillow not installed or IMAGE_DERIVATIVES=0)")
+        return 1
+    store = BlobStore.from_env(db["blobs"])
+    workorders = db["workorders"]
+    filt = {"_id": args.wo_id} if args.wo_id else {}
+    todo = []
+    for d in workorders.find({**filt, "work_updates.images.sha256": {"$exists": True}}, {"work_updates": 1}):
+        todo.extend((d["_id"], up) for up in d.get("work_updates") or [])
+    bfilt = {"wo_id": args.wo_id} if args.wo_id else {}
+    for b in buckets.collection(workorders).find({**bfilt, "kind": "work_updates"}, {"wo_id": 1, "entries": 1}):
+        todo.extend((b["wo_id"], up) for up in b.get("entries") or [])
+
+    done = failed = 0
+    seen = set()
+    for wo_id, up in todo:
+        for m in up.get("images") or []:
+            key = (wo_id, up.get("id"), m.get("sha256"))
+            if not m.get("sha256") or m.get("variants") or key in seen:
+                continue
+            seen.add(key)
+            try:
+                derivatives.derive(store, workorders, wo_id, up.get("id"), m["sha256"])
+                done += 1
+            except Exception as e:
+                failed += 1
+                print(f"{wo_id}/{up.get('id')}: {e}")
+    print(f"derived {done} images, {failed} failed")
+    return 1 if failed else 0
+
+
+def cmd_enable_preimages(db, args):
+    # Lets /mobile/events tell unassigned users precisely (MongoDB 6+).
+    db.command("collMod", "workorders", changeStreamPreAndPostImages={"enabled": True})
+    print("change stream pre-images enabled on workorders")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="manage.py", description="FabriX mobile backend maintenance commands")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("backfill-buckets", help="move inline work_updates/history into workorder_update_buckets and archive missed entries")
+    p.add_argument("--wo-id", help="only migrate this workorder")
+    p.set_defaults(func=cmd_backfill_buckets)
+
+    p = sub.add_parser("backfill-geo", help="mirror workorder location into the 2dsphere-indexed geo field")
+    p.set_defaults(func=cmd_backfill_geo)
+
+    p = sub.add_parser("rebuild-stats", help="recompute user_stats rollups from workorders")
+    p.add_argument("--user-id", help="only rebuild this user")
+    p.set_defaults(func=cmd_rebuild_stats)
+
+    p = sub.add_parser("gc-blobs", help="delete content-addressed upload blobs that nothing references")
+    p.add_argument("--grace-hours", type=float, default=24.0, help="keep blobs younger than this (in-flight submits)")
+    p.add_argument("--recount", action="store_true", help="recompute reference counts from workorders first")
+    p.add_argument("--dry-run", action="store_true")
+    p.set_defaults(func=cmd_gc_blobs)
+
+    p = sub.add_parser("derive-images", help="render missing thumbnails/previews for stored images")
+    p.add_argument("--wo-id", help="only this workorder")
+    p.set_defaults(func=cmd_derive_images)
+
+    p = sub.add_parser("ensure-indexes", help="create the indexes declared in indexes.INDEXES")
+    p.add_argument("--strict", action="store_true", help="exit 1 if an index conflicts with an existing one")
+    p.set_defaults(func=cmd_ensure_indexes)
+
+    p = sub.add_parser("check-plans", help="explain() every route query shape; exit 1 on COLLSCAN or in-memory SORT")
+    p.add_argument("--ensure", action="store_true", help="run ensure-indexes first (e.g. against a fresh local mongod)")
+    p.set_defaults(func=cmd_check_plans)
+
+    p = sub.add_parser("enable-preimages", help="enable change stream pre-images on workorders (for /mobile/events)")
+    p.set_defaults(func=cmd_enable_preimages)
+
+    p = sub.add_parser("cleanup-uploads", help="delete staged chunked-upload files that are expired or used")
+    p.set_defaults(func=cmd_cleanup_uploads)
+
+    args = parser.parse_args(argv)
+    return args.func(get_db(), args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+log = logging.getLogger(__name__)
+
+# Request, MongoDB command and code-section timings in Prometheus format.
+#
+# Each gunicorn worker keeps its own registry and writes a snapshot to
+# METRICS_DIR/<pid>.json every METRICS_FLUSH_SECONDS; /metrics (on whichever worker
+# serves it) sums the snapshots of all live workers. Counters restart when a worker
+# restarts, which Prometheus treats as a counter reset.
+#
+# MongoDB commands are attributed to the route of the request that issued them: pymongo
+# publishes command events on the calling thread, and each request thread records its
+# route in a thread-local (see begin()). Commands from background threads (derivatives,
+# change stream, cache refreshes) are labelled route="-", as are those of asgi.py's native
+# routes (Motor runs them on its own threads).
+
+ENABLED = os.getenv("METRICS_ENABLED", "1").strip() in ("1", "true", "True")
+DIR = os.getenv("METRICS_DIR", "").strip() or os.path.join(tempfile.gettempdir(), "fabrix-mobile-metrics")
+FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+# Requests slower than this are logged with the MongoDB commands they issued (0 = off).
+SLOW_REQUEST_MS = int(os.getenv("METRICS_SLOW_REQUEST_MS", "0"))
+_SLOW_LOG_COMMANDS = 25
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# Connection handshake / session bookkeeping, not application queries.
+_IGNORED_COMMANDS = {"hello", "ismaster", "isMaster", "saslStart", "saslContinue", "endSessions", "ping"}
+
+_HELP = {
+    "http_requests_total": ("counter", "Requests by route, method and status."),
+    "http_request_duration_seconds": ("histogram", "Time to build the response, by route."),
+    "http_request_mongo_seconds": ("histogram", "MongoDB command time per request, by route."),
+    "http_request_mongo_commands": ("histogram", "MongoDB commands per request, by route."),
+    "mongo_command_duration_seconds": ("histogram", "MongoDB command round trips by route and command."),
+    "mongo_command_failures_total": ("counter", "Failed MongoDB commands by route and command."),
+    "section_duration_seconds": ("histogram", "Timed code sections (verify_password, save_file, json_encode, compress)."),
+}
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> value
+_hists = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+_local = threading.local()
+_flusher_pid = None
+
+
+def _labels(**kw):
+    return tuple(sorted((k, str(v)) for k, v in kw.items()))
+
+
+def inc(name, value=1, **labels):
+    key = (name, _labels(**labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, buckets=BUCKETS, **labels):
+    key = (name, _labels(**labels))
+    with _lock:
+        h = _hists.get(key)
+        if h is None:
+            h = _hists[key] = [0] * (len(buckets) + 2)
+        h[bisect_left(buckets, value)] += 1
+        h[-1] += value
+
+
+# ----------------------------------------------------------------------
+# Per-request context
+# ----------------------------------------------------------------------
+
+class _Request:
+    __slots__ = ("route", "method", "t0", "mongo_count", "mongo_seconds", "commands", "sections", "pending")
+
+    def __init__(self, route, method):
+        self.route = route
+        self.method = method
+        self.t0 = time.perf_counter()
+        self.mongo_count = 0
+        self.mongo_seconds = 0.0
+        self.commands = []
+        self.sections = {}
+        self.pending = {}
+
+
+def begin(route, method):
+    _local.req = _Request(route, method)
+    _start_flusher()
+
+
+def current_route():
+    req = getattr(_local, "req", None)
+    return req.route if req else "-"
+
+
+# Request count and duration only: for handlers that do not run begin()/end() on a
+# thread of their own (asgi.py's native routes).
+def record_request(route, method, status, seconds):
+    _start_flusher()
+    inc("http_requests_total", route=route, method=method, status=status)
+    observe("http_request_duration_seconds", seconds, route=route, method=method)
+
+
+def end(status):
+    req = getattr(_local, "req", None)
+    if req is None:
+        return
+    _local.req = None
+    seconds = time.perf_counter() - req.t0
+    record_request(req.route, req.method, status, seconds)
+    observe("http_request_mongo_seconds", req.mongo_seconds, route=req.route)
+    observe("http_request_mongo_commands", req.mongo_count, buckets=COUNT_BUCKETS, route=req.route)
+    if SLOW_REQUEST_MS and seconds * 1000 >= SLOW_REQUEST_MS:
+        log.warning(
+            "slow request %s %s -> %s in %.0f ms; mongo: %d commands, %.0f ms; sections: %s; commands: %s",
+            req.method, req.route, status, seconds * 1000, req.mongo_count, req.mongo_seconds * 1000,
+            {k: round(v * 1000, 1) for k, v in req.sections.items()},
+            ", ".join(f"{c}({coll}) {ms:.1f} ms" for c, coll, ms in req.commands[:_SLOW_LOG_COMMANDS]),
+        )
+
+
+@contextmanager
+def timed(section):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - t0
+        observe("section_duration_seconds", seconds, section=section, route=current_route())
+        req = getattr(_local, "req", None)
+        if req is not None:
+            req.sections[section] = req.sections.get(section, 0.0) + seconds
+
+
+class CommandMetrics(monitoring.CommandListener):
+    def started(self, event):
+        req = getattr(_local, "req", None)
+        if req is not None and event.command_name not in _IGNORED_COMMANDS:
+            coll = event.command.get(event.command_name)
+            if event.command_name == "getMore":
+                coll = event.command.get("collection")
+            req.pending[event.request_id] = coll if isinstance(coll, str) else ""
+
+    def _finished(self, event, failed):
+        if event.command_name in _IGNORED_COMMANDS:
+            return
+        seconds = event.duration_micros / 1e6
+        route = current_route()
+        observe("mongo_command_duration_seconds", seconds, route=route, command=event.command_name)
+        if failed:
+            inc("mongo_command_failures_total", route=route, command=event.command_name)
+        req = getattr(_local, "req", None)
+        if req is not None:
+            req.mongo_count += 1
+            req.mongo_seconds += seconds
+            coll = req.pending.pop(event.request_id, "")
+            if len(req.commands) < _SLOW_LOG_COMMANDS:
+                req.commands.append((event.command_name, coll, seconds * 1000))
+
+    def succeeded(self, event):
+        self._finished(event, False)
+
+    def failed(self, event):
+        self._finished(event, True)
+
+
+command_listener = CommandMetrics()
+
+
+# ----------------------------------------------------------------------
+# Cross-worker aggregation
+# ----------------------------------------------------------------------
+
+def _snapshot(gauges=None) -> dict:
+    with _lock:
+        return {
+            "pid": os.getpid(),
+            "counters": [[n, list(l), v] for (n, l), v in _counters.items()],
+            "hists": [[n, list(l), list(h)] for (n, l), h in _hists.items()],
+            "gauges": gauges or {},
+        }
+
+
+def flush(gauges=None):
+    os.makedirs(DIR, exist_ok=True)
+    path = os.path.join(DIR, f"{os.getpid()}.json")
+    fd, tmp = tempfile.mkstemp(dir=DIR, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(_snapshot(gauges), f)
+    os.replace(tmp, path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Set by the app: returns this worker's gauges (the dicts shown by GET /).
+gauge_source = None
+
+
+def _gauges():
+    try:
+        return gauge_source() if gauge_source else {}
+    except Exception:
+        log.exception("metrics gauge source failed")
+        return {}
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_SECONDS)
+        try:
+            flush(_gauges())
+        except Exception:
+            log.exception("metrics flush failed")
+
+
+# Like db.get_client: one flusher thread per worker, started after gunicorn forks.
+def _start_flusher():
+    global _flusher_pid
+    if not ENABLED or _flusher_pid == os.getpid():
+        return
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+
+
+def collect() -> list:
+    flush(_gauges())
+    snaps = []
+    for name in os.listdir(DIR):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(DIR, name)
+        pid = int(name[:-5]) if name[:-5].isdigit() else None
+        if pid is None or not _alive(pid):
+            # Worker gone (restart, max_requests): drop its file.
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path) as f:
+                snaps.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snaps
+
+
+def _fmt_labels(pairs):
+    if not pairs:
+        return ""
+    esc = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, esc)) + "}"
+
+
+def _flatten(prefix, value, out):
+    if isinstance(value, bool):
+        out[prefix] = int(value)
+    elif isinstance(value, (int, float)):
+        out[prefix] = value
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            _flatten(f"{prefix}_{k}", v, out)
+
+
+def render(snaps) -> str:
+    counters, hists = {}, {}
+    for s in snaps:
+        for n, l, v in s["counters"]:
+            key = (n, tuple(tuple(p) for p in l))
+            counters[key] = counters.get(key, 0) + v
+        for n, l, h in s["hists"]:
+            key = (n, tuple(tuple(p) for p in l))
+            if key in hists and len(hists[key]) == len(h):
+                hists[key] = [a + b for a, b in zip(hists[key], h)]
+            else:
+                hists[key] = list(h)
+
+    lines = []
+    for name in sorted({n for n, _ in counters} | {n for n, _ in hists}):
+        kind, help_ = _HELP.get(name, ("untyped", ""))
+        lines.append(f"# HELP fabrix_{name} {help_}")
+        lines.append(f"# TYPE fabrix_{name} {kind}")
+        for (n, l), v in sorted(counters.items()):
+            if n == name:
+                lines.append(f"fabrix_{name}{_fmt_labels(l)} {v}")
+        for (n, l), h in sorted(hists.items()):
+            if n != name:
+                continue
+            buckets = COUNT_BUCKETS if name == "http_request_mongo_commands" else BUCKETS
+            cum = 0
+            for le, c in zip(list(buckets) + ["+Inf"], h[:-1]):
+                cum += c
+                lines.append(f"fabrix_{name}_bucket{_fmt_labels(l + (('le', str(le)),))} {cum}")
+            lines.append(f"fabrix_{name}_sum{_fmt_labels(l)} {h[-1]}")
+            lines.append(f"fabrix_{name}_count{_fmt_labels(l)} {cum}")
+
+    # Existing per-worker stats (user cache, pool, hashing, ...) as gauges labelled by pid.
+    gauges = {}
+    for s in snaps:
+        flat = {}
+        _flatten("fabrix", s.get("gauges") or {}, flat)
+        for k, v in flat.items():
+            gauges.setdefault(k, []).append((s["pid"], v))
+    for k in sorted(gauges):
+        lines.append(f"# TYPE {k} gauge")
+        for pid, v in gauges[k]:
+            lines.append(f'{k}{{pid="{pid}"}} {v}')
+    return "\n".join(lines) + "\n"
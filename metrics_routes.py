@@ -0,0 +1,35 @@
+import os
+import hmac
+
+from flask import Response, jsonify, request
+
+import metrics
+
+# Bearer token required by /metrics when set (otherwise restrict it at the proxy).
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "").strip()
+
+
+# gauges: returns this worker's stats dicts (exported as fabrix_<section>_<key>{pid}).
+def register_metrics(app, gauges=None):
+    if not metrics.ENABLED:
+        return
+    metrics.gauge_source = gauges
+
+    @app.before_request
+    def _metrics_begin():
+        rule = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.begin(rule, request.method)
+
+    @app.after_request
+    def _metrics_end(resp):
+        metrics.end(resp.status_code)
+        return resp
+
+    @app.get("/metrics")
+    def metrics_endpoint():
+        if METRICS_TOKEN:
+            auth = request.headers.get("Authorization", "")
+            if not hmac.compare_digest(auth, f"Bearer {METRICS_TOKEN}"):
+                return jsonify({"detail": "Unauthorized"}), 401
+        body = metrics.render(metrics.collect())
+        return Response(body, mimetype="text/plain; version=0.0.4")
@@ -1,21 +1,250 @@
 import os
+import re
+import time
 import mimetypes
 from pathlib import Path
-from datetime import timedelta
+from datetime import datetime, timedelta
 from flask import request, jsonify, send_from_directory
-from werkzeug.utils import secure_filename
 
-from util import utcnow, new_id, norm
-
-_IMG_EXT = {".jpg", ".jpeg", ".png", ".webp"}
-_AUD_EXT = {".m4a", ".aac", ".mp3", ".wav", ".ogg"}
-# If you ever record as .mp4 (AAC in mp4 container), then enable this:
-# _AUD_EXT = {".m4a", ".aac", ".mp3", ".wav", ".ogg", ".mp4"}
+import buckets
+from blobstore import BlobStore
+from db import for_route
+import derivatives
+import geo
+import idempotency
+import metrics
+from responses import not_modified, weak_etag, with_validators
+import routing
+from cache import RefreshingCache
+import stats
+import workflow
+from upload_routes import clean_filename, claim_uploads, release_uploads, mark_used
+from security import sign_media, verify_media
+from util import utcnow, new_id, norm, naive_utc, encode_token, decode_token
 
 _MAX_IMAGES = 3
+_MAX_BATCH_ACTIONS = int(os.getenv("MOBILE_MAX_BATCH_ACTIONS", "100"))
+
+_SYNC_TOKEN_DAYS = int(os.getenv("MOBILE_SYNC_TOKEN_DAYS", "14"))
+# Overlap applied to the previous sync time so writes stamped by a slightly skewed clock are not missed.
+_SYNC_SKEW_SECONDS = int(os.getenv("MOBILE_SYNC_SKEW_SECONDS", "5"))
+
+_team_cache = RefreshingCache(
+    ttl=float(os.getenv("TEAM_STATS_TTL_SECONDS", "30")),
+    max_stale=float(os.getenv("TEAM_STATS_MAX_STALE_SECONDS", "300")),
+)
+
+_MEDIA_URL_SECONDS = int(os.getenv("MEDIA_URL_TTL_SECONDS", "3600"))
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+_ROUTE_MAX_STOPS = int(os.getenv("ROUTE_MAX_STOPS", "500"))
+
+_PAGE_SIZE = int(os.getenv("MOBILE_WORKORDERS_PAGE_SIZE", "500"))
+_MAX_PAGE_SIZE = int(os.getenv("MOBILE_WORKORDERS_MAX_PAGE_SIZE", "500"))
+
+# Public field name -> workorder document field, in the order work_public emits them.
+_WORK_PUBLIC_FIELDS = {
+    "id": "_id",
+    "wo_no": "wo_no",
+    "customer_name": "customer_name",
+    "phone": "phone",
+    "address": "address",
+    "status": "status",
+    "schedule": "schedule",
+    "location": "location",
+    "updated_at": "updated_at",
+}
+
+
+def parse_fields(raw):
+    if not raw:
+        return None
+    fields = [f.strip() for f in raw.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in _WORK_PUBLIC_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return ["id"] + [f for f in fields if f != "id"]
+
+
+def work_projection(fields=None):
+    proj = {_WORK_PUBLIC_FIELDS[f]: 1 for f in (fields or _WORK_PUBLIC_FIELDS)}
+    proj["updated_at"] = 1  # always needed for the page cursor
+    return proj
+
+
+def page_size(raw, default=_PAGE_SIZE, maximum=_MAX_PAGE_SIZE):
+    try:
+        n = int(raw) if raw else default
+    except ValueError:
+        n = default
+    return max(1, min(n, maximum))
+
+
+def is_admin(u):
+    return ((u or {}).get("role") or "") in ("SUPER_ADMIN", "ADMIN")
+
+
+def work_public(d, fields=None):
+    out = {
+        "id": d.get("_id"),
+        "wo_no": d.get("wo_no"),
+        "customer_name": d.get("customer_name"),
+        "phone": d.get("phone"),
+        "address": d.get("address"),
+        "status": d.get("status"),
+        "schedule": d.get("schedule") or None,
+        "location": d.get("location") or None,  # {lat,lng,label}
+        "updated_at": d.get("updated_at"),
+    }
+    if fields:
+        return {k: out[k] for k in fields}
+    return out
+
+
+# Weak ETag of a workorder list: caller, query string and each item's (id, updated_at).
+# A workorder that changes, appears or leaves the result changes the tag.
+def list_validators(uid, query_string: bytes, docs, extra=None):
+    stamps = [d.get("updated_at") for d in docs if d.get("updated_at")]
+    etag = weak_etag(uid, query_string, [(d.get("_id"), d.get("updated_at")) for d in docs], extra)
+    return etag, max(stamps) if stamps else None
+
+
+# Opaque keyset cursor over (updated_at desc, _id desc).
+def encode_cursor(d):
+    ua = d.get("updated_at")
+    return encode_token([ua.isoformat() if ua else None, d.get("_id")])
+
+
+def decode_cursor(cursor):
+    try:
+        ua, wid = decode_token(cursor)
+        return (datetime.fromisoformat(ua) if ua else None), str(wid)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+# Cursor of /updates pages: [bucket, index]; the bucket is "" for inline entries.
+def decode_updates_cursor(cursor):
+    try:
+        bucket, index = decode_token(cursor)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(bucket, str) or type(index) is not int or index < 0:
+        raise ValueError("Invalid cursor")
+    return bucket, index
+
+
+def after_cursor(ua, wid):
+    # Documents without updated_at sort after every dated one in descending order.
+    if ua is None:
+        return {"updated_at": None, "_id": {"$lt": wid}}
+    return {"$or": [
+        {"updated_at": {"$lt": ua}},
+        {"updated_at": ua, "_id": {"$lt": wid}},
+        {"updated_at": None},
+    ]}
+
+
+# Signed, short-lived URL for an upload stored in the blob store. The expiry is rounded up
+# to a window boundary (valid for 1-2 windows) so the URL, and the app's image cache
+# entry, stays the same for a whole window.
+def signed_media_url(meta, now_ts=None, variant=None):
+    sha256 = (meta or {}).get("sha256")
+    if variant:
+        sha256 = (((meta or {}).get("variants") or {}).get(variant) or {}).get("sha256")
+    if not sha256 or not meta.get("url"):
+        return None
+    now_ts = int(now_ts or time.time())
+    exp = (now_ts // _MEDIA_URL_SECONDS + 2) * _MEDIA_URL_SECONDS
+    url = f"{meta['url']}?h={sha256}&exp={exp}&sig={sign_media(meta['url'], sha256, exp)}"
+    return f"{url}&variant={variant}" if variant else url
+
+
+def _image_urls(m):
+    out = {**m, "signed_url": signed_media_url(m)}
+    if m.get("variants"):
+        out["variants"] = {k: {**v, "signed_url": signed_media_url(m, variant=k)} for k, v in m["variants"].items()}
+    return out
+
+
+def with_media_urls(update):
+    if not update:
+        return update
+    out = dict(update)
+    out["images"] = [_image_urls(m) if (m or {}).get("sha256") else m for m in (update.get("images") or [])]
+    v = update.get("voice")
+    if v and v.get("sha256"):
+        out["voice"] = {**v, "signed_url": signed_media_url(v)}
+    return out
+
+
+def my_workorders_filter(target_uid=None, statuses=None, after=None):
+    base_and = [{"is_deleted": {"$ne": True}}]
+    if statuses:
+        base_and.append({"status": {"$in": statuses}} if len(statuses) > 1 else {"status": statuses[0]})
+    if target_uid:
+        base_and.append({"assigned_team_ids": target_uid})
+    if after:
+        base_and.append(after_cursor(*after))
+    return {"$and": base_and} if len(base_and) > 1 else base_and[0]
+
+
+def team_stats_pipeline(uids, now):
+    d7 = now - timedelta(days=7)
+    d30 = now - timedelta(days=30)
+    return [
+        {"$match": {
+            "is_deleted": {"$ne": True},
+            "$or": [{"assigned_team_ids": {"$in": uids}}, {"completed_by": {"$in": uids}}],
+        }},
+        {"$project": {"assigned_team_ids": 1, "completed_by": 1, "completed_at": 1, "status": 1, "updated_at": 1}},
+        {"$facet": {
+            "assigned": [
+                {"$unwind": "$assigned_team_ids"},
+                {"$match": {"assigned_team_ids": {"$in": uids}}},
+                {"$group": {
+                    "_id": "$assigned_team_ids",
+                    "assigned": {"$sum": 1},
+                    "active": {"$sum": {"$cond": [{"$in": ["$status", stats.ACTIVE_STATUSES]}, 1, 0]}},
+                    "last_updated_at": {"$max": "$updated_at"},
+                }},
+            ],
+            "completed": [
+                {"$match": {"completed_by": {"$in": uids}}},
+                {"$group": {
+                    "_id": "$completed_by",
+                    "completed": {"$sum": 1},
+                    "completed_7d": {"$sum": {"$cond": [{"$gte": ["$completed_at", d7]}, 1, 0]}},
+                    "completed_30d": {"$sum": {"$cond": [{"$gte": ["$completed_at", d30]}, 1, 0]}},
+                    "last_completed_at": {"$max": "$completed_at"},
+                }},
+            ],
+        }},
+    ]
+
+
+def register_mobile_routes(
+    app,
+    workorders,
+    users,
+    require_auth,
+    require_auth_read=None,
+    sync_states=None,
+    upload_sessions=None,
+    blob_store=None,
+    idempotency_keys=None,
+):
+    # Read-only endpoints may use the stateless (claims-only) variant of require_auth.
+    require_auth_read = require_auth_read or require_auth
+    if sync_states is None:
+        sync_states = workorders.database["mobile_sync_states"]
+    if upload_sessions is None:
+        upload_sessions = workorders.database["upload_sessions"]
+    if blob_store is None:
+        blob_store = BlobStore.from_env(workorders.database["blobs"])
+    if idempotency_keys is None:
+        idempotency_keys = workorders.database["idempotency_keys"]
 
-
-def register_mobile_routes(app, workorders, users, require_auth):
     upload_root = Path(os.getenv("UPLOAD_ROOT", "./uploads")).resolve()
     wo_upload_root = upload_root / "workorders"
     wo_upload_root.mkdir(parents=True, exist_ok=True)
@@ -23,277 +252,576 @@ def register_mobile_routes(app, workorders, users, require_auth):
     max_upload_mb = int(os.getenv("MOBILE_MAX_UPLOAD_MB", "35"))
     app.config.setdefault("MAX_CONTENT_LENGTH", max_upload_mb * 1024 * 1024)
 
-    def _role(u):
-        return (u or {}).get("role") or ""
-
-    def _is_admin(u):
-        return _role(u) in ("SUPER_ADMIN", "ADMIN")
+    # Route-level read preference (MONGO_READ_PREFERENCES); writes always use the primary.
+    def _reader(route):
+        return for_route(workorders, route)
 
     def _can_access_wo(u, wo):
         if not u or not wo:
             return False
-        if _is_admin(u):
+        if is_admin(u):
             return True
         return u.get("_id") in (wo.get("assigned_team_ids") or [])
 
-    def _work_public(d):
-        return {
-            "id": d.get("_id"),
-            "wo_no": d.get("wo_no"),
-            "customer_name": d.get("customer_name"),
-            "phone": d.get("phone"),
-            "address": d.get("address"),
-            "status": d.get("status"),
-            "schedule": d.get("schedule") or None,
-            "location": d.get("location") or None,  # {lat,lng,label}
-            "updated_at": d.get("updated_at").isoformat() if d.get("updated_at") else None,
-        }
+    def _list_validators(u, docs, extra=None):
+        return list_validators(u.get("_id"), request.query_string, docs, extra)
 
     @app.get("/mobile/my-workorders")
-    @require_auth
+    @require_auth_read
     def my_workorders():
         u = request.user
         status_q = norm(request.args.get("status"))
         user_id = norm(request.args.get("user_id"))
 
         target_uid = u.get("_id")
-        if user_id and _is_admin(u):
+        if user_id and is_admin(u):
             target_uid = user_id
 
-        base_and = [{"is_deleted": {"$ne": True}}]
-        if status_q:
-            statuses = [s.strip() for s in status_q.split(",") if s.strip()]
-            base_and.append({"status": {"$in": statuses}} if len(statuses) > 1 else {"status": statuses[0]})
+        statuses = [s.strip() for s in status_q.split(",") if s.strip()]
+        limit = page_size(request.args.get("limit"))
+        cursor = norm(request.args.get("cursor"))
+        near = norm(request.args.get("near"))
+        try:
+            fields = parse_fields(norm(request.args.get("fields")))
+            after = decode_cursor(cursor) if cursor else None
+            if near:
+                lat, lng = geo.parse_point(near)
+                radius = geo.parse_radius(norm(request.args.get("radius")))
+        except ValueError as ve:
+            return jsonify({"detail": str(ve)}), 400
+
+        scope_uid = target_uid if (not is_admin(u) or user_id) else None
+        if near:
+            # Nearest first, within radius metres; one page only (no cursor).
+            if after:
+                return jsonify({"detail": "cursor cannot be combined with near"}), 400
+            pipeline = geo.geo_near(
+                lat, lng, radius, my_workorders_filter(scope_uid, statuses), limit, work_projection(fields)
+            )
+            docs = list(_reader("my_workorders").aggregate(pipeline))
+            for d in docs:
+                d["distance_m"] = round(d["distance_m"])
+            etag, last_modified = _list_validators(u, docs, [d["distance_m"] for d in docs])
+            resp = not_modified(etag, last_modified)
+            if resp:
+                return resp
+            items = [{**work_public(d, fields), "distance_m": d["distance_m"]} for d in docs]
+            return with_validators(jsonify({"items": items, "next_cursor": None}), etag, last_modified)
+
+        filt = my_workorders_filter(scope_uid, statuses, after)
+        cur = (
+            _reader("my_workorders").find(filt, work_projection(fields))
+            .sort([("updated_at", -1), ("_id", -1)])
+            .limit(limit + 1)
+        )
+        docs = list(cur)
+        etag, last_modified = _list_validators(u, docs)
+        resp = not_modified(etag, last_modified)
+        if resp:
+            return resp
+        next_cursor = encode_cursor(docs[limit - 1]) if len(docs) > limit else None
+        body = {"items": [work_public(d, fields) for d in docs[:limit]], "next_cursor": next_cursor}
+        return with_validators(jsonify(body), etag, last_modified)
+
+    # Suggested visiting order of the caller's active workorders, starting at ?start=lat,lng
+    # when given. Workorders without a usable location are listed under `unplaced`.
+    @app.get("/mobile/route-plan")
+    @require_auth_read
+    def route_plan():
+        u = request.user
+        user_id = norm(request.args.get("user_id"))
+        target_uid = user_id if (user_id and is_admin(u)) else u.get("_id")
+        try:
+            start = geo.parse_point(norm(request.args.get("start"))) if norm(request.args.get("start")) else None
+        except ValueError as ve:
+            return jsonify({"detail": str(ve)}), 400
+
+        proj = {**work_projection(), geo.FIELD: 1}
+        docs = list(
+            _reader("route_plan").find(my_workorders_filter(target_uid, stats.ACTIVE_STATUSES), proj)
+            .sort([("updated_at", -1), ("_id", -1)])
+            .limit(_ROUTE_MAX_STOPS)
+        )
+        placed, points, unplaced = [], [], []
+        for d in docs:
+            p = geo.doc_point(d)
+            if p:
+                placed.append(d)
+                points.append(p)
+            else:
+                unplaced.append(work_public(d))
+
+        order, legs = routing.plan(points, start)
+        stops = [{**work_public(placed[i]), "leg_m": round(leg)} for i, leg in zip(order, legs)]
+        return jsonify({
+            "start": {"lat": start[0], "lng": start[1]} if start else None,
+            "stops": stops,
+            "total_m": round(sum(legs)),
+            "unplaced": unplaced,
+        })
 
-        if not _is_admin(u) or user_id:
-            base_and.append({"assigned_team_ids": target_uid})
+    # Delta sync. Each token remembers the set of workorder ids the client holds after that
+    # sync, so unassigned and deleted workorders can be reported as tombstones ("removed").
+    @app.get("/mobile/sync")
+    @require_auth_read
+    def sync():
+        u = request.user
+        since = norm(request.args.get("since"))
+        user_id = norm(request.args.get("user_id"))
 
-        filt = {"$and": base_and} if len(base_and) > 1 else base_and[0]
-        cur = workorders.find(filt).sort("updated_at", -1).limit(500)
-        return jsonify({"items": [_work_public(d) for d in cur]})
+        target_uid = u.get("_id")
+        if user_id and is_admin(u):
+            target_uid = user_id
 
-    def _save_file(file_storage, dest_dir: Path, kind: str):
-        if not file_storage:
-            return None
-        filename = secure_filename(file_storage.filename or "")
-        if not filename:
-            guessed = mimetypes.guess_extension(file_storage.mimetype or "") or ""
-            filename = f"{kind}{guessed or ''}"
-        ext = Path(filename).suffix.lower()
+        now = utcnow()
+        # Always the primary: the delta watermark is wall-clock time, and a lagging secondary
+        # would hide updates committed before it for good.
+        reader = workorders
+        current_ids = [d["_id"] for d in reader.find(my_workorders_filter(target_uid), {"_id": 1})]
+
+        state = None
+        if since:
+            state = sync_states.find_one({"_id": since, "user_id": target_uid})
+            if state and state.get("expires_at") and naive_utc(state["expires_at"]) <= naive_utc(now):
+                state = None
+
+        if state:
+            known = set(state.get("ids") or [])
+            current = set(current_ids)
+            removed = sorted(known - current)
+            added = [i for i in current_ids if i not in known]
+            since_at = state["at"] - timedelta(seconds=_SYNC_SKEW_SECONDS)
+            filt = {"$and": [
+                my_workorders_filter(target_uid),
+                {"$or": [{"updated_at": {"$gte": since_at}}, {"_id": {"$in": added}}]},
+            ]}
+        else:
+            removed = []
+            filt = my_workorders_filter(target_uid)
+
+        items = [work_public(d) for d in reader.find(filt, work_projection()).sort([("updated_at", -1), ("_id", -1)])]
+
+        if state and not items and not removed:
+            token = since
+        else:
+            token = new_id()
+            sync_states.insert_one({
+                "_id": token,
+                "user_id": target_uid,
+                "at": now,
+                "ids": current_ids,
+                "created_at": now,
+                "expires_at": now + timedelta(days=_SYNC_TOKEN_DAYS),
+            })
 
-        if kind == "image" and ext not in _IMG_EXT:
-            raise ValueError(f"Invalid image type: {ext}")
-        if kind == "voice" and ext not in _AUD_EXT:
-            raise ValueError(f"Invalid audio type: {ext}")
+        return jsonify({"items": items, "removed": removed, "next": token, "full": state is None})
 
-        dest_dir.mkdir(parents=True, exist_ok=True)
+    # Names only need to be unique within one update; the bytes live in the blob store.
+    def _unique_name(taken: set, filename: str):
+        ext = Path(filename).suffix.lower()
         final_name = filename
         i = 2
-        while (dest_dir / final_name).exists():
-            stem = Path(filename).stem
-            final_name = f"{stem}_{i}{ext}"
+        while final_name in taken:
+            final_name = f"{Path(filename).stem}_{i}{ext}"
             i += 1
+        taken.add(final_name)
+        return final_name
 
-        out_path = dest_dir / final_name
-        file_storage.save(out_path)
-        mime = file_storage.mimetype or (mimetypes.guess_type(str(out_path))[0] or "application/octet-stream")
-        size = out_path.stat().st_size
-        url = f"/mobile/uploads/workorders/{dest_dir.parent.name}/{dest_dir.name}/{final_name}"
-        return {"name": final_name, "url": url, "mime": mime, "size": int(size)}
+    def _file_meta(wo_id, update_id, final_name: str, mime: str, size: int, sha256: str):
+        url = f"/mobile/uploads/workorders/{wo_id}/{update_id}/{final_name}"
+        return {"name": final_name, "url": url, "mime": mime, "size": int(size), "sha256": sha256}
 
+    def _save_file(file_storage, wo_id, update_id, kind: str, taken: set):
+        if not file_storage:
+            return None
+        filename = clean_filename(file_storage.filename, file_storage.mimetype, kind)
+        final_name = _unique_name(taken, filename)
+        mime = file_storage.mimetype or (mimetypes.guess_type(final_name)[0] or "application/octet-stream")
+        with metrics.timed("save_file"):
+            sha256, size = blob_store.put_stream(file_storage.stream, mime)
+        return _file_meta(wo_id, update_id, final_name, mime, size, sha256)
+
+    # Adds a finished chunked upload (see upload_routes) to the blob store without copying it.
+    # Direct (presigned) uploads are already in the store and have no staged file.
+    # Like _save_file, the returned meta holds a blob reference.
+    def _save_staged(session: dict, staged, wo_id, update_id, taken: set):
+        final_name = _unique_name(taken, session["filename"])
+        if staged is None:
+            sha256, size = session["digest"], session["size"]
+            blob_store.add_refs([{"sha256": sha256, "size": size, "mime": session.get("mime")}])
+            if not blob_store.exists(sha256):
+                blob_store.release(sha256)
+                raise ValueError(f"Upload expired: {session['_id']}")
+        else:
+            with metrics.timed("save_file"):
+                sha256, size = blob_store.put_file(staged, session["digest"], session.get("mime"))
+        return _file_meta(wo_id, update_id, final_name, session.get("mime"), size, sha256)
+
+    # Media fetch. A signed URL (see signed_media_url) is served without a token check or
+    # any database access; otherwise the caller must be able to access the workorder.
     @app.get("/mobile/uploads/workorders/<wo_id>/<update_id>/<filename>")
-    @require_auth
     def get_upload(wo_id, update_id, filename):
+        if "sig" not in request.args:
+            return _get_upload_authed(wo_id, update_id, filename)
+        sha256 = norm(request.args.get("h")).lower()
+        if not _SHA256_RE.match(sha256) or not verify_media(
+            request.path, sha256, request.args.get("exp"), norm(request.args.get("sig"))
+        ):
+            return jsonify({"detail": "Invalid or expired media URL"}), 403
+        if norm(request.args.get("variant")) in derivatives.VARIANTS:
+            mime = derivatives.MIME
+        else:
+            mime = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        resp = blob_store.response(sha256, mime, filename)
+        if resp is None:
+            return jsonify({"detail": "Not found"}), 404
+        return resp
+
+    @require_auth_read
+    def _get_upload_authed(wo_id, update_id, filename):
         u = request.user
-        wo = workorders.find_one({"_id": wo_id, "is_deleted": {"$ne": True}})
+        reader = _reader("uploads")
+        wo = reader.find_one(
+            {"_id": wo_id, "is_deleted": {"$ne": True}},
+            {"assigned_team_ids": 1, "updates_bucketed": 1, "work_updates": {"$elemMatch": {"id": update_id}}},
+        )
         if not wo:
             return jsonify({"detail": "Not found"}), 404
         if not _can_access_wo(u, wo):
             return jsonify({"detail": "Forbidden"}), 403
 
-        ok = False
-        for up in (wo.get("work_updates") or []):
-            if str(up.get("id") or "") != str(update_id):
-                continue
-            for im in (up.get("images") or []):
-                if (im or {}).get("name") == filename:
-                    ok = True
+        up = ((wo.get("work_updates") or [None])[0]) or None
+        if up is None and wo.get("updates_bucketed"):
+            up = buckets.find_update(reader, wo_id, update_id)
+
+        meta = None
+        if up:
+            for m in (up.get("images") or []) + [up.get("voice") or {}]:
+                if (m or {}).get("name") == filename:
+                    meta = m
                     break
-            v = up.get("voice") or {}
-            if v.get("name") == filename:
-                ok = True
-            break
-        if not ok:
+        if not meta:
             return jsonify({"detail": "Not found"}), 404
 
+        variant = norm(request.args.get("variant"))
+        if variant and variant not in derivatives.VARIANTS:
+            return jsonify({"detail": f"variant must be one of: {', '.join(derivatives.VARIANTS)}"}), 400
+        # Until the derivative is rendered (or without Pillow) the original is served.
+        if variant and (meta.get("variants") or {}).get(variant):
+            meta = meta["variants"][variant]
+
+        if meta.get("sha256"):
+            # Local disk streams the file; S3 redirects to a short-lived presigned GET.
+            resp = blob_store.response(meta["sha256"], meta.get("mime"), filename)
+            if resp is None:
+                return jsonify({"detail": "Not found"}), 404
+            return resp
+
+        # Uploads stored before the blob store: uploads/workorders/<wo_id>/<update_id>/<name>
         dir_path = wo_upload_root / wo_id / update_id
         return send_from_directory(dir_path, filename, as_attachment=False)
 
-    # ==========================================================
-    # NEW: ACCEPTED -> IN_PROGRESS (used by dropdown)
-    # ==========================================================
-    @app.post("/mobile/workorders/<wo_id>/in-progress")
-    @require_auth
-    def mark_in_progress(wo_id):
+    # Full, newest-first list of work_updates or history. Bucketed workorders only keep
+    # the most recent entries inline; the rest is read from workorder_update_buckets.
+    @app.get("/mobile/workorders/<wo_id>/updates")
+    @require_auth_read
+    def list_updates(wo_id):
         u = request.user
-        wo = workorders.find_one({"_id": wo_id, "is_deleted": {"$ne": True}})
+        kind = norm(request.args.get("kind")) or "work_updates"
+        if kind not in buckets.KINDS:
+            return jsonify({"detail": "Invalid kind. Use work_updates or history"}), 400
+        limit = page_size(request.args.get("limit"), 50, 200)
+        cursor = norm(request.args.get("cursor"))
+        try:
+            before = decode_updates_cursor(cursor) if cursor else None
+        except ValueError as ve:
+            return jsonify({"detail": str(ve)}), 400
+
+        reader = _reader("updates")
+        wo = reader.find_one(
+            {"_id": wo_id, "is_deleted": {"$ne": True}},
+            {"assigned_team_ids": 1, "updates_bucketed": 1, kind: 1},
+        )
         if not wo:
             return jsonify({"detail": "Not found"}), 404
         if not _can_access_wo(u, wo):
             return jsonify({"detail": "Forbidden"}), 403
 
-        cur_status = (norm(wo.get("status")) or "").upper()
+        if wo.get("updates_bucketed"):
+            items, next_before = buckets.read_page(reader, wo_id, kind, limit, before)
+        else:
+            entries = wo.get(kind) or []
+            end = min(int(before[1]), len(entries)) if before else len(entries)
+            start = max(0, end - limit)
+            items = list(reversed(entries[start:end]))
+            next_before = ["", start] if start > 0 else None
 
-        if cur_status == "COMPLETED":
-            return jsonify({"detail": "Already completed"}), 400
+        if kind == "work_updates":
+            items = [with_media_urls(up) for up in items]
+        return jsonify({"items": items, "next_cursor": encode_token(next_before) if next_before else None})
+
+    # ==========================================================
+    # NEW: ACCEPTED -> IN_PROGRESS (used by dropdown)
+    # ==========================================================
+    @app.post("/mobile/workorders/<wo_id>/in-progress")
+    @require_auth
+    def mark_in_progress(wo_id):
+        body, code = _start_action(request.user, wo_id)
+        return jsonify(body), code
+
+    # Shared by submit_work and the batch replay: returns (body, status code). images/voice
+    # are multipart files; upload_ids reference finished resumable uploads. update_id is
+    # fixed by the caller for keyed (idempotent) requests.
+    def _submit(u, wo_id, note, status_in, images, voice, upload_ids, update_id=None):
+        admin = is_admin(u)
+        # Checked before the workorder state: a keyed retry of a completing submit would
+        # otherwise get "Already completed".
+        if update_id and workflow.has_update(workorders, wo_id, update_id):
+            return _duplicate(wo_id, update_id, upload_ids)
+        try:
+            workflow.check_submit(workorders, u, wo_id, admin)
+        except workflow.TransitionError as te:
+            return {"detail": te.detail}, te.status_code
 
-        # Allowed transitions:
-        # ACCEPTED -> IN_PROGRESS
-        # IN_PROGRESS -> IN_PROGRESS (idempotent)
-        if cur_status not in ("ACCEPTED", "IN_PROGRESS"):
-            return jsonify({"detail": f"Cannot start work from status: {cur_status}"}), 400
+        target_status = (status_in or "IN_PROGRESS").upper()
+        if target_status not in ("IN_PROGRESS", "COMPLETED"):
+            return {"detail": "Invalid status. Use IN_PROGRESS or COMPLETED"}, 400
 
-        now = utcnow()
-        hist = wo.get("history") or []
+        update_id = update_id or new_id()
+        try:
+            staged = claim_uploads(upload_sessions, u.get("_id"), upload_ids, update_id)
+        except ValueError as ve:
+            return {"detail": str(ve)}, 400
+        staged_ids = [sess["_id"] for sess, _ in staged]
+        staged_images = [x for x in staged if x[0].get("kind") == "image"]
+        staged_voice = [x for x in staged if x[0].get("kind") == "voice"]
+
+        # Until the update is stored, any failure hands the uploads back and releases the
+        # blob references taken so far.
+        taken = set()
+        saved = []
+        try:
+            if len(images) + len(staged_images) > _MAX_IMAGES:
+                raise ValueError(f"max {_MAX_IMAGES} images")
+            if len(staged_voice) + (1 if voice else 0) > 1:
+                raise ValueError("max 1 voice")
+            if not note and not images and not voice and not staged:
+                raise ValueError("Provide note, images, or voice")
+
+            images = [f for f in images if f and (f.filename or "").strip()]
+            if voice and not (voice.filename or "").strip():
+                voice = None
+            for f in images:
+                clean_filename(f.filename, f.mimetype, "image")
+            if voice:
+                clean_filename(voice.filename, voice.mimetype, "voice")
 
-        if cur_status != "IN_PROGRESS":
-            hist.append({
+            for f in images:
+                saved.append(_save_file(f, wo_id, update_id, "image", taken))
+            for sess, path in staged_images:
+                saved.append(_save_staged(sess, path, wo_id, update_id, taken))
+            imgs_meta = list(saved)
+            voice_meta = None
+            if voice:
+                voice_meta = _save_file(voice, wo_id, update_id, "voice", taken)
+                saved.append(voice_meta)
+            for sess, path in staged_voice:
+                voice_meta = _save_staged(sess, path, wo_id, update_id, taken)
+                saved.append(voice_meta)
+
+            now = utcnow()
+            update_doc = {
+                "id": update_id,
                 "at": now.isoformat(),
                 "by": u.get("_id"),
-                "action": "MOBILE_START_WORK",
-                "status": "IN_PROGRESS"
-            })
-
-            patch = {
-                "status": "IN_PROGRESS",
-                "in_progress_by": u.get("_id"),
-                "in_progress_at": now,
-                "history": hist,
-                "updated_at": now,
+                "message": note or "",
+                "images": [m for m in imgs_meta if m],
+                "voice": voice_meta,
+                "source": "MOBILE",
+                "status": target_status,  # optional per-update status trace
             }
-            workorders.update_one({"_id": wo_id}, {"$set": patch})
-
-        return jsonify({"ok": True, "id": wo_id, "status": "IN_PROGRESS"})
-
+            d = workflow.submit(workorders, u, wo_id, update_doc, target_status, admin=admin, now=now)
+        except workflow.AlreadyApplied:
+            blob_store.release_all(saved)
+            return _duplicate(wo_id, update_id, staged_ids)
+        except workflow.TransitionError as te:
+            _unclaim(saved, staged_ids, update_id)
+            return {"detail": te.detail}, te.status_code
+        except ValueError as ve:
+            _unclaim(saved, staged_ids, update_id)
+            return {"detail": str(ve)}, 400
+        except BaseException:
+            _unclaim(saved, staged_ids, update_id)
+            raise
+        derivatives.schedule(blob_store, workorders, wo_id, update_id, imgs_meta)
+        if staged:
+            mark_used(upload_sessions, staged_ids, wo_id, update_id)
+        return {"ok": True, "update": update_doc, "status": d.get("status")}, 200
+
+    def _unclaim(saved, staged_ids, update_id):
+        blob_store.release_all(saved)
+        release_uploads(upload_sessions, staged_ids, update_id)
+
+    # A replay of an update that was stored before the response got lost. The stored update
+    # took its blob references before the transition; uploads it claimed are marked used
+    # here in case the first attempt stopped before doing so.
+    def _duplicate(wo_id, update_id, upload_ids):
+        if upload_ids:
+            mark_used(upload_sessions, upload_ids, wo_id, update_id)
+        return {"ok": True, "update": {"id": update_id}, "duplicate": True}, 200
+
+    def _present(body):
+        if body.get("update") and "at" in body["update"]:
+            return {**body, "update": with_media_urls(body["update"])}
+        return body
+
+    # Optional `Idempotency-Key` header: a retried submit returns the first response
+    # instead of appending a second work_updates entry.
     @app.post("/mobile/workorders/<wo_id>/submit")
     @require_auth
     def submit_work(wo_id):
         u = request.user
-        wo = workorders.find_one({"_id": wo_id, "is_deleted": {"$ne": True}})
-        if not wo:
-            return jsonify({"detail": "Not found"}), 404
-        if not _can_access_wo(u, wo):
-            return jsonify({"detail": "Forbidden"}), 403
-
         note = norm(request.form.get("note"))
         status_in = norm(request.form.get("status"))
-        target_status = (status_in or "IN_PROGRESS").upper()
-
-        if target_status not in ("IN_PROGRESS", "COMPLETED"):
-            return jsonify({"detail": "Invalid status. Use IN_PROGRESS or COMPLETED"}), 400
-
-        cur_status = (wo.get("status") or "").upper()
-        if cur_status == "COMPLETED":
-            return jsonify({"detail": "Already completed"}), 400
-
         images = request.files.getlist("images") or []
         voice = request.files.get("voice")
+        # Files sent earlier through the resumable upload API, referenced by id.
+        upload_ids = [x.strip() for v in request.form.getlist("upload_ids") for x in v.split(",") if x.strip()]
+
+        key = request.headers.get("Idempotency-Key")
+        if key is None:
+            body, code = _submit(u, wo_id, note, status_in, images, voice, upload_ids)
+            return jsonify(_present(body)), code
+
+        # Files are fingerprinted by name and type; their bytes are only read when the key is new.
+        fp = idempotency.fingerprint({
+            "type": "submit",
+            "wo_id": wo_id,
+            "note": note,
+            "status": status_in,
+            "upload_ids": upload_ids,
+            "files": [(f.filename, f.mimetype) for f in images + ([voice] if voice else []) if f],
+        })
+        try:
+            key = idempotency.check_key(key)
+            stored = idempotency.begin(idempotency_keys, u.get("_id"), key, fp)
+        except idempotency.IdempotencyError as ie:
+            return jsonify({"detail": ie.detail}), ie.status_code
+        if stored:
+            resp = jsonify(_present(stored["body"]))
+            resp.headers["Idempotent-Replayed"] = "true"
+            return resp, stored["status_code"]
+        try:
+            body, code = _submit(
+                u, wo_id, note, status_in, images, voice, upload_ids,
+                update_id=idempotency.derived_id(u.get("_id"), key),
+            )
+        except Exception:
+            idempotency.abandon(idempotency_keys, u.get("_id"), key)
+            raise
+        idempotency.finish(idempotency_keys, u.get("_id"), key, code, body)
+        return jsonify(_present(body)), code
+
+    def _accept_action(u, wo_id):
+        try:
+            d = workflow.accept(workorders, u, wo_id)
+        except workflow.TransitionError as te:
+            return {"detail": te.detail}, te.status_code
+        return {"ok": True, "id": wo_id, "status": d.get("status")}, 200
 
-        if len(images) > _MAX_IMAGES:
-            return jsonify({"detail": f"max {_MAX_IMAGES} images"}), 400
-        if not note and not images and not voice:
-            return jsonify({"detail": "Provide note, images, or voice"}), 400
-
-        update_id = new_id()
-        update_dir = wo_upload_root / wo_id / update_id
-
-        imgs_meta = []
+    def _start_action(u, wo_id):
         try:
-            for f in images:
-                if not f or not (f.filename or "").strip():
-                    continue
-                imgs_meta.append(_save_file(f, update_dir, "image"))
-            voice_meta = None
-            if voice and (voice.filename or "").strip():
-                voice_meta = _save_file(voice, update_dir, "voice")
-        except ValueError as ve:
+            d = workflow.start(workorders, u, wo_id, admin=is_admin(u))
+        except workflow.TransitionError as te:
+            return {"detail": te.detail}, te.status_code
+        return {"ok": True, "id": wo_id, "status": d.get("status") or "IN_PROGRESS"}, 200
+
+    def _run_action(u, action, key):
+        kind = norm(action.get("type")).lower()
+        wo_id = norm(action.get("wo_id"))
+        if not wo_id:
+            return {"detail": "wo_id required"}, 400
+        if kind == "accept":
+            return _accept_action(u, wo_id)
+        if kind == "start":
+            return _start_action(u, wo_id)
+        if kind == "submit":
+            upload_ids = action.get("upload_ids") or []
+            if not isinstance(upload_ids, list):
+                return {"detail": "upload_ids must be a list"}, 400
+            return _submit(
+                u, wo_id, norm(action.get("note")), norm(action.get("status")), [], None,
+                [norm(x) for x in upload_ids if norm(x)],
+                update_id=idempotency.derived_id(u.get("_id"), key),
+            )
+        return {"detail": "type must be accept, start or submit"}, 400
+
+    # Offline replay: {"actions": [{"key", "type": accept|start|submit, "wo_id", note?, status?,
+    # upload_ids?}, ...]}. Actions run in order with the same rules as the single endpoints
+    # (photos/voice go through /mobile/uploads first). Every action needs a client-generated
+    # key; retrying a batch returns the stored result for keys that already ran.
+    @app.post("/mobile/actions")
+    @require_auth
+    def replay_actions():
+        u = request.user
+        data = request.get_json(force=True) or {}
+        actions = data.get("actions")
+        if not isinstance(actions, list) or not actions:
+            return jsonify({"detail": "actions must be a non-empty list"}), 400
+        if len(actions) > _MAX_BATCH_ACTIONS:
+            return jsonify({"detail": f"max {_MAX_BATCH_ACTIONS} actions per batch"}), 400
+
+        results = []
+        for action in actions:
+            if not isinstance(action, dict):
+                results.append({"status_code": 400, "detail": "action must be an object"})
+                continue
+            head = {"key": action.get("key"), "type": action.get("type"), "wo_id": action.get("wo_id")}
+            try:
+                key = idempotency.check_key(action.get("key"))
+                fp = idempotency.fingerprint({k: v for k, v in action.items() if k != "key"})
+                stored = idempotency.begin(idempotency_keys, u.get("_id"), key, fp)
+            except idempotency.IdempotencyError as ie:
+                results.append({**head, "status_code": ie.status_code, "detail": ie.detail})
+                continue
+            if stored:
+                results.append({**head, **_present(stored["body"]), "status_code": stored["status_code"], "replayed": True})
+                continue
             try:
-                if update_dir.exists():
-                    for p in update_dir.glob("*"):
-                        p.unlink(missing_ok=True)
-                    update_dir.rmdir()
+                body, code = _run_action(u, action, key)
             except Exception:
-                pass
-            return jsonify({"detail": str(ve)}), 400
-
-        now = utcnow()
-        updates = wo.get("work_updates") or []
-        update_doc = {
-            "id": update_id,
-            "at": now.isoformat(),
-            "by": u.get("_id"),
-            "message": note or "",
-            "images": [m for m in imgs_meta if m],
-            "voice": voice_meta,
-            "source": "MOBILE",
-            "status": target_status,  # optional per-update status trace
-        }
-        updates.append(update_doc)
-
-        hist = wo.get("history") or []
-        hist.append({
-            "at": now.isoformat(),
-            "by": u.get("_id"),
-            "action": "MOBILE_SUBMIT",
-            "status": target_status
-        })
-
-        patch = {
-            "work_updates": updates,
-            "history": hist,
-            "status": target_status,
-            "updated_at": now,
-        }
-
-        if target_status == "COMPLETED":
-            patch.update({
-                "completed_by": u.get("_id"),
-                "completed_at": now,
-            })
-
-        workorders.update_one({"_id": wo_id}, {"$set": patch})
-        return jsonify({"ok": True, "update": update_doc, "status": target_status})
+                idempotency.abandon(idempotency_keys, u.get("_id"), key)
+                raise
+            idempotency.finish(idempotency_keys, u.get("_id"), key, code, body)
+            results.append({**head, **_present(body), "status_code": code})
+        return jsonify({"results": results})
 
     @app.get("/mobile/achievement")
-    @require_auth
+    @require_auth_read
     def achievement():
         u = request.user
         user_id = norm(request.args.get("user_id"))
         target_uid = u.get("_id")
-        if user_id and _is_admin(u):
+        if user_id and is_admin(u):
             target_uid = user_id
 
         now = utcnow()
-        d7 = now - timedelta(days=7)
-        d30 = now - timedelta(days=30)
-
-        total_assigned = workorders.count_documents({"is_deleted": {"$ne": True}, "assigned_team_ids": target_uid})
-        total_completed = workorders.count_documents({"is_deleted": {"$ne": True}, "completed_by": target_uid})
-        completed_7d = workorders.count_documents({"is_deleted": {"$ne": True}, "completed_by": target_uid, "completed_at": {"$gte": d7}})
-        completed_30d = workorders.count_documents({"is_deleted": {"$ne": True}, "completed_by": target_uid, "completed_at": {"$gte": d30}})
-        active = workorders.count_documents({"is_deleted": {"$ne": True}, "assigned_team_ids": target_uid, "status": {"$in": ["ASSIGNED", "ACCEPTED", "IN_PROGRESS"]}})
-
-        cur = workorders.find({"is_deleted": {"$ne": True}, "completed_by": target_uid}).sort("completed_at", -1).limit(60)
-        recent = []
-        for d in cur:
-            recent.append({
-                "id": d.get("_id"),
-                "wo_no": d.get("wo_no"),
-                "customer_name": d.get("customer_name"),
-                "completed_at": d.get("completed_at").isoformat() if d.get("completed_at") else None,
-                "location": d.get("location") or None,
-                "status": d.get("status"),
-            })
+        st = stats.get(_reader("achievement"), target_uid, now)
+        total_assigned = st.get("assigned_total") or 0
+        total_completed = st.get("completed_total") or 0
+        active = st.get("active") or 0
+        completed_7d = stats.completed_in(st, 7, now)
+        completed_30d = stats.completed_in(st, 30, now)
+
+        recent = st.get("recent") or []
+        # completed_7d/30d depend on the day as well as on the stored counters. The timeline
+        # is hashed whole: its entries also carry wo_no, customer_name and location.
+        etag = weak_etag(
+            target_uid, now.date(), total_assigned, total_completed, active, completed_7d, completed_30d, recent,
+        )
+        resp = not_modified(etag)
+        if resp:
+            return resp
 
         badges = []
         if total_completed >= 1:
@@ -303,7 +831,7 @@ def register_mobile_routes(app, workorders, users, require_auth):
         if completed_7d >= 5:
             badges.append({"key": "week5", "title": "On Fire", "hint": "5 works in last 7 days"})
 
-        return jsonify({
+        return with_validators(jsonify({
             "user_id": target_uid,
             "totals": {
                 "assigned": total_assigned,
@@ -314,4 +842,55 @@ def register_mobile_routes(app, workorders, users, require_auth):
             },
             "badges": badges,
             "timeline": recent,
-        })
\ No newline at end of file
+        }), etag)
+
+    def _iso(v):
+        return v.isoformat() if v else None
+
+    def _team_stats(uids):
+        now = utcnow()
+        ufilt = {"is_deleted": {"$ne": True}}
+        ufilt.update({"_id": {"$in": list(uids)}} if uids else {"role": "MOBILE_USER"})
+        members = list(users.find(ufilt, {"username": 1, "full_name": 1, "role": 1, "is_active": 1}))
+        ids = [m["_id"] for m in members]
+
+        reader = _reader("team_stats")
+        facets = (list(reader.aggregate(team_stats_pipeline(ids, now))) or [{}])[0]
+        assigned = {r["_id"]: r for r in facets.get("assigned") or []}
+        completed = {r["_id"]: r for r in facets.get("completed") or []}
+        activity = {
+            r["_id"]: r.get("last_activity_at")
+            for r in stats.collection(reader).find({"_id": {"$in": ids}}, {"last_activity_at": 1})
+        }
+
+        rows = []
+        for m in members:
+            a = assigned.get(m["_id"]) or {}
+            c = completed.get(m["_id"]) or {}
+            rows.append({
+                "user_id": m["_id"],
+                "username": m.get("username"),
+                "full_name": m.get("full_name"),
+                "is_active": m.get("is_active", True),
+                "assigned": a.get("assigned", 0),
+                "active": a.get("active", 0),
+                "completed": c.get("completed", 0),
+                "completed_7d": c.get("completed_7d", 0),
+                "completed_30d": c.get("completed_30d", 0),
+                "last_completed_at": _iso(c.get("last_completed_at")),
+                "last_updated_at": _iso(a.get("last_updated_at")),
+                "last_activity_at": _iso(activity.get(m["_id"])),
+            })
+        rows.sort(key=lambda r: (-r["completed_30d"], -r["completed"], r["username"] or ""))
+        return {"members": rows, "generated_at": now.isoformat()}
+
+    # Team leaderboard for admins: one aggregation for every member, cached briefly and
+    # refreshed in the background. Defaults to all mobile users; ?user_ids= narrows it.
+    @app.get("/mobile/team-stats")
+    @require_auth_read
+    def team_stats():
+        u = request.user
+        if not is_admin(u):
+            return jsonify({"detail": "Forbidden"}), 403
+        uids = tuple(sorted({x.strip() for x in norm(request.args.get("user_ids")).split(",") if x.strip()}))
+        return jsonify(_team_cache.get(uids, lambda: _team_stats(uids)))
@@ -0,0 +1,157 @@
+import os
+import gzip
+import json
+import hashlib
+from datetime import date, datetime
+
+from flask import current_app, request
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date, parse_etags, quote_etag
+
+import metrics
+
+try:
+    import orjson
+except ImportError:  # optional; the stdlib encoder produces the same JSON, slower
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # optional; gzip only
+    brotli = None
+
+# Response layer shared by all routes:
+# - JSON: orjson when installed; datetimes are written as ISO 8601 (`.isoformat()`), so
+#   handlers can return them as they come from MongoDB.
+# - Conditional GET: list/detail handlers compute a weak ETag from what the body is built
+#   from (ids, updated_at, counters) and answer a matching If-None-Match with 304 before
+#   building or encoding the body.
+# - Compression: JSON and text bodies above COMPRESS_MIN_BYTES are sent brotli- or
+#   gzip-encoded as the client accepts. The ETag is weak, so it stays valid across encodings.
+
+COMPRESS_ENABLED = os.getenv("COMPRESS_RESPONSES", "1").strip() in ("1", "true", "True")
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "5"))
+# Dynamic responses: a low brotli quality is already smaller than gzip and much faster than 11.
+BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))
+_COMPRESSIBLE = {"application/json", "text/plain"}
+
+# Part of every ETag: bump when a response shape changes so clients refetch.
+ETAG_VERSION = "1"
+
+
+def _default(o):
+    if isinstance(o, (datetime, date)):
+        return o.isoformat()
+    return DefaultJSONProvider.default(o)
+
+
+# JSON body as bytes; also used by asgi.py's native routes.
+def dumps(obj) -> bytes:
+    with metrics.timed("json_encode"):
+        if orjson is None:
+            return json.dumps(obj, default=_default, separators=(",", ":")).encode()
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class JSONProvider(DefaultJSONProvider):
+    default = staticmethod(_default)
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        with metrics.timed("json_encode"):
+            if orjson is None or kwargs:
+                return super().dumps(obj, **kwargs)
+            return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if orjson is None:
+            return super().response(obj)
+        return self._app.response_class(dumps(obj), mimetype=self.mimetype)
+
+
+def weak_etag(*parts) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(ETAG_VERSION.encode())
+    for p in parts:
+        h.update(b"\0")
+        h.update(repr(p).encode())
+    return h.hexdigest()
+
+
+def validator_headers(etag, last_modified=None) -> dict:
+    # Cacheable by the client only, and always revalidated.
+    headers = {"ETag": quote_etag(etag, weak=True), "Cache-Control": "private, no-cache"}
+    if last_modified:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
+
+
+def with_validators(resp, etag, last_modified=None):
+    resp.headers.update(validator_headers(etag, last_modified))
+    return resp
+
+
+# Only If-None-Match is honoured: a Last-Modified date cannot tell that an item left the result set.
+def etag_matches(if_none_match, etag) -> bool:
+    return bool(if_none_match) and parse_etags(if_none_match).contains_weak(etag)
+
+
+# 304 response when the client already has this version, else None.
+def not_modified(etag, last_modified=None):
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return with_validators(current_app.response_class(status=304), etag, last_modified)
+    return None
+
+
+def _choose_encoding(accept):
+    if brotli is not None and accept["br"]:
+        return "br"
+    if accept["gzip"]:
+        return "gzip"
+    return None
+
+
+# (body, Content-Encoding or None) for a compressible body; `accept` is the parsed
+# Accept-Encoding header (werkzeug Accept).
+def compress(body: bytes, accept):
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    encoding = _choose_encoding(accept)
+    if not encoding:
+        return body, None
+    with metrics.timed("compress"):
+        if encoding == "br":
+            return brotli.compress(body, quality=BROTLI_QUALITY), encoding
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0), encoding
+
+
+def _compress(resp):
+    if (
+        resp.direct_passthrough
+        or resp.is_streamed
+        or resp.status_code < 200
+        or resp.status_code in (204, 206, 304)
+        or resp.mimetype not in _COMPRESSIBLE
+        or "Content-Encoding" in resp.headers
+    ):
+        return resp
+    resp.vary.add("Accept-Encoding")
+    data, encoding = compress(resp.get_data(), request.accept_encodings)
+    if not encoding:
+        return resp
+    resp.set_data(data)
+    resp.headers["Content-Encoding"] = encoding
+    return resp
+
+
+def register_responses(app):
+    app.json = JSONProvider(app)
+    if COMPRESS_ENABLED:
+        app.after_request(_compress)
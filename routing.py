@@ -0,0 +1,77 @@
+import os
+import time
+
+import numpy as np
+
+# Visiting order for a technician's day: an open path (no return to the start) over the
+# given stops, built nearest-neighbour first and then improved with 2-opt until no
+# reversal shortens it or ROUTE_2OPT_SECONDS runs out. Distances are great-circle
+# (haversine) metres, computed for all pairs at once.
+
+EARTH_RADIUS_M = 6371008.8
+TWO_OPT_SECONDS = float(os.getenv("ROUTE_2OPT_SECONDS", "0.5"))
+
+
+def distance_matrix(lat, lng) -> np.ndarray:
+    la = np.radians(np.asarray(lat, dtype=float))
+    lo = np.radians(np.asarray(lng, dtype=float))
+    dlat = la[:, None] - la[None, :]
+    dlng = lo[:, None] - lo[None, :]
+    a = np.sin(dlat / 2) ** 2 + np.cos(la)[:, None] * np.cos(la)[None, :] * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def nearest_neighbour(d: np.ndarray, start: int) -> list:
+    visited = np.zeros(len(d), dtype=bool)
+    visited[start] = True
+    order = [start]
+    cur = start
+    for _ in range(len(d) - 1):
+        cur = int(np.where(visited, np.inf, d[cur]).argmin())
+        visited[cur] = True
+        order.append(cur)
+    return order
+
+
+# 2-opt on a path whose first and last nodes stay fixed. For each i all segment ends k are
+# scored in one vector operation and the best improving reversal of order[i..k] is applied.
+def two_opt(d: np.ndarray, order: list, deadline: float) -> list:
+    o = np.asarray(order)
+    n = len(o)
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for i in range(1, n - 2):
+            a, b = o[i - 1], o[i]
+            c, e = o[i + 1:n - 1], o[i + 2:n]
+            delta = d[a, c] + d[b, e] - d[a, b] - d[c, e]
+            j = int(delta.argmin())
+            if delta[j] < -1e-6:
+                o[i:i + j + 2] = o[i:i + j + 2][::-1].copy()
+                improved = True
+            if time.monotonic() >= deadline:
+                break
+    return o.tolist()
+
+
+# points: [(lat, lng)]; start: (lat, lng) or None. Returns (order of point indices,
+# metres from the previous stop (or start) for each of them).
+def plan(points, start=None, seconds=TWO_OPT_SECONDS):
+    if not points:
+        return [], []
+    nodes = ([start] if start else []) + list(points)
+    d = distance_matrix([p[0] for p in nodes], [p[1] for p in nodes])
+    m = len(d)
+    # Without a start, begin at the outermost stop (largest total distance to the others).
+    first = 0 if start else int(d.sum(axis=1).argmax())
+    order = nearest_neighbour(d, first)
+    # A dummy end node at distance 0 from every stop turns the open path into one with
+    # fixed ends, so the last real stop is free to change.
+    padded = np.zeros((m + 1, m + 1))
+    padded[:m, :m] = d
+    order = two_opt(padded, order + [m], time.monotonic() + seconds)[:-1]
+
+    legs = [0.0] + [float(d[p, q]) for p, q in zip(order, order[1:])]
+    if start:
+        return [i - 1 for i in order[1:]], legs[1:]
+    return order, legs
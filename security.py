@@ -1,13 +1,47 @@
 import os
+import hmac
+import hashlib
 import bcrypt
 import jwt
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 
 def _now():
     return datetime.now(timezone.utc)
 
-def hash_password(password: str) -> str:
-    salt = bcrypt.gensalt(rounds=12)
+# Secrets are read once per process (after load_dotenv) instead of on every encode/decode.
+@lru_cache(maxsize=None)
+def _secret(name: str, default: str) -> str:
+    return os.getenv(name, default)
+
+def _access_secret():
+    return _secret("ACCESS_TOKEN_SECRET", "change_me_access_secret_please")
+
+def _refresh_secret():
+    return _secret("REFRESH_TOKEN_SECRET", "change_me_refresh_secret_please")
+
+def _media_secret():
+    return _secret("MEDIA_URL_SECRET", "") or _access_secret()
+
+def _epoch(dt):
+    if not dt or not isinstance(dt, datetime):
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+def from_epoch(v):
+    if v is None:
+        return None
+    try:
+        return datetime.fromtimestamp(int(v), tz=timezone.utc)
+    except Exception:
+        return None
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+def hash_password(password: str, rounds: int = None) -> str:
+    salt = bcrypt.gensalt(rounds=rounds or BCRYPT_ROUNDS)
     hashed = bcrypt.hashpw(password.encode("utf-8"), salt)
     return hashed.decode("utf-8")
 
@@ -17,36 +51,84 @@ def verify_password(password: str, password_hash: str) -> bool:
     except Exception:
         return False
 
-def create_access_token(user_id: str, username: str, role: str, minutes: int) -> str:
-    secret = os.getenv("ACCESS_TOKEN_SECRET", "change_me_access_secret_please")
+# Cost factor of a "$2b$12$..." hash (None when it is not a bcrypt hash).
+def hash_rounds(password_hash: str):
+    try:
+        return int((password_hash or "").split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+def create_access_token(
+    user_id: str,
+    username: str,
+    role: str,
+    minutes: int,
+    token_version: int = 0,
+    is_active: bool = True,
+    subscription_start: datetime = None,
+    subscription_end: datetime = None,
+) -> str:
     exp = _now() + timedelta(minutes=minutes)
     payload = {
         "sub": user_id,
         "username": username,
         "role": role,
         "type": "access",
+        "tv": int(token_version or 0),
+        "act": bool(is_active),
+        "sst": _epoch(subscription_start),
+        "sen": _epoch(subscription_end),
         "iat": int(_now().timestamp()),
         "exp": int(exp.timestamp()),
     }
-    return jwt.encode(payload, secret, algorithm="HS256")
+    return jwt.encode(payload, _access_secret(), algorithm="HS256")
 
-def create_refresh_token(user_id: str, days: int) -> str:
-    secret = os.getenv("REFRESH_TOKEN_SECRET", "change_me_refresh_secret_please")
+# sid/jti tie the token to a server-side session (auth_sessions) and its current rotation.
+def create_refresh_token(user_id: str, days: int, session_id: str = None, jti: str = None) -> str:
     exp = _now() + timedelta(days=days)
     payload = {
         "sub": user_id,
         "type": "refresh",
+        "sid": session_id,
+        "jti": jti,
         "iat": int(_now().timestamp()),
         "exp": int(exp.timestamp()),
     }
-    return jwt.encode(payload, secret, algorithm="HS256")
+    return jwt.encode(payload, _refresh_secret(), algorithm="HS256")
+
+def decode_refresh_token(token: str):
+    if not token:
+        return None
+    try:
+        payload = jwt.decode(token, _refresh_secret(), algorithms=["HS256"])
+        if payload.get("type") != "refresh" or not payload.get("sid") or not payload.get("jti"):
+            return None
+        return payload
+    except Exception:
+        return None
 
 def decode_access_token(token: str):
-    secret = os.getenv("ACCESS_TOKEN_SECRET", "change_me_access_secret_please")
+    if not token:
+        return None
     try:
-        payload = jwt.decode(token, secret, algorithms=["HS256"])
+        payload = jwt.decode(token, _access_secret(), algorithms=["HS256"])
         if payload.get("type") != "access":
             return None
         return payload
     except Exception:
         return None
+
+# Signed media URLs: an HMAC over the upload path, its sha256 and the expiry, so a media
+# fetch can be authorized without a token check or a workorder lookup.
+def sign_media(path: str, sha256: str, exp: int) -> str:
+    msg = f"{path}|{sha256}|{int(exp)}".encode("utf-8")
+    return hmac.new(_media_secret().encode("utf-8"), msg, hashlib.sha256).hexdigest()[:32]
+
+def verify_media(path: str, sha256: str, exp, sig: str) -> bool:
+    try:
+        exp = int(exp)
+    except (TypeError, ValueError):
+        return False
+    if exp < int(_now().timestamp()):
+        return False
+    return hmac.compare_digest(sign_media(path, sha256, exp), sig or "")
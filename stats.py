@@ -0,0 +1,133 @@
+import os
+from datetime import timedelta
+
+from util import utcnow, naive_utc
+
+# Per-user achievement rollups (user_stats collection, _id = user id).
+#
+# Completion figures are maintained incrementally by the workflow transitions:
+# completed_total, completed_days ({"YYYY-MM-DD": n}, daily buckets) and recent (the
+# 60 latest completions, newest first). assigned_total and active depend on
+# assignments made by the desktop backend, so they are recounted when older than
+# STATS_COUNTS_TTL_SECONDS or after an accept. `python manage.py rebuild-stats`
+# recomputes everything from workorders (e.g. after completions made on desktop).
+
+COUNTS_TTL_SECONDS = int(os.getenv("STATS_COUNTS_TTL_SECONDS", "300"))
+RECENT_LIMIT = 60
+DAYS_KEPT = 31
+
+ACTIVE_STATUSES = ["ASSIGNED", "ACCEPTED", "IN_PROGRESS"]
+
+
+def collection(workorders):
+    # Inherit the caller's read preference (see db.for_route).
+    return workorders.database.get_collection("user_stats", read_preference=workorders.read_preference)
+
+
+def _day(dt) -> str:
+    return naive_utc(dt).strftime("%Y-%m-%d")
+
+
+def recent_entry(d: dict) -> dict:
+    return {
+        "id": d.get("_id"),
+        "wo_no": d.get("wo_no"),
+        "customer_name": d.get("customer_name"),
+        "completed_at": d.get("completed_at"),
+        "location": d.get("location") or None,
+        "status": d.get("status"),
+    }
+
+
+def _update(workorders, uid, update):
+    # Stats are derived data; a failed write must never fail the transition itself.
+    try:
+        collection(workorders).update_one({"_id": uid}, update, upsert=True)
+    except Exception:
+        pass
+
+
+def record_activity(workorders, uid, now=None):
+    _update(workorders, uid, {"$set": {"last_activity_at": now or utcnow()}})
+
+
+def record_accept(workorders, uid, now=None):
+    # DRAFT -> ACCEPTED changes the active count; let the next read recount it.
+    _update(workorders, uid, {"$set": {"last_activity_at": now or utcnow(), "counts_at": None}})
+
+
+def record_completion(workorders, uid, wo: dict, now=None):
+    now = now or utcnow()
+    _update(workorders, uid, {
+        "$inc": {"completed_total": 1, f"completed_days.{_day(now)}": 1},
+        "$push": {"recent": {"$each": [recent_entry(wo)], "$position": 0, "$slice": RECENT_LIMIT}},
+        "$set": {"last_activity_at": now, "counts_at": None},
+    })
+
+
+def _counts(workorders, uid) -> dict:
+    return {
+        "assigned_total": workorders.count_documents({"is_deleted": {"$ne": True}, "assigned_team_ids": uid}),
+        "active": workorders.count_documents({
+            "is_deleted": {"$ne": True},
+            "assigned_team_ids": uid,
+            "status": {"$in": ACTIVE_STATUSES},
+        }),
+    }
+
+
+def rebuild_user(workorders, uid, now=None) -> dict:
+    now = now or utcnow()
+    since = now - timedelta(days=DAYS_KEPT)
+    base = {"is_deleted": {"$ne": True}, "completed_by": uid}
+
+    days = {}
+    for row in workorders.aggregate([
+        {"$match": {**base, "completed_at": {"$gte": since}}},
+        {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$completed_at"}}, "n": {"$sum": 1}}},
+    ]):
+        days[row["_id"]] = row["n"]
+
+    proj = {"wo_no": 1, "customer_name": 1, "completed_at": 1, "location": 1, "status": 1}
+    recent = [recent_entry(d) for d in workorders.find(base, proj).sort("completed_at", -1).limit(RECENT_LIMIT)]
+
+    doc = {
+        "_id": uid,
+        "completed_total": workorders.count_documents(base),
+        "completed_days": days,
+        "recent": recent,
+        **_counts(workorders, uid),
+        "counts_at": now,
+        "rebuilt_at": now,
+    }
+    prev = collection(workorders).find_one({"_id": uid}, {"last_activity_at": 1}) or {}
+    if prev.get("last_activity_at"):
+        doc["last_activity_at"] = prev["last_activity_at"]
+    collection(workorders).replace_one({"_id": uid}, doc, upsert=True)
+    return doc
+
+
+def get(workorders, uid, now=None) -> dict:
+    now = now or utcnow()
+    coll = collection(workorders)
+    doc = coll.find_one({"_id": uid})
+    if not doc or not doc.get("rebuilt_at"):
+        return rebuild_user(workorders, uid, now)
+
+    counts_at = doc.get("counts_at")
+    if not counts_at or naive_utc(counts_at) < naive_utc(now) - timedelta(seconds=COUNTS_TTL_SECONDS):
+        counts = _counts(workorders, uid)
+        coll.update_one({"_id": uid}, {"$set": {**counts, "counts_at": now}})
+        doc.update(counts)
+
+    oldest = _day(now - timedelta(days=DAYS_KEPT))
+    stale_days = [k for k in (doc.get("completed_days") or {}) if k < oldest]
+    if stale_days:
+        coll.update_one({"_id": uid}, {"$unset": {f"completed_days.{k}": "" for k in stale_days}})
+    return doc
+
+
+# Completions in the last `days` calendar days, today included.
+def completed_in(doc: dict, days: int, now=None) -> int:
+    first = _day((now or utcnow()) - timedelta(days=days - 1))
+    return sum(n for k, n in (doc.get("completed_days") or {}).items() if k >= first)
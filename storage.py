@@ -0,0 +1,224 @@
+import os
+import base64
+import shutil
+from pathlib import Path
+
+from flask import Response, send_file, redirect
+
+# Where upload blobs live. Keys are "<aa>/<bb>/<sha256>" (see blobstore.py).
+#   STORAGE_BACKEND=local (default): files under UPLOAD_ROOT/blobs, streamed by the workers.
+#   STORAGE_BACKEND=s3: an S3-compatible bucket (AWS, MinIO). Downloads redirect to a
+#   presigned GET and clients can PUT new media straight to the bucket, so large bodies
+#   never occupy a worker thread. Needs `pip install boto3`.
+
+PRESIGN_SECONDS = int(os.getenv("S3_PRESIGN_SECONDS", "300"))
+
+# Blobs never change once written (the key is their sha256).
+IMMUTABLE = "private, max-age=31536000, immutable"
+
+# Local backend only: let the front proxy ship the bytes.
+#   MEDIA_ACCEL=nginx    -> X-Accel-Redirect: <MEDIA_ACCEL_PREFIX><key> (an `internal` nginx location)
+#   MEDIA_ACCEL=sendfile -> X-Sendfile: <absolute path> (Apache mod_xsendfile, lighttpd)
+MEDIA_ACCEL = os.getenv("MEDIA_ACCEL", "").strip().lower()
+MEDIA_ACCEL_PREFIX = os.getenv("MEDIA_ACCEL_PREFIX", "/_blobs/")
+
+
+class LocalStorage:
+    presigns = False
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key: str) -> Path:
+        return self.root / key
+
+    def exists(self, key: str) -> bool:
+        return self.path(key).exists()
+
+    def size(self, key: str):
+        p = self.path(key)
+        return p.stat().st_size if p.exists() else None
+
+    # Moves a finished temp file into place (the temp file is consumed).
+    def put_path(self, tmp_path: Path, key: str):
+        dest = self.path(key)
+        if dest.exists():
+            tmp_path.unlink(missing_ok=True)
+            return
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, dest)
+
+    # Adds src under key, leaving src in place (hard link when possible).
+    def put_copy(self, src: Path, key: str, tmp_path: Path):
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+        self.put_path(tmp_path, key)
+
+    # Local path of a blob for processing; tmp_path is not needed here.
+    def fetch(self, key: str, tmp_path: Path) -> Path:
+        return self.path(key)
+
+    def delete(self, key: str):
+        self.path(key).unlink(missing_ok=True)
+
+    # (key, size, mtime epoch) of every stored blob.
+    def list(self):
+        for p in self.root.glob("??/??/*"):
+            st = p.stat()
+            yield p.relative_to(self.root).as_posix(), st.st_size, st.st_mtime
+
+    def response(self, key: str, mime: str, download_name: str, etag: str):
+        p = self.path(key)
+        if not p.exists():
+            return None
+        if MEDIA_ACCEL in ("nginx", "sendfile"):
+            resp = Response(mimetype=mime or "application/octet-stream")
+            if MEDIA_ACCEL == "nginx":
+                resp.headers["X-Accel-Redirect"] = f"{MEDIA_ACCEL_PREFIX}{key}"
+            else:
+                resp.headers["X-Sendfile"] = str(p)
+            resp.headers["Content-Disposition"] = f'inline; filename="{download_name}"'
+        else:
+            # conditional=True answers If-None-Match / If-Modified-Since and Range requests.
+            resp = send_file(p, mimetype=mime, download_name=download_name, conditional=True, etag=etag)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = IMMUTABLE
+        return resp
+
+
+class S3Storage:
+    presigns = True
+
+    def __init__(self, make_client, bucket: str, prefix: str = "blobs/", expires: int = PRESIGN_SECONDS):
+        self._make_client = make_client
+        self._client = None
+        self._pid = None
+        self.bucket = bucket
+        self.prefix = prefix
+        self.expires = expires
+
+    # Like db.get_client: one client per process, created after gunicorn forks.
+    @property
+    def client(self):
+        if self._client is None or self._pid != os.getpid():
+            self._client = self._make_client()
+            self._pid = os.getpid()
+        return self._client
+
+    @classmethod
+    def from_env(cls):
+        try:
+            import boto3
+            from botocore.config import Config
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires boto3 (pip install boto3)")
+        bucket = os.getenv("S3_BUCKET")
+        if not bucket:
+            raise RuntimeError("S3_BUCKET missing in environment")
+
+        def make_client():
+            return boto3.client(
+                "s3",
+                endpoint_url=os.getenv("S3_ENDPOINT_URL") or None,
+                region_name=os.getenv("S3_REGION") or None,
+                config=Config(
+                    signature_version="s3v4",
+                    # MinIO and most self-hosted endpoints need path-style addressing.
+                    s3={"addressing_style": os.getenv("S3_ADDRESSING_STYLE", "path")},
+                    max_pool_connections=int(os.getenv("S3_MAX_POOL_CONNECTIONS", "16")),
+                ),
+            )
+
+        return cls(make_client, bucket, os.getenv("S3_PREFIX", "blobs/"))
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    def _head(self, key: str):
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def exists(self, key: str) -> bool:
+        return self._head(key) is not None
+
+    def size(self, key: str):
+        head = self._head(key)
+        return head["ContentLength"] if head else None
+
+    # (size, LastModified) of an object, or None when it is missing.
+    def stat(self, key: str):
+        head = self._head(key)
+        return (head["ContentLength"], head["LastModified"]) if head else None
+
+    def put_path(self, tmp_path: Path, key: str):
+        try:
+            if not self.exists(key):
+                self.client.upload_file(str(tmp_path), self.bucket, self._key(key))
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def put_copy(self, src: Path, key: str, tmp_path: Path):
+        if not self.exists(key):
+            self.client.upload_file(str(src), self.bucket, self._key(key))
+
+    def fetch(self, key: str, tmp_path: Path) -> Path:
+        self.client.download_file(self.bucket, self._key(key), str(tmp_path))
+        return tmp_path
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def list(self):
+        pages = self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=self.prefix)
+        for page in pages:
+            for obj in page.get("Contents") or []:
+                yield obj["Key"][len(self.prefix):], obj["Size"], obj["LastModified"].timestamp()
+
+    # Presigned PUT for a client-side upload. The sha256 is signed into the request, so
+    # S3 rejects a body that does not match it; the client must send `headers` as given.
+    def presign_put(self, key: str, sha256: str, mime: str) -> dict:
+        checksum = base64.b64encode(bytes.fromhex(sha256)).decode()
+        url = self.client.generate_presigned_url(
+            "put_object",
+            Params={"Bucket": self.bucket, "Key": self._key(key), "ContentType": mime, "ChecksumSHA256": checksum},
+            ExpiresIn=self.expires,
+        )
+        return {"url": url, "headers": {"Content-Type": mime, "x-amz-checksum-sha256": checksum}, "expires_in": self.expires}
+
+    def presign_get(self, key: str, mime: str, download_name: str) -> str:
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={
+                "Bucket": self.bucket,
+                "Key": self._key(key),
+                "ResponseContentType": mime or "application/octet-stream",
+                "ResponseContentDisposition": f'inline; filename="{download_name}"',
+                "ResponseCacheControl": IMMUTABLE,
+            },
+            ExpiresIn=self.expires,
+        )
+
+    # The bucket serves Range requests itself.
+    def response(self, key: str, mime: str, download_name: str, etag: str):
+        resp = redirect(self.presign_get(key, mime, download_name), code=302)
+        # The signed URL expires; clients must come back here rather than cache it.
+        resp.headers["Cache-Control"] = "private, no-store"
+        return resp
+
+
+def from_env(local_root: Path):
+    backend = os.getenv("STORAGE_BACKEND", "local").strip().lower()
+    if backend == "s3":
+        return S3Storage.from_env()
+    if backend != "local":
+        raise RuntimeError(f"Unknown STORAGE_BACKEND: {backend}")
+    return LocalStorage(local_root)
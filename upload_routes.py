@@ -0,0 +1,380 @@
+import os
+import re
+import hashlib
+import mimetypes
+import threading
+from pathlib import Path
+from datetime import timedelta
+from flask import request, jsonify
+from pymongo import ReturnDocument
+from werkzeug.utils import secure_filename
+
+from util import utcnow, new_id, norm, naive_utc
+from blobstore import BlobStore
+
+IMG_EXT = {".jpg", ".jpeg", ".png", ".webp"}
+AUD_EXT = {".m4a", ".aac", ".mp3", ".wav", ".ogg"}
+# If you ever record as .mp4 (AAC in mp4 container), then enable this:
+# AUD_EXT = {".m4a", ".aac", ".mp3", ".wav", ".ogg", ".mp4"}
+
+UPLOAD_SESSION_HOURS = int(os.getenv("UPLOAD_SESSION_HOURS", "24"))
+CHUNK_MAX_BYTES = int(os.getenv("UPLOAD_CHUNK_MAX_MB", "8")) * 1024 * 1024
+# A submit claim not finished within this long (the worker died) can be taken over.
+CLAIM_SECONDS = int(os.getenv("UPLOAD_CLAIM_SECONDS", "300"))
+_COPY_BUF = 256 * 1024
+
+_RANGE_RE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+# Incremental sha256 state for uploads whose chunks arrive in order on this worker.
+# A chunk served by another worker drops the entry; finalize then re-hashes the file.
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+
+def clean_filename(filename: str, mimetype: str, kind: str) -> str:
+    name = secure_filename(filename or "")
+    if not name:
+        guessed = mimetypes.guess_extension(mimetype or "") or ""
+        name = f"{kind}{guessed or ''}"
+    ext = Path(name).suffix.lower()
+    if kind == "image" and ext not in IMG_EXT:
+        raise ValueError(f"Invalid image type: {ext}")
+    if kind == "voice" and ext not in AUD_EXT:
+        raise ValueError(f"Invalid audio type: {ext}")
+    return name
+
+
+def sha256_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_COPY_BUF), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+# Session `s` unless it has expired.
+def live_session(s):
+    if s and naive_utc(s.get("expires_at")) and naive_utc(s["expires_at"]) <= naive_utc(utcnow()):
+        return None
+    return s
+
+
+class ChunkError(Exception):
+    def __init__(self, detail: str, status_code: int, offset: int = None):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code
+        self.offset = offset
+
+
+# (start, end) of a chunk PUT to session `s`, from its Content-Range header.
+# Shared with asgi.py's native chunk upload.
+def chunk_range(s, content_range):
+    if s.get("status") != "OPEN":
+        raise ChunkError("Upload already finished", 409)
+    if s.get("direct"):
+        raise ChunkError("Direct upload: PUT the file to the presigned URL", 409)
+    m = _RANGE_RE.match(norm(content_range))
+    if not m:
+        raise ChunkError("Content-Range: bytes <start>-<end>/<size> required", 400)
+    start, end, total = (int(x) for x in m.groups())
+    received = int(s.get("received", 0))
+    if total != s["size"] or end < start or end >= total:
+        raise ChunkError("Invalid range", 416)
+    if start != received:
+        raise ChunkError("Unexpected offset", 409, offset=received)
+    if end - start + 1 > CHUNK_MAX_BYTES:
+        raise ChunkError(f"Chunk too large (max {CHUNK_MAX_BYTES} bytes)", 413)
+    return start, end
+
+
+# Hash state to continue with a chunk starting at `start`; None when the file has to be
+# re-hashed at completion.
+def take_hasher(upload_id, start):
+    with _hashers_lock:
+        state = _hashers.pop(upload_id, None)
+    if state and state[0] == start:
+        return state[1]
+    if start == 0:
+        return hashlib.sha256()
+    return None
+
+
+def keep_hasher(upload_id, offset, hasher):
+    if hasher is not None:
+        with _hashers_lock:
+            _hashers[upload_id] = (offset, hasher)
+
+
+def staging_root() -> Path:
+    return Path(os.getenv("UPLOAD_ROOT", "./uploads")).resolve() / "_staging"
+
+
+def staging_path(upload_id: str) -> Path:
+    return staging_root() / f"{upload_id}.part"
+
+
+# Finished uploads referenced by a submit: [(session, staged path)], in the given order.
+# Direct uploads went straight to the blob store and have no staged path (None).
+# Each upload is claimed for update_id (DONE -> USED) with a compare-and-set, so two
+# concurrent submits can't both attach it; used_at is only set once the update is stored
+# (mark_used). A keyed retry with the same update_id may take over its own claim, and
+# any submit one older than CLAIM_SECONDS. On error the uploads claimed so far are
+# released again.
+def claim_uploads(upload_sessions, uid, upload_ids, update_id):
+    out = []
+    try:
+        for uid_ in upload_ids:
+            now = utcnow()
+            s = upload_sessions.find_one_and_update(
+                {"_id": uid_, "user_id": uid, "$or": [
+                    {"status": "DONE"},
+                    {"status": "USED", "update_id": update_id, "used_at": {"$exists": False}},
+                    {"status": "USED", "used_at": {"$exists": False},
+                     "claimed_at": {"$lt": now - timedelta(seconds=CLAIM_SECONDS)}},
+                ]},
+                {"$set": {"status": "USED", "update_id": update_id, "claimed_at": now}},
+                return_document=ReturnDocument.AFTER,
+            )
+            if not s:
+                s = upload_sessions.find_one({"_id": uid_, "user_id": uid}, {"status": 1})
+                if not s:
+                    raise ValueError(f"Unknown upload: {uid_}")
+                if s.get("status") == "USED":
+                    raise ValueError(f"Upload already used: {uid_}")
+                raise ValueError(f"Upload not finished: {uid_}")
+            if s.get("direct"):
+                out.append((s, None))
+                continue
+            path = staging_path(uid_)
+            out.append((s, path))
+            if not path.exists():
+                raise ValueError(f"Upload expired: {uid_}")
+    except ValueError:
+        release_uploads(upload_sessions, [s["_id"] for s, _ in out], update_id)
+        raise
+    return out
+
+
+# Undoes claim_uploads when the submit fails, so the client can retry with the same uploads.
+def release_uploads(upload_sessions, upload_ids, update_id):
+    if not upload_ids:
+        return
+    upload_sessions.update_many(
+        {"_id": {"$in": list(upload_ids)}, "status": "USED", "update_id": update_id, "used_at": {"$exists": False}},
+        {"$set": {"status": "DONE"}, "$unset": {"update_id": "", "claimed_at": ""}},
+    )
+
+
+# Finishes the uploads claimed for update_id once it is stored. Safe to repeat.
+def mark_used(upload_sessions, upload_ids, wo_id, update_id):
+    filt = {"_id": {"$in": list(upload_ids)}, "update_id": update_id}
+    mine = [s["_id"] for s in upload_sessions.find(filt, {"_id": 1})]
+    if not mine:
+        return
+    upload_sessions.update_many(
+        {**filt, "used_at": {"$exists": False}},
+        {"$set": {"status": "USED", "wo_id": wo_id, "used_at": utcnow()}},
+    )
+    for upload_id in mine:
+        staging_path(upload_id).unlink(missing_ok=True)
+
+
+def register_upload_routes(app, upload_sessions, require_auth, blob_store=None):
+    staging_root().mkdir(parents=True, exist_ok=True)
+    if blob_store is None:
+        blob_store = BlobStore.from_env(upload_sessions.database["blobs"])
+    direct_ok = getattr(blob_store.storage, "presigns", False)
+
+    def _session(upload_id):
+        return live_session(upload_sessions.find_one({"_id": upload_id, "user_id": request.user.get("_id")}))
+
+    def _state(s):
+        return {
+            "upload_id": s["_id"],
+            "kind": s.get("kind"),
+            "filename": s.get("filename"),
+            "size": s.get("size"),
+            "offset": s.get("received", 0),
+            "status": s.get("status"),
+            "sha256": s.get("digest"),
+            "chunk_max_bytes": CHUNK_MAX_BYTES,
+            "direct": bool(s.get("direct")),
+        }
+
+    # Open a resumable upload session: {kind: image|voice, filename, size, mime?, sha256?, direct?}
+    # With direct=true and an object-storage backend (STORAGE_BACKEND=s3) the response carries a
+    # presigned `put` ({url, headers}) and the client uploads the whole file to it instead of
+    # sending chunks here; sha256 is then required. The PUT is required even when the content is
+    # already stored: /complete only accepts an object written after the session was opened.
+    @app.post("/mobile/uploads")
+    @require_auth
+    def open_upload():
+        u = request.user
+        data = request.get_json(force=True) or {}
+        kind = norm(data.get("kind")).lower()
+        if kind not in ("image", "voice"):
+            return jsonify({"detail": "kind must be image or voice"}), 400
+        try:
+            size = int(data.get("size"))
+        except (TypeError, ValueError):
+            return jsonify({"detail": "size required"}), 400
+        max_bytes = app.config.get("MAX_CONTENT_LENGTH") or 0
+        if size <= 0 or (max_bytes and size > max_bytes):
+            return jsonify({"detail": "Invalid size"}), 400
+        mime = norm(data.get("mime"))
+        try:
+            filename = clean_filename(data.get("filename"), mime, kind)
+        except ValueError as ve:
+            return jsonify({"detail": str(ve)}), 400
+        declared = norm(data.get("sha256")).lower() or None
+        direct = bool(data.get("direct")) and direct_ok
+        if direct and not re.fullmatch(r"[0-9a-f]{64}", declared or ""):
+            return jsonify({"detail": "sha256 required for direct uploads"}), 400
+
+        now = utcnow()
+        upload_id = new_id()
+        if not direct:
+            with open(staging_path(upload_id), "wb") as f:
+                f.truncate(size)
+        s = {
+            "_id": upload_id,
+            "user_id": u.get("_id"),
+            "kind": kind,
+            "filename": filename,
+            "mime": mime or (mimetypes.guess_type(filename)[0] or "application/octet-stream"),
+            "size": size,
+            "received": 0,
+            "sha256": declared,
+            "status": "OPEN",
+            "created_at": now,
+            "expires_at": now + timedelta(hours=UPLOAD_SESSION_HOURS),
+        }
+        if direct:
+            s["direct"] = True
+        upload_sessions.insert_one(s)
+        out = _state(s)
+        if direct:
+            out["put"] = blob_store.storage.presign_put(blob_store.key(declared), declared, s["mime"])
+        return jsonify(out), 201
+
+    @app.get("/mobile/uploads/<upload_id>")
+    @require_auth
+    def upload_status(upload_id):
+        s = _session(upload_id)
+        if not s:
+            return jsonify({"detail": "Not found"}), 404
+        out = _state(s)
+        if s.get("direct") and s.get("status") == "OPEN":
+            # Fresh URL for a client resuming after the previous one expired.
+            out["put"] = blob_store.storage.presign_put(blob_store.key(s["sha256"]), s["sha256"], s["mime"])
+        resp = jsonify(out)
+        resp.headers["Upload-Offset"] = str(s.get("received", 0))
+        return resp
+
+    # Append one chunk. Content-Range: bytes <start>-<end>/<size>; <start> must equal the
+    # current offset (GET the session to resume after a dropped connection).
+    @app.put("/mobile/uploads/<upload_id>")
+    @require_auth
+    def put_chunk(upload_id):
+        s = _session(upload_id)
+        if not s:
+            return jsonify({"detail": "Not found"}), 404
+        try:
+            start, end = chunk_range(s, request.headers.get("Content-Range"))
+        except ChunkError as ce:
+            if ce.offset is None:
+                return jsonify({"detail": ce.detail}), ce.status_code
+            resp = jsonify({"detail": ce.detail, "offset": ce.offset})
+            resp.headers["Upload-Offset"] = str(ce.offset)
+            return resp, ce.status_code
+        length = end - start + 1
+        hasher = take_hasher(upload_id, start)
+
+        written = 0
+        with open(staging_path(upload_id), "r+b") as f:
+            f.seek(start)
+            while written < length:
+                block = request.stream.read(min(_COPY_BUF, length - written))
+                if not block:
+                    break
+                f.write(block)
+                if hasher is not None:
+                    hasher.update(block)
+                written += len(block)
+        if written != length:
+            return jsonify({"detail": "Incomplete chunk", "offset": start}), 400
+
+        res = upload_sessions.update_one(
+            {"_id": upload_id, "status": "OPEN", "received": start},
+            {"$set": {"received": end + 1, "updated_at": utcnow()}},
+        )
+        if not res.modified_count:
+            return jsonify({"detail": "Concurrent chunk upload"}), 409
+        keep_hasher(upload_id, end + 1, hasher)
+
+        resp = jsonify({"upload_id": upload_id, "offset": end + 1, "size": s["size"]})
+        resp.headers["Upload-Offset"] = str(end + 1)
+        return resp
+
+    @app.post("/mobile/uploads/<upload_id>/complete")
+    @require_auth
+    def complete_upload(upload_id):
+        s = _session(upload_id)
+        if not s:
+            return jsonify({"detail": "Not found"}), 404
+        if s.get("status") == "DONE":
+            return jsonify(_state(s))
+        if s.get("status") != "OPEN":
+            return jsonify({"detail": "Upload already used"}), 409
+        if s.get("direct"):
+            # The object store verified the signed sha256; check that this session's PUT happened.
+            # An object that was already there (same hash, another user) does not count: knowing
+            # a hash must not be enough to attach the file. LastModified has second precision.
+            stat = blob_store.storage.stat(blob_store.key(s["sha256"]))
+            opened = naive_utc(s["created_at"]).replace(microsecond=0)
+            if not stat or stat[0] != s["size"] or naive_utc(stat[1]) < opened:
+                return jsonify({"detail": "Upload incomplete", "offset": 0}), 409
+            upload_sessions.update_one(
+                {"_id": upload_id, "status": "OPEN"},
+                {"$set": {"status": "DONE", "digest": s["sha256"], "received": s["size"], "completed_at": utcnow()}},
+            )
+            s.update({"status": "DONE", "digest": s["sha256"], "received": s["size"]})
+            return jsonify(_state(s))
+        if int(s.get("received", 0)) != s["size"]:
+            return jsonify({"detail": "Upload incomplete", "offset": s.get("received", 0)}), 409
+
+        with _hashers_lock:
+            state = _hashers.pop(upload_id, None)
+        path = staging_path(upload_id)
+        digest = state[1].hexdigest() if state and state[0] == s["size"] else sha256_file(path)
+        if s.get("sha256") and s["sha256"] != digest:
+            upload_sessions.update_one({"_id": upload_id}, {"$set": {"status": "FAILED", "digest": digest}})
+            path.unlink(missing_ok=True)
+            return jsonify({"detail": "sha256 mismatch"}), 422
+
+        upload_sessions.update_one(
+            {"_id": upload_id, "status": "OPEN"},
+            {"$set": {"status": "DONE", "digest": digest, "completed_at": utcnow()}},
+        )
+        s.update({"status": "DONE", "digest": digest})
+        return jsonify(_state(s))
+
+
+# Removes staged files whose session is gone, expired or no longer needs them.
+def cleanup_staging(upload_sessions) -> int:
+    root = staging_root()
+    if not root.exists():
+        return 0
+    now = naive_utc(utcnow())
+    removed = 0
+    for p in root.glob("*.part"):
+        s = upload_sessions.find_one({"_id": p.stem}, {"status": 1, "expires_at": 1, "used_at": 1})
+        expired = not s or (s.get("expires_at") and naive_utc(s["expires_at"]) <= now)
+        # A USED upload without used_at is claimed by a submit still in flight.
+        done = s and (s.get("status") == "FAILED" or (s.get("status") == "USED" and s.get("used_at")))
+        if expired or done:
+            p.unlink(missing_ok=True)
+            removed += 1
+    return removed
+
@@ -1,3 +1,5 @@
+import json
+import base64
 import hashlib
 import secrets
 from datetime import datetime, timezone
@@ -5,6 +7,12 @@ from datetime import datetime, timezone
 def utcnow():
     return datetime.now(timezone.utc)
 
+# Datetimes read back from MongoDB are naive UTC; use this before comparing them with utcnow().
+def naive_utc(dt):
+    if dt is not None and dt.tzinfo is not None:
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
 def new_id():
     return secrets.token_urlsafe(12).replace("-", "").replace("_", "")
 
@@ -18,3 +26,11 @@ def mac_hash(mac: str):
 
 def norm(s):
     return (s or "").strip()
+
+# Opaque URL-safe tokens (page cursors, sync tokens) carrying a small JSON value.
+def encode_token(value) -> str:
+    raw = json.dumps(value, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_token(token: str):
+    return json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
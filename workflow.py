@@ -0,0 +1,191 @@
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
+
+import buckets
+import stats
+from util import utcnow, norm
+
+# Workorder state transitions shared by the desktop-compatible and mobile routes.
+# Each transition is a single conditional update: the filter guards on the expected
+# current status (compare-and-set) and the new history/work_updates entries are $push-ed,
+# so concurrent writers never overwrite each other's entries.
+
+# Post-update state returned by the transitions.
+STATE_PROJECTION = {
+    "status": 1,
+    "assigned_team_ids": 1,
+    "accepted_by": 1,
+    "accepted_at": 1,
+    "in_progress_by": 1,
+    "in_progress_at": 1,
+    "completed_by": 1,
+    "completed_at": 1,
+    "updated_at": 1,
+    "wo_no": 1,
+    "customer_name": 1,
+    "location": 1,
+}
+
+
+class TransitionError(Exception):
+    def __init__(self, detail: str, status_code: int):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code
+
+
+# submit() found its work_updates entry already stored (a replayed request).
+class AlreadyApplied(TransitionError):
+    def __init__(self):
+        super().__init__("Update already applied", 409)
+
+
+def _scope(wo_id, uid, admin: bool):
+    filt = {"_id": wo_id, "is_deleted": {"$ne": True}}
+    if not admin:
+        filt["assigned_team_ids"] = uid
+    return filt
+
+
+def _find_and_update(workorders, filt, update):
+    return workorders.find_one_and_update(
+        filt,
+        update,
+        projection=STATE_PROJECTION,
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+# $push fails (BadValue) on an array field stored as null, which older documents have;
+# such fields are set to [] once and the update is retried.
+def _push_update(workorders, filt, update, kinds):
+    try:
+        return _find_and_update(workorders, filt, update)
+    except OperationFailure as e:
+        if e.code != 2:
+            raise
+    for k in kinds:
+        workorders.update_one({"_id": filt["_id"], k: {"$exists": True, "$eq": None}}, {"$set": {k: []}})
+    return _find_and_update(workorders, filt, update)
+
+
+# pushes: {"history": entry, "work_updates": entry}. In bucket mode the update only
+# applies to migrated workorders; an unmigrated one is migrated once and retried.
+def _apply(workorders, filt, patch: dict, pushes: dict):
+    update = {"$set": patch, **buckets.push_ops(pushes)}
+    if not buckets.ENABLED:
+        return _push_update(workorders, filt, update, pushes)
+
+    filt = dict(filt, updates_bucketed=True)
+    d = _push_update(workorders, filt, update, pushes)
+    if d is None and buckets.migrate(workorders, filt["_id"]):
+        d = _push_update(workorders, filt, update, pushes)
+    if d is not None:
+        buckets.archive(workorders, filt["_id"], pushes)
+    return d
+
+
+# Small projected read used to explain why a conditional update matched nothing.
+def current_state(workorders, u, wo_id, admin: bool = False):
+    d = workorders.find_one({"_id": wo_id, "is_deleted": {"$ne": True}}, {"status": 1, "assigned_team_ids": 1})
+    if not d:
+        raise TransitionError("Not found", 404)
+    if not admin and u.get("_id") not in (d.get("assigned_team_ids") or []):
+        raise TransitionError("Forbidden", 403)
+    return d
+
+
+def _status(d):
+    return (norm((d or {}).get("status")) or "").upper()
+
+
+def history_entry(u, action, status, now):
+    return {"at": now.isoformat(), "by": u.get("_id"), "action": action, "status": status}
+
+
+# ASSIGNED/DRAFT -> ACCEPTED. Only members of assigned_team_ids may accept.
+def accept(workorders, u, wo_id):
+    now = utcnow()
+    filt = _scope(wo_id, u["_id"], admin=False)
+    filt["status"] = {"$in": ["ASSIGNED", "DRAFT", "", None]}
+    d = _apply(
+        workorders,
+        filt,
+        {"status": "ACCEPTED", "accepted_by": u["_id"], "accepted_at": now, "updated_at": now},
+        {"history": history_entry(u, "ACCEPT", "ACCEPTED", now)},
+    )
+    if d is None:
+        current_state(workorders, u, wo_id)
+        raise TransitionError("Invalid state", 409)
+    stats.record_accept(workorders, u["_id"], now)
+    return d
+
+
+# ACCEPTED -> IN_PROGRESS; IN_PROGRESS is accepted as a no-op.
+def start(workorders, u, wo_id, admin: bool = False):
+    expected = "ACCEPTED"
+    for _ in range(2):
+        now = utcnow()
+        filt = _scope(wo_id, u.get("_id"), admin)
+        filt["status"] = expected
+        d = _apply(
+            workorders,
+            filt,
+            {"status": "IN_PROGRESS", "in_progress_by": u.get("_id"), "in_progress_at": now, "updated_at": now},
+            {"history": history_entry(u, "MOBILE_START_WORK", "IN_PROGRESS", now)},
+        )
+        if d is not None:
+            stats.record_activity(workorders, u.get("_id"), now)
+            return d
+
+        d = current_state(workorders, u, wo_id, admin)
+        cur_status = _status(d)
+        if cur_status == "COMPLETED":
+            raise TransitionError("Already completed", 400)
+        if cur_status == "IN_PROGRESS":
+            return d
+        if cur_status != "ACCEPTED":
+            raise TransitionError(f"Cannot start work from status: {cur_status}", 400)
+        # Stored with a different case (e.g. "Accepted"); retry against the stored value.
+        expected = d.get("status")
+    raise TransitionError("Conflict, please retry", 409)
+
+
+# Raises unless u may still submit updates to wo_id. Reads only status and assignees.
+def check_submit(workorders, u, wo_id, admin: bool = False):
+    d = current_state(workorders, u, wo_id, admin)
+    if _status(d) == "COMPLETED":
+        raise TransitionError("Already completed", 400)
+    return d
+
+
+def has_update(workorders, wo_id, update_id) -> bool:
+    if workorders.find_one({"_id": wo_id, "work_updates.id": update_id}, {"_id": 1}):
+        return True
+    return buckets.find_update(workorders, wo_id, update_id) is not None
+
+
+# Appends update_doc to work_updates and moves the workorder to target_status.
+def submit(workorders, u, wo_id, update_doc: dict, target_status: str, admin: bool = False, now=None):
+    now = now or utcnow()
+    filt = _scope(wo_id, u.get("_id"), admin)
+    filt["status"] = {"$ne": "COMPLETED"}
+    # Replays carry the same update id; never append it twice.
+    filt["work_updates.id"] = {"$ne": update_doc["id"]}
+    patch = {"status": target_status, "updated_at": now}
+    if target_status == "COMPLETED":
+        patch.update({"completed_by": u.get("_id"), "completed_at": now})
+    d = _apply(workorders, filt, patch, {
+        "work_updates": update_doc,
+        "history": history_entry(u, "MOBILE_SUBMIT", target_status, now),
+    })
+    if d is None:
+        if has_update(workorders, wo_id, update_doc["id"]):
+            raise AlreadyApplied()
+        check_submit(workorders, u, wo_id, admin)
+        raise TransitionError("Conflict, please retry", 409)
+    if target_status == "COMPLETED":
+        stats.record_completion(workorders, u.get("_id"), {**d, "_id": wo_id}, now)
+    else:
+        stats.record_activity(workorders, u.get("_id"), now)
+    return d